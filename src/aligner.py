@@ -0,0 +1,190 @@
+import multiprocessing
+import queue
+import time
+from concurrent import futures
+from threading import Event
+from typing import Optional, Tuple
+
+import native_aligner
+from native_aligner import Fragments
+
+# aeneas synthesizes text with espeak and matches it with audio,
+# native lays text out at constant rate and matches it with singing
+ENGINES = ("aeneas", "native")
+# how often alignment being waited for is checked for cancellation
+CANCEL_INTERVAL = 0.5
+
+# aeneas runtime configuration living in a pool worker process,
+# see AlignerPool. aeneas synthesizes text of every alignment from
+# scratch, so there is no per language state worth keeping
+_worker_config: Optional[object] = None
+
+
+def _init_worker(engine: str):
+    """
+    Loads aeneas and langdetect once per worker process
+    """
+    global _worker_config
+    if engine != "aeneas":
+        return
+    import aeneas.executetask  # type: ignore # noqa: F401
+    from aeneas.runtimeconfiguration import (  # type: ignore
+        RuntimeConfiguration,
+    )
+    from langdetect import DetectorFactory, detect  # type: ignore
+
+    _worker_config = RuntimeConfiguration()
+    # same text is always detected as the same language
+    DetectorFactory.seed = 0
+    # language profiles are loaded on first detection
+    detect("warm up")
+
+
+def _align_in_worker(
+    engine: str,
+    text_path: str,
+    audio_path: str,
+    language: Optional[str],
+) -> Tuple[str, Fragments]:
+    if engine == "native":
+        lines = native_aligner.align(text_path, audio_path)
+        return language or "", lines
+
+    from aeneas.executetask import ExecuteTask  # type: ignore
+    from aeneas.task import Task  # type: ignore
+    from langdetect import detect  # type: ignore
+
+    if not language:
+        with open(text_path, encoding="utf-8") as file:
+            language = detect(file.read())
+
+    task = Task(
+        config_string=f"task_language={language}"
+        "|is_text_type=plain|os_task_file_format=srt"
+    )
+    task.audio_file_path_absolute = audio_path
+    task.text_file_path_absolute = text_path
+    ExecuteTask(task, rconf=_worker_config).execute()
+    return language, [
+        (float(f.begin), float(f.end), f.text)
+        for f in task.sync_map.fragments
+    ]
+
+
+class AlignerPool:
+    """
+    Pool of alignment worker processes, so alignments run in
+    parallel, outside of the api process, and one stuck or no longer
+    needed alignment is killed instead of holding up the rest <br>
+    Usage: <br>
+        - Create pool: p = AlignerPool(workers=2, timeout=300) <br>
+        - Align lyrics via p.align()
+    """
+
+    def __init__(
+        self,
+        workers: int = 2,
+        timeout: float = 300,
+        engine: str = "aeneas",
+    ):
+        """
+        Args:
+            workers (int): number of alignment processes
+            timeout (float): seconds after which alignment is killed
+            engine (str): aeneas or native
+
+        Raises:
+            ValueError: engine is not supported
+        """
+        if engine not in ENGINES:
+            raise ValueError(f"Unsupported aligner: {engine}")
+        self.engine = engine
+        self.workers = max(1, workers)
+        self.timeout = timeout
+        self.__context = multiprocessing.get_context("spawn")
+        self.__executors = [
+            self.__create_executor() for _ in range(self.workers)
+        ]
+        # indexes of workers not aligning anything right now
+        self.__idle: queue.Queue = queue.Queue()
+        for index in range(self.workers):
+            self.__idle.put(index)
+
+    def __create_executor(self) -> futures.ProcessPoolExecutor:
+        return futures.ProcessPoolExecutor(
+            1,
+            mp_context=self.__context,
+            initializer=_init_worker,
+            initargs=(self.engine,),
+        )
+
+    def align(
+        self,
+        text_path: str,
+        audio_path: str,
+        language: Optional[str] = None,
+        cancelled: Optional[Event] = None,
+    ) -> Tuple[str, Fragments]:
+        """
+        Aligns lines of text file with audio, waits for a free worker
+
+        Args:
+            text_path (str): plain text, one line per fragment
+            audio_path (str): audio the text is sung in
+            language (str): language code, detected if not given
+            cancelled (Event): kills alignment once it is set
+
+        Returns:
+            tuple: (language, fragments)
+
+        Raises:
+            TimeoutError: alignment took longer than timeout
+            CancelledError: alignment was cancelled
+        """
+        index = self.__idle.get()
+        try:
+            job = self.__executors[index].submit(
+                _align_in_worker,
+                self.engine,
+                text_path,
+                audio_path,
+                language,
+            )
+            deadline = time.time() + self.timeout
+            while True:
+                if cancelled is not None and cancelled.is_set():
+                    self.__restart(index)
+                    raise futures.CancelledError("Alignment cancelled")
+                left = deadline - time.time()
+                try:
+                    return job.result(
+                        max(0, min(left, CANCEL_INTERVAL))
+                    )
+                except futures.TimeoutError as e:
+                    if time.time() < deadline:
+                        continue
+                    self.__restart(index)
+                    raise TimeoutError(
+                        f"Alignment took over {self.timeout}s"
+                    ) from e
+                except futures.process.BrokenProcessPool:
+                    self.__restart(index)
+                    raise
+        finally:
+            self.__idle.put(index)
+
+    def __restart(self, index: int):
+        """
+        Kills worker process, the only way to stop running alignment,
+        and replaces it with a fresh one
+        """
+        executor = self.__executors[index]
+        # executor has no public way to kill its processes
+        for process in list((executor._processes or {}).values()):
+            process.kill()
+        executor.shutdown(wait=False)
+        self.__executors[index] = self.__create_executor()
+
+    def shutdown(self):
+        for executor in self.__executors:
+            executor.shutdown(wait=False, cancel_futures=True)
@@ -1,64 +1,568 @@
+import asyncio
 import json
 import os
-from threading import Thread
-
-from fastapi import FastAPI, HTTPException
-from fastapi.responses import FileResponse
+from contextlib import asynccontextmanager
+from email.utils import formatdate, parsedate_to_datetime
+from typing import List, Optional
+from urllib.parse import quote
+
+from fastapi import (
+    FastAPI,
+    HTTPException,
+    Request,
+    WebSocket,
+    WebSocketDisconnect,
+)
+from fastapi.responses import (
+    FileResponse,
+    JSONResponse,
+    Response,
+    StreamingResponse,
+)
+from pydantic import BaseModel
 
 from download import DOWNLOADS_PATH, Download
+from encoder import BITRATES, Mp3StreamEncoder, StemEncoder
 from engine import Engine
+from jobs import open_job_store
 from lyrics import Lyrics
-from search import Search
+from pipeline import STAGES, Pipeline, Saturated
+from progress import FINAL_STAGES
+from search import PLAYLIST_LIMIT, Playlist, SearchCache
+from separator import WAV_HEADER_SIZE, Separator
+
+# how often a stem that is still being separated is checked for
+# new data, and how much of it is sent at once
+STREAM_POLL_INTERVAL = 0.5
+STREAM_CHUNK_SIZE = 64 * 1024
+# seconds stream waits for separation to start or to write more
+# before it gives up, e.g. when worker separating the song died
+STREAM_MAX_WAIT = 600.0
+# finished stems never change under their urls, so clients and
+# proxies keep them without asking again
+IMMUTABLE = "public, max-age=31536000, immutable"
+# lyrics and metadata can change when song is processed again,
+# so cached copies are revalidated, which is a cheap 304
+REVALIDATE = "public, no-cache"
+# location nginx serves downloads directory from, when set files are
+# sent by nginx (X-Accel-Redirect) with sendfile instead of the api
+ACCEL_REDIRECT_PREFIX = os.getenv("ACCEL_REDIRECT_PREFIX", "")
+# songs submitted or checked at once by batch endpoints
+MAX_BATCH = PLAYLIST_LIMIT
+# idle progress subscriptions get a keepalive this often (seconds),
+# so proxies do not close them
+EVENTS_KEEPALIVE = 15.0
+
+
+def get_stem_path(song_id: str, stem: str) -> str:
+    """
+    Returns path of complete lossless stem of a song
+    """
+    return Separator.get_stem_path(
+        Download.get_download_dir(song_id), stem
+    )
+
+
+def is_separating(song_id: str) -> bool:
+    """
+    Tells if stems of a song can still appear or grow, which they
+    can not once song is done, failed or cancelled
+    """
+    if engine.is_done(Download.get_download_dir(song_id)):
+        return False
+    return pipeline.get_stage(song_id) is not None
+
+
+async def follow_stem(song_id: str, stem: str, bitrate: int):
+    """
+    Yields stem encoded to mp3 as it is being written by separation,
+    ends once it is complete, separation is over or nothing was
+    written for STREAM_MAX_WAIT
+    """
+    path = get_stem_path(song_id, stem)
+    # separation writes stem under .part and renames it when done,
+    # file stays the same, so it can be followed across the rename
+    part = f"{path}.part"
+
+    file = None
+    waited = 0.0
+    while file is None:
+        # checked before opening, so stem finished meanwhile is found
+        over = not await asyncio.to_thread(is_separating, song_id)
+        for candidate in (path, part):
+            try:
+                file = open(candidate, "rb")  # noqa: SIM115
+                break
+            except FileNotFoundError:
+                continue
+        if file is None:
+            if over or waited >= STREAM_MAX_WAIT:
+                return
+            await asyncio.sleep(STREAM_POLL_INTERVAL)
+            waited += STREAM_POLL_INTERVAL
+
+    with file:
+        data = b""
+        mp3 = None
+        finished = False
+        waited = 0.0
+        while True:
+            chunk = await asyncio.to_thread(
+                file.read, STREAM_CHUNK_SIZE
+            )
+            if chunk:
+                waited = 0.0
+                data += chunk
+                if mp3 is None:
+                    if len(data) < WAV_HEADER_SIZE:
+                        continue
+                    mp3 = Mp3StreamEncoder(
+                        data[:WAV_HEADER_SIZE], bitrate
+                    )
+                    data = data[WAV_HEADER_SIZE:]
+                yield mp3.encode(data)
+                data = b""
+            elif finished:
+                if mp3 is not None:
+                    yield mp3.flush()
+                return
+            else:
+                # read whatever was written before it got finished
+                finished = (
+                    not os.path.exists(part)
+                    or waited >= STREAM_MAX_WAIT
+                    or not await asyncio.to_thread(
+                        is_separating, song_id
+                    )
+                )
+                if not finished:
+                    await asyncio.sleep(STREAM_POLL_INTERVAL)
+                    waited += STREAM_POLL_INTERVAL
+
+
+def stream_stem(
+    song_id: str, stem: str, bitrate: int
+) -> StreamingResponse:
+    if not os.path.isdir(Download.get_download_dir(song_id)):
+        raise HTTPException(
+            status_code=404, detail="Path does not exist"
+        )
+    if bitrate not in BITRATES:
+        raise HTTPException(
+            status_code=400, detail=f"Unsupported bitrate: {bitrate}"
+        )
+    engine.touch(Download.get_download_dir(song_id))
+
+    return StreamingResponse(
+        follow_stem(song_id, stem, bitrate),
+        media_type=StemEncoder.get_media_type("mp3"),
+    )
+
+
+def get_cache_headers(
+    song_id: str, tag: str, stat: os.stat_result, cache_control: str
+) -> dict:
+    """
+    Returns validators of a song file, ETag is strong and stays the
+    same until the song is processed again
+
+    Args:
+        song_id (str): id of the song
+        tag (str): what is served, e.g. vocals.mp3.320
+        stat (os.stat_result): stat of file response is made from
+        cache_control (str): IMMUTABLE or REVALIDATE
+    """
+    return {
+        "ETag": f'"{song_id}-{tag}-{stat.st_mtime_ns:x}-{stat.st_size:x}"',
+        "Last-Modified": formatdate(stat.st_mtime, usegmt=True),
+        "Cache-Control": cache_control,
+    }
 
 
-def wait_for_engine_end_and_get_lyrics(path: str):
-    engine.wait_for(path)
+def is_not_modified(request: Request, headers: dict) -> bool:
+    """
+    Tells if client already has the file headers were made for
+    """
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        tags = [tag.strip() for tag in if_none_match.split(",")]
+        etag = headers["ETag"]
+        return "*" in tags or etag in tags or f"W/{etag}" in tags
+
+    if_modified_since = request.headers.get("if-modified-since")
+    if if_modified_since is None:
+        return False
     try:
-        with open(f"{path}/metadata.json") as file:
-            txt = file.read()
-            j = json.loads(txt)
-            title = j["title"]
-            lyrics = Lyrics("", title, path)
-            lyrics.is_done()
-    except Exception as e:
-        print(f"internal error while queueing song {e}")
+        since = parsedate_to_datetime(if_modified_since)
+        modified = parsedate_to_datetime(headers["Last-Modified"])
+    except (TypeError, ValueError):
+        return False
+    return modified <= since
+
 
+def stat_file(path: str, detail: str) -> os.stat_result:
+    """
+    Returns stat of a file
 
-def wait_for_download_end(downloader: Download):
-    downloader.wait_for()
+    Raises:
+        HTTPException: file does not exist
+    """
     try:
-        engine.enqueue(f"{DOWNLOADS_PATH}/{downloader.get_name()}")
+        return os.stat(path)
+    except FileNotFoundError as e:
+        raise HTTPException(status_code=404, detail=detail) from e
+
+
+def send_file(
+    path: str, filename: str, media_type: str, headers: dict
+) -> Response:
+    """
+    Returns file with cache headers. Range requests are answered
+    by FileResponse, which sends whole files with pathsend when
+    server supports it, or by nginx when ACCEL_REDIRECT_PREFIX is set
+    """
+    if ACCEL_REDIRECT_PREFIX:
+        relative = os.path.relpath(path, DOWNLOADS_PATH)
+        location = (
+            f"{ACCEL_REDIRECT_PREFIX.rstrip('/')}/{quote(relative)}"
+        )
+        return Response(
+            media_type=media_type,
+            headers={
+                **headers,
+                "X-Accel-Redirect": location,
+                "Content-Disposition": f'attachment; filename="{filename}"',
+            },
+        )
+    return FileResponse(
+        path=path,
+        filename=filename,
+        media_type=media_type,
+        headers=headers,
+    )
+
+
+async def encoded_stem(
+    request: Request, song_id: str, stem: str, format: str, bitrate: int
+) -> Response:
+    """
+    Returns complete stem encoded to requested format,
+    encoding happens on first request of each variant.
+    Client that has the variant already gets 304 without encoding,
+    which is why ETag comes from the lossless stem. Encoding is
+    bit-exact, so variant encoded again matches the ETag too
+    """
+    path = get_stem_path(song_id, stem)
+    stat = stat_file(path, "Path does not exist")
+    engine.touch(Download.get_download_dir(song_id))
+    headers = get_cache_headers(
+        song_id, f"{stem}.{format}.{bitrate}", stat, IMMUTABLE
+    )
+    if is_not_modified(request, headers):
+        return Response(status_code=304, headers=headers)
+
+    try:
+        variant = await asyncio.to_thread(
+            encoder.get, path, format, bitrate
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e)) from e
     except Exception as e:
-        print(f"internal error while queueing song {e}")
+        raise HTTPException(
+            status_code=500, detail="Unable to encode song"
+        ) from e
+
+    _, ext = os.path.splitext(variant)
+    return send_file(
+        variant,
+        f"audio{ext}",
+        StemEncoder.get_media_type(format),
+        headers,
+    )
+
+
+def song_file(
+    request: Request,
+    song_id: str,
+    name: str,
+    media_type: str,
+    detail: str,
+) -> Response:
+    """
+    Returns lyrics or metadata file of a song
+    """
+    path = os.path.join(Download.get_download_dir(song_id), name)
+    stat = stat_file(path, detail)
+    headers = get_cache_headers(song_id, name, stat, REVALIDATE)
+    if is_not_modified(request, headers):
+        return Response(status_code=304, headers=headers)
+    return send_file(path, name, media_type, headers)
+
 
-    wait_for_engine_end_and_get_lyrics(
-        f"{DOWNLOADS_PATH}/{downloader.get_name()}"
+async def watch_song(song_id: str):
+    """
+    Subscribes to progress of a song
+
+    Returns:
+        async iterator: progress events, None for keepalives
+
+    Raises:
+        HTTPException: song is neither processed nor being processed
+    """
+    progress = pipeline.progress
+    queue = progress.open(song_id)
+    if pipeline.is_processing(song_id):
+        return progress.listen(song_id, queue, EVENTS_KEEPALIVE)
+
+    progress.close(song_id, queue)
+    # job store and catalog are sqlite, so they are read in a thread
+    if await asyncio.to_thread(pipeline.get_stage, song_id) is not None:
+        return follow_song(song_id)
+    done = await asyncio.to_thread(
+        engine.is_done, Download.get_download_dir(song_id)
     )
+    if not done:
+        raise HTTPException(
+            status_code=404, detail="Song is not being processed"
+        )
+
+    async def done():
+        yield {"song_id": song_id, "stage": "done", "percent": 100}
+
+    return done()
+
+
+async def follow_song(song_id: str):
+    """
+    Yields stage changes of a song queued or processed by another
+    worker, polled from job store, None for keepalives
+    """
+    last = None
+    idle = 0.0
+    while True:
+        stage = await asyncio.to_thread(pipeline.get_stage, song_id)
+        if stage is None:
+            done = await asyncio.to_thread(
+                engine.is_done, Download.get_download_dir(song_id)
+            )
+            stage = "done" if done else "failed"
+        if stage != last:
+            percent = 100 if stage == "done" else 0
+            yield {
+                "song_id": song_id,
+                "stage": stage,
+                "percent": percent,
+            }
+            last, idle = stage, 0.0
+        elif idle >= EVENTS_KEEPALIVE:
+            yield None
+            idle = 0.0
+        if stage in FINAL_STAGES:
+            return
+        await asyncio.sleep(STREAM_POLL_INTERVAL)
+        idle += STREAM_POLL_INTERVAL
+
+
+async def format_events(events):
+    """
+    Formats progress events as server-sent events
+    """
+    async for event in events:
+        if event is None:
+            yield ": keepalive\n\n"
+        else:
+            yield f"event: progress\ndata: {json.dumps(event)}\n\n"
+
+
+class Batch(BaseModel):
+    """
+    Songs submitted at once, as links, playlist or both
+    """
+
+    links: List[str] = []
+    playlist: Optional[str] = None
+    priority: int = 0
+
+
+class SongIds(BaseModel):
+    song_ids: List[str]
+
+
+def saturated_response(e: Saturated) -> JSONResponse:
+    content = {
+        "detail": str(e),
+        "queue_position": e.position,
+        "retry_after": e.retry_after,
+    }
+    # songs of a batch that fitted are queued, the rest are null
+    if e.song_ids:
+        content["song_ids"] = e.song_ids
+    return JSONResponse(
+        status_code=429,
+        headers={"Retry-After": str(e.retry_after)},
+        content=content,
+    )
+
+
+def get_song_status(song_id: str) -> dict:
+    """
+    Returns readiness of a song, with its metadata once it is ready
+    """
+    path = Download.get_download_dir(song_id)
+
+    if not engine.is_done(path):
+        return {"ready": False, "stage": pipeline.get_stage(song_id)}
+
+    with open(os.path.join(path, "metadata.json")) as file:
+        metadata = json.load(file)
+
+    metadata["ready"] = True
+    return metadata
+
+
+def get_client(request: Request) -> str:
+    """
+    Returns id of client songs are queued for, shared by its
+    requests, so it gets fair share of workers
+    """
+    client = request.headers.get("X-Client-Id")
+    if client:
+        return client
+    return request.client.host if request.client else ""
 
 
-app = FastAPI()
-engine = Engine()
+def get_stage_config(setting: str) -> dict:
+    """
+    Reads per stage settings given in environment,
+    e.g. PIPELINE_DOWNLOAD_CONCURRENCY
+    """
+    config = {}
+    for stage in STAGES:
+        value = os.getenv(f"PIPELINE_{stage.upper()}_{setting}")
+        if value:
+            config[stage] = int(value)
+    return config
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    pipeline.start(os.getenv("PROCESS_SONGS", "1") == "1")
+    yield
+    pipeline.stop()
+
+
+app = FastAPI(lifespan=lifespan)
+jobs = open_job_store(os.getenv("JOB_STORE", ""))
+engine = Engine(
+    warmup=os.getenv("SEPARATOR_WARMUP", "0") == "1",
+    workers=os.getenv("SEPARATION_WORKERS", "1"),
+    threads=int(os.getenv("SEPARATION_THREADS", "0")) or None,
+    device=os.getenv("SEPARATION_DEVICE") or None,
+    streaming_min_duration=float(
+        os.getenv("STREAMING_MIN_DURATION", "0")
+    ),
+    disk_budget=int(os.getenv("DISK_BUDGET", "10240")) * 1024**2,
+    max_idle=float(os.getenv("MAX_IDLE", "0")) or None,
+    is_active=jobs.is_leased,
+)
+searches = SearchCache(
+    int(os.getenv("SEARCH_CACHE_SIZE", "1024")),
+    float(os.getenv("SEARCH_CACHE_TTL", "3600")),
+)
+encoder = StemEncoder(
+    int(os.getenv("ENCODED_CACHE_BUDGET", "2048")) * 1024**2
+)
+pipeline = Pipeline(
+    engine,
+    concurrency={
+        "separate": engine.get_workers(),
+        **get_stage_config("CONCURRENCY"),
+    },
+    queue_sizes=get_stage_config("QUEUE"),
+    jobs=jobs,
+    client_queue_size=int(os.getenv("PIPELINE_CLIENT_QUEUE", "0"))
+    or None,
+    shortest_first=os.getenv("PIPELINE_SHORTEST_FIRST", "0") == "1",
+    speculative_separation=os.getenv("PREFETCH_SEPARATE", "0") == "1",
+)
+# top search results prefetched while pipeline is idle, 0 disables it
+PREFETCH_RESULTS = int(os.getenv("PREFETCH_RESULTS", "0"))
+PREFETCH_LIMIT = int(os.getenv("PREFETCH_LIMIT", "8"))
 
 
 @app.post("/v1/process_song")
-async def process_song(link):
+async def process_song(link, request: Request, priority: int = 0):
     """
     Receives link to a song and directs it to download and process
 
+    Args:
+        priority (int): songs with higher priority are processed first
+
     Returns:
         json: unique song id based on youtube url
     """
-    download = Download(link)
-    engine.enqueue(download)
+    try:
+        song_id = await asyncio.to_thread(
+            pipeline.submit, link, get_client(request), priority
+        )
+    except Saturated as e:
+        return saturated_response(e)
+
+    return {"song_id": song_id}
+
+
+@app.post("/v1/process_songs")
+async def process_songs(batch: Batch, request: Request):
+    """
+    Receives links to songs and/or a playlist link and directs them
+    all to download and process, in the given order. When only some
+    fit in the queue, 429 lists ids of those that were queued
+
+    Returns:
+        json: song ids in order of links, playlist songs last
+    """
+    links = list(batch.links)
+    if batch.playlist:
+        try:
+            playlist = await asyncio.to_thread(Playlist, batch.playlist)
+        except Exception as e:
+            raise HTTPException(
+                status_code=400, detail="Unable to read playlist"
+            ) from e
+        links += playlist.links
+    if not links:
+        raise HTTPException(status_code=400, detail="No songs given")
+    if len(links) > MAX_BATCH:
+        raise HTTPException(
+            status_code=400, detail=f"At most {MAX_BATCH} songs at once"
+        )
 
     try:
-        song_id = download.get_name()
-    except Exception as e:
-        return HTTPException(status_code=502, detail=e)
+        song_ids = await asyncio.to_thread(
+            pipeline.submit_many,
+            links,
+            get_client(request),
+            batch.priority,
+        )
+    except Saturated as e:
+        return saturated_response(e)
 
-    Thread(target=wait_for_download_end, args=(download,)).start()
+    return {"song_ids": song_ids}
 
-    return {"song_id": song_id}
+
+@app.post("/v1/cancel_song/{song_id}")
+async def cancel_song(song_id: str, request: Request):
+    """
+    Tells that client no longer waits for a song, which stops its
+    processing if no other client waits for it
+
+    Returns:
+        json: whether song got cancelled
+    """
+    cancelled = await asyncio.to_thread(
+        pipeline.cancel, song_id, get_client(request)
+    )
+    return {"song_id": song_id, "cancelled": cancelled}
 
 
 @app.get("/v1/songinfo/{song_id}")
@@ -67,92 +571,176 @@ async def get_songinfo(song_id: str):
     Returns:
         json: whether song is ready to be downloaded from the server, expiry date...
     """
-    path = Download.get_download_dir(song_id)
+    return await asyncio.to_thread(get_song_status, song_id)
 
-    if not engine.is_done(path):
-        return {"ready": False}
 
-    with open(os.path.join(path, "metadata.json")) as file:
-        metadata = json.load(file)
+@app.post("/v1/songinfo")
+async def get_songinfo_many(songs: SongIds):
+    """
+    Same as /v1/songinfo/{song_id} for many songs at once
 
-    metadata["ready"] = True
-    return metadata
+    Returns:
+        json: song id -> its info
+    """
+    if len(songs.song_ids) > MAX_BATCH:
+        raise HTTPException(
+            status_code=400, detail=f"At most {MAX_BATCH} songs at once"
+        )
 
+    def get_statuses():
+        return {
+            song_id: get_song_status(song_id)
+            for song_id in songs.song_ids
+        }
 
-@app.get("/v1/song_vocals/{song_id}")
-async def get_song_vocals(song_id: str):
+    return await asyncio.to_thread(get_statuses)
+
+
+@app.get("/v1/songinfo/{song_id}/events")
+async def get_songinfo_events(song_id: str):
     """
     Returns:
-        payload: processed song along with metadata
+        event stream: stage changes and percent of stage done, pushed
+        as they happen until song is done or failed
     """
-    path = os.path.join(
-        DOWNLOADS_PATH, song_id, "htdemucs", "audio", "vocals.mp3"
+    return StreamingResponse(
+        format_events(await watch_song(song_id)),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache"},
     )
-    if not os.path.exists(path):
-        raise HTTPException(
-            status_code=404, detail="Path does not exist"
-        )
 
-    return FileResponse(
-        path=path, filename="audio.mp3", media_type="application/mp3"
+
+@app.websocket("/v1/songinfo/{song_id}/ws")
+async def songinfo_socket(websocket: WebSocket, song_id: str):
+    """
+    Sends the same progress events as /v1/songinfo/{song_id}/events
+    as json messages, then closes the socket
+    """
+    await websocket.accept()
+    try:
+        events = await watch_song(song_id)
+    except HTTPException as e:
+        await websocket.close(code=4404, reason=e.detail)
+        return
+
+    try:
+        async for event in events:
+            if event is not None:
+                await websocket.send_json(event)
+    except WebSocketDisconnect:
+        return
+    await websocket.close()
+
+
+@app.get("/v1/song_vocals/{song_id}")
+async def get_song_vocals(
+    song_id: str,
+    request: Request,
+    format: str = "mp3",
+    bitrate: int = 320,
+):
+    """
+    Args:
+        format (str): mp3, opus or aac
+        bitrate (int): kbps
+
+    Returns:
+        payload: processed song along with metadata
+    """
+    return await encoded_stem(
+        request, song_id, "vocals", format, bitrate
     )
 
 
 @app.get("/v1/song_no_vocals/{song_id}")
-async def get_song_no_vocals(song_id: str):
+async def get_song_no_vocals(
+    song_id: str,
+    request: Request,
+    format: str = "mp3",
+    bitrate: int = 320,
+):
     """
+    Args:
+        format (str): mp3, opus or aac
+        bitrate (int): kbps
+
     Returns:
         payload: processed song along with metadata
     """
-    path = os.path.join(
-        DOWNLOADS_PATH, song_id, "htdemucs", "audio", "no_vocals.mp3"
+    return await encoded_stem(
+        request, song_id, "no_vocals", format, bitrate
     )
-    if not os.path.exists(path):
-        raise HTTPException(
-            status_code=404, detail="Path does not exist"
-        )
 
-    return FileResponse(
-        path=path, filename="audio.mp3", media_type="application/mp3"
-    )
+
+@app.get("/v1/song_vocals/{song_id}/stream")
+async def stream_song_vocals(song_id: str, bitrate: int = 320):
+    """
+    Returns:
+        payload: vocals stem, already separated part is sent right away
+        and the rest as soon as it is separated
+    """
+    return stream_stem(song_id, "vocals", bitrate)
+
+
+@app.get("/v1/song_no_vocals/{song_id}/stream")
+async def stream_song_no_vocals(song_id: str, bitrate: int = 320):
+    """
+    Returns:
+        payload: song without vocals, already separated part is sent
+        right away and the rest as soon as it is separated
+    """
+    return stream_stem(song_id, "no_vocals", bitrate)
 
 
 @app.get("/v1/lyrics/{song_id}")
-async def get_song_lyrics(song_id: str):
+async def get_song_lyrics(song_id: str, request: Request):
     """
     Returns:
         payload: lyrics.srt file
     """
-    path = os.path.join(DOWNLOADS_PATH, song_id, "lyrics.srt")
-    if not os.path.exists(path):
-        raise HTTPException(
-            status_code=404, detail="Lyrics for this song do not exist!"
-        )
-
-    return FileResponse(
-        path=path,
-        filename="lyrics.srt",
-        media_type="application/x-subrip",
+    response = song_file(
+        request,
+        song_id,
+        "lyrics.srt",
+        "application/x-subrip",
+        "Lyrics for this song do not exist!",
     )
+    engine.touch(Download.get_download_dir(song_id))
+    return response
+
+
+@app.get("/v1/stats/lyrics_cache")
+async def get_lyrics_cache_stats():
+    """
+    Returns:
+        json: lyrics cache hits, misses, cached songs and hit rate
+    """
+    return Lyrics.get_cache_stats()
+
+
+@app.get("/v1/stats/prefetch")
+async def get_prefetch_stats():
+    """
+    Returns:
+        json: songs prefetched from search results, how many of them
+        were asked for later, hit rate and prefetches given way to
+        requested songs
+    """
+    return pipeline.get_prefetch_stats()
 
 
 @app.get("/v1/metadata/{song_id}")
-async def get_song_metadata(song_id: str):
+async def get_song_metadata(song_id: str, request: Request):
     """
     Returns:
         payload: song metadata
     """
-    path = os.path.join(DOWNLOADS_PATH, song_id, "metadata.json")
-    if not os.path.exists(path):
-        raise HTTPException(
-            status_code=404,
-            detail="Metadata for this song does not exist!",
-        )
-
-    return FileResponse(
-        path=path,
-        filename="metadata.json",
-        media_type="application/json",
+    return song_file(
+        request,
+        song_id,
+        "metadata.json",
+        "application/json",
+        "Metadata for this song does not exist!",
     )
 
 
@@ -162,6 +750,12 @@ async def search_song(query: str):
     Returns:
         json: Search results from a query
     """
-    search = Search(query)
-    # error handling
-    return search.results
+    # searching blocks for seconds, so it runs in a thread
+    results = await asyncio.wrap_future(searches.submit(query))
+    if PREFETCH_RESULTS:
+        links = [result["url"] for result in results[:PREFETCH_RESULTS]]
+        # response does not wait for prefetch to be queued
+        asyncio.get_running_loop().run_in_executor(
+            None, pipeline.prefetch, links, PREFETCH_LIMIT
+        )
+    return results
@@ -0,0 +1,123 @@
+import contextlib
+import queue
+from typing import Iterator, Optional
+
+import undetected_chromedriver as uc  # type: ignore
+
+USER_AGENT = (
+    "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 "
+    "(KHTML, like Gecko) Chrome/115 Safari/537.36"
+)
+
+
+def create_driver() -> uc.Chrome:
+    options = uc.ChromeOptions()
+    options.add_argument("--headless=new")
+    options.add_argument(
+        "--disable-blink-features=AutomationControlled"
+    )
+    options.add_argument("--no-sandbox")
+    options.add_argument("--disable-gpu")
+    options.add_argument("--disable-dev-shm-usage")
+    options.add_argument(f"user-agent={USER_AGENT}")
+    return uc.Chrome(options=options)
+
+
+class Session:
+    """
+    Long lived browser together with number of lookups it served
+    """
+
+    def __init__(self):
+        self.driver = create_driver()
+        self.uses = 0
+
+    def is_alive(self) -> bool:
+        """
+        Tells if browser still responds
+        """
+        try:
+            self.driver.current_url  # noqa: B018
+        except Exception:
+            return False
+        return True
+
+    def quit(self):
+        with contextlib.suppress(Exception):
+            self.driver.quit()
+
+
+class BrowserPool:
+    """
+    Keeps a few headless browsers running, so lookups do not pay for
+    browser startup and can run in parallel. Browsers are started on
+    first use, checked before every lookup and replaced after
+    max_uses lookups or when they stop responding <br>
+    Usage: <br>
+        - Create pool: p = BrowserPool(size) <br>
+        - Borrow a browser: with p.acquire() as driver: ...
+    """
+
+    def __init__(self, size: int = 2, max_uses: int = 50):
+        """
+        Args:
+            size (int): number of browsers running at once
+            max_uses (int): lookups after which browser is restarted,
+            which keeps its memory use and cookies in check
+        """
+        self.size = size
+        self.max_uses = max_uses
+        # idle sessions and None for every slot without a browser,
+        # most recently used sessions are lent first
+        self.__idle: queue.LifoQueue = queue.LifoQueue()
+        for _ in range(size):
+            self.__idle.put(None)
+
+    @contextlib.contextmanager
+    def acquire(self) -> Iterator[uc.Chrome]:
+        """
+        Lends a healthy browser, waits when all of them are in use.
+        Browser that raised is not returned to the pool
+        """
+        session = self.__take()
+        try:
+            yield session.driver
+        except Exception:
+            self.__discard(session)
+            raise
+        session.uses += 1
+        if session.uses >= self.max_uses:
+            self.__discard(session)
+        else:
+            self.__idle.put(session)
+
+    def close(self):
+        """
+        Quits all idle browsers
+        """
+        sessions = []
+        while not self.__idle.empty():
+            sessions.append(self.__idle.get_nowait())
+        for session in sessions:
+            if session is None:
+                self.__idle.put(None)
+            else:
+                self.__discard(session)
+
+    def __take(self) -> Session:
+        while True:
+            session: Optional[Session] = self.__idle.get()
+            if session is None:
+                try:
+                    return Session()
+                except Exception:
+                    self.__idle.put(None)
+                    raise
+            if session.is_alive():
+                return session
+            print("replacing unresponsive browser")
+            self.__discard(session)
+
+    def __discard(self, session: Session):
+        session.quit()
+        self.__idle.put(None)
@@ -1,21 +1,57 @@
 import json
 import os
+import re
 from concurrent import futures
 from hashlib import sha256
 from multiprocessing import cpu_count
+from typing import Callable, Optional
 
 import yt_dlp  # type: ignore
 
-DOWNLOADS_PATH = "downloads"
-
+from singleflight import SingleFlight
+from ytdl import KEY_FIELD, YoutubeDLPool
 
-def do_nothing():
-    pass
+DOWNLOADS_PATH = "downloads"
+# all the ways a single youtube video can be linked to
+YOUTUBE_LINK = re.compile(
+    r"^(?:https?://)?(?:(?:www|m|music)\.)?"
+    r"(?:youtube(?:-nocookie)?\.com/"
+    r"(?:watch\?(?:.*&)?v=|shorts/|embed/|live/|v/)|youtu\.be/)"
+    r"(?P<id>[\w-]{11})(?![\w-])"
+)
+# extractors are matched against links that are not youtube ones
+_extractors = None
+
+
+def get_extractors() -> list:
+    global _extractors
+    if _extractors is None:
+        _extractors = [
+            ie
+            for ie in yt_dlp.extractor.gen_extractor_classes()
+            if ie.ie_key() != "Generic"
+        ]
+    return _extractors
 
 
 class Download:
     __threads = cpu_count() if cpu_count() >= 2 else cpu_count() + 1
     __executor = futures.ThreadPoolExecutor(__threads)
+    # concurrent requests for the same song share one download
+    __flights = SingleFlight(__executor)
+    # native bestaudio stream is kept as is, separation decodes it
+    # straight to PCM, so there is no lossy intermediate file.
+    # Link to a video inside a playlist shares song id with the video
+    # alone (see get_key), so only the video is downloaded
+    __ytdl = YoutubeDLPool(
+        {
+            "format": "bestaudio/best",
+            "outtmpl": f"{DOWNLOADS_PATH}/%({KEY_FIELD})s/audio.%(ext)s",
+            "quiet": True,
+            "noplaylist": True,
+        },
+        __threads,
+    )
 
     @staticmethod
     def parse_info(info: dict, link: str) -> dict:
@@ -25,51 +61,70 @@ class Download:
             "author": info.get("artist") or info.get("uploader"),
             "album": info.get("album") or "Unknown",
             "release": info.get("release_year")
-            or info.get("upload_date")[:4],
+            or (info.get("upload_date") or "")[:4]
+            or "Unknown",
             "duration": info.get("duration"),
         }
 
-    def __init__(self, link: str):
+    def __init__(
+        self,
+        link: str,
+        on_progress: Optional[Callable[[float], None]] = None,
+    ):
         """
         Starts downloading video given by link and stores
         name of folder with results internally
+
+        Args:
+            link (str): link to the video
+            on_progress (callable): called with percent downloaded
         """
         self.link = link
-        self.__name = sha256(link.encode()).hexdigest()
+        self.__name = Download.get_song_id(link)
         song_dir = f"{DOWNLOADS_PATH}/{self.__name}"
-
-        if os.path.exists(song_dir):
-            self.__worker = self.__executor.submit(do_nothing)
-            return
-
-        os.makedirs(song_dir)
-        song_file = f"{song_dir}/audio.%(ext)s"
+        os.makedirs(song_dir, exist_ok=True)
         metadata_file = f"{song_dir}/metadata.json"
 
-        ytdl_opts = {
-            "format": "bestaudio/best",
-            "extract-audio": True,
-            "outtmpl": song_file,
-            "no-post-overwrites": True,
-            "postprocessors": [
-                {
-                    "key": "FFmpegExtractAudio",
-                    "preferredcodec": "mp3",
-                    "preferredquality": "112k",
-                }
-            ],
-            "quiet": True,
-        }
+        def download(ytdl: yt_dlp.YoutubeDL):
+            info = ytdl.extract_info(link, download=False)
+            data = Download.parse_info(info, link)
+            # renamed into place, so it is never seen half written
+            with open(f"{metadata_file}.part", "w") as output:
+                json.dump(data, output, indent=4)
+            os.replace(f"{metadata_file}.part", metadata_file)
+            # download using already extracted info
+            info[KEY_FIELD] = self.__name
+            ytdl.process_ie_result(info, download=True)
 
         def helper():
-            with yt_dlp.YoutubeDL(ytdl_opts) as ytdl:
-                info = ytdl.extract_info(link, download=False)
-                data = Download.parse_info(info, link)
-                with open(metadata_file, "w") as output:
-                    json.dump(data, output, indent=4)
-                ytdl.download([link])
+            # downloaded before, possibly before restart
+            if Download.has_audio(song_dir):
+                return
+            Download.__ytdl.run(download)
+
+        if on_progress is not None:
+            Download.__ytdl.watch(
+                self.__name,
+                lambda status: Download.report(status, on_progress),
+            )
+        self.__worker = Download.__flights.submit(self.__name, helper)
+        if on_progress is not None:
+            self.__worker.add_done_callback(
+                lambda _: Download.__ytdl.unwatch(self.__name)
+            )
 
-        self.__worker = self.__executor.submit(helper)
+    @staticmethod
+    def report(status: dict, on_progress: Callable[[float], None]):
+        """
+        Passes yt-dlp download progress on as percent
+        """
+        total = status.get("total_bytes") or status.get(
+            "total_bytes_estimate"
+        )
+        if status.get("status") == "finished":
+            on_progress(100)
+        elif total:
+            on_progress(100 * status.get("downloaded_bytes", 0) / total)
 
     def is_ready(self) -> bool:
         """
@@ -92,6 +147,55 @@ class Download:
             raise Exception("Something gone wrong with your download")
         return self.__name
 
+    @staticmethod
+    def get_key(link: str) -> str:
+        """
+        Normalizes link to extractor and video id, so every variant
+        of a link to the same video (short links, timestamps,
+        playlists, mobile site...) gets the same key.
+        Works offline, link itself is the key when nothing matches
+        """
+        link = link.strip()
+        match = YOUTUBE_LINK.match(link)
+        if match:
+            return f"youtube:{match.group('id')}"
+
+        for ie in get_extractors():
+            if not ie.suitable(link):
+                continue
+            video_id = ie.get_temp_id(link)
+            if video_id:
+                return f"{ie.ie_key().lower()}:{video_id}"
+            break
+        return link
+
+    @staticmethod
+    def get_song_id(link: str) -> str:
+        """
+        Returns id of song, same for all links to the same video
+        """
+        return sha256(Download.get_key(link).encode()).hexdigest()
+
+    @staticmethod
+    def get_audio_path(song_dir: str) -> str:
+        """
+        Returns path of downloaded audio in its native container
+        (webm, m4a...) or raises exception if there is none
+        """
+        for name in os.listdir(song_dir):
+            base, ext = os.path.splitext(name)
+            if base == "audio" and ext not in (".part", ".ytdl"):
+                return os.path.join(song_dir, name)
+        raise Exception("Audio for this song is not downloaded")
+
+    @staticmethod
+    def has_audio(song_dir: str) -> bool:
+        try:
+            Download.get_audio_path(song_dir)
+        except Exception:
+            return False
+        return True
+
     @staticmethod
     def get_download_dir(str) -> str:
         """
@@ -0,0 +1,192 @@
+import contextlib
+import glob
+import os
+import subprocess
+from threading import Lock
+
+import lameenc  # type: ignore
+
+from download import DOWNLOADS_PATH
+from separator import read_wav_header
+
+# format -> (file extension, ffmpeg codec arguments, media type)
+FORMATS = {
+    "mp3": ("mp3", ["-c:a", "libmp3lame"], "application/mp3"),
+    "opus": ("opus", ["-c:a", "libopus"], "audio/ogg"),
+    "aac": (
+        "m4a",
+        ["-c:a", "aac", "-movflags", "+faststart"],
+        "audio/mp4",
+    ),
+}
+BITRATES = (64, 96, 128, 192, 256, 320)
+VARIANTS_DIR = "variants"
+
+
+class StemEncoder:
+    """
+    Encodes lossless stems to formats requested by clients on first
+    request and keeps encoded variants on disk under a size budget <br>
+    Usage: <br>
+        - Create encoder: e = StemEncoder(budget) <br>
+        - Get path of encoded stem via e.get()
+    """
+
+    def __init__(self, budget: int = 2 * 1024**3):
+        """
+        Args:
+            budget (int): bytes all cached variants can take together
+        """
+        self.budget = budget
+        self.__lock = Lock()
+        self.__encoding: dict[str, Lock] = {}
+
+    def get(self, stem_path: str, format: str, bitrate: int) -> str:
+        """
+        Returns path of stem encoded to given format and bitrate,
+        encodes it first if there is no such variant yet
+
+        Raises:
+            ValueError: format or bitrate is not supported
+        """
+        if format not in FORMATS:
+            raise ValueError(f"Unsupported format: {format}")
+        if bitrate not in BITRATES:
+            raise ValueError(f"Unsupported bitrate: {bitrate}")
+
+        path = StemEncoder.get_variant_path(stem_path, format, bitrate)
+        # concurrent requests for the same variant encode it once
+        with self.__lock:
+            lock = self.__encoding.setdefault(path, Lock())
+        try:
+            with lock:
+                if os.path.exists(path):
+                    # mark as recently used, eviction goes by mtime
+                    os.utime(path)
+                    return path
+                self.__encode(stem_path, path, format, bitrate)
+        finally:
+            # also when encoding failed, so locks do not pile up
+            with self.__lock:
+                self.__encoding.pop(path, None)
+
+        self.__evict(keep=path)
+        return path
+
+    def __encode(
+        self, stem_path: str, path: str, format: str, bitrate: int
+    ):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        ext, codec, _ = FORMATS[format]
+        base, _ = os.path.splitext(path)
+        part = f"{base}.part.{ext}"
+        subprocess.run(
+            [
+                "ffmpeg",
+                "-v",
+                "error",
+                "-y",
+                "-i",
+                stem_path,
+                *codec,
+                "-b:a",
+                f"{bitrate}k",
+                # evicted variant encoded again is byte for byte the
+                # same (no random ogg serial, no encoder tags), so it
+                # keeps its strong ETag and ranges of both match
+                "-fflags",
+                "+bitexact",
+                "-flags:a",
+                "+bitexact",
+                part,
+            ],
+            check=True,
+        )
+        os.replace(part, path)
+
+    def __evict(self, keep: str) -> int:
+        """
+        Deletes least recently used variants over budget
+
+        Returns:
+            int: Number of deleted variants
+        """
+        pattern = os.path.join(
+            DOWNLOADS_PATH, "*", "**", VARIANTS_DIR, "*"
+        )
+        variants = []
+        for path in glob.glob(pattern, recursive=True):
+            if ".part." in path:
+                continue
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            variants.append((stat.st_mtime, stat.st_size, path))
+
+        total = sum(size for _, size, _ in variants)
+        deleted = 0
+        for _, size, path in sorted(variants):
+            if total <= self.budget:
+                break
+            if path == keep:
+                continue
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(path)
+            total -= size
+            deleted += 1
+        return deleted
+
+    @staticmethod
+    def get_variant_path(
+        stem_path: str, format: str, bitrate: int
+    ) -> str:
+        """
+        Returns path of cached variant of a stem
+        """
+        stem_dir, name = os.path.split(stem_path)
+        stem, _ = os.path.splitext(name)
+        ext = FORMATS[format][0]
+        return os.path.join(
+            stem_dir, VARIANTS_DIR, f"{stem}.{bitrate}k.{ext}"
+        )
+
+    @staticmethod
+    def get_media_type(format: str) -> str:
+        return FORMATS[format][2]
+
+
+class Mp3StreamEncoder:
+    """
+    Encodes wav stem to mp3 on the fly, piece by piece, as it is
+    read while separation is still writing it
+    """
+
+    def __init__(self, header: bytes, bitrate: int):
+        """
+        Args:
+            header (bytes): wav header of the stem
+            bitrate (int): mp3 bitrate in kbps
+        """
+        samplerate, channels = read_wav_header(header)
+        self.__block = channels * 2
+        self.__rest = b""
+        self.__encoder = lameenc.Encoder()
+        self.__encoder.set_bit_rate(bitrate)
+        self.__encoder.set_in_sample_rate(samplerate)
+        self.__encoder.set_channels(channels)
+        self.__encoder.set_quality(5)
+        self.__encoder.silence()
+
+    def encode(self, data: bytes) -> bytes:
+        """
+        Encodes next piece of PCM data, incomplete sample frame
+        at the end is kept for the next piece
+        """
+        data = self.__rest + data
+        whole = len(data) - len(data) % self.__block
+        self.__rest = data[whole:]
+        return bytes(self.__encoder.encode(data[:whole]))
+
+    def flush(self) -> bytes:
+        return bytes(self.__encoder.flush())
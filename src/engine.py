@@ -1,12 +1,40 @@
+import contextlib
+import json
 import os
 import shutil
-import time
 from concurrent import futures
-from typing import Union
-
-import demucs.separate
+from multiprocessing import cpu_count
+from threading import Lock
+from typing import Callable, Optional, Union
 
+import fingerprint
 from download import DOWNLOADS_PATH, Download
+from separator import (
+    CANCEL_FILE,
+    STEM,
+    Cancelled,
+    Separator,
+    SeparatorPool,
+    get_devices,
+)
+from store import Reaper, Store
+
+
+def link_file(source: str, destination: str):
+    """
+    Hard links file, copies it if linking is not possible
+
+    Raises:
+        FileExistsError: destination exists, it is never replaced
+    """
+    os.makedirs(os.path.dirname(destination), exist_ok=True)
+    try:
+        os.link(source, destination)
+    except FileExistsError:
+        raise
+    except OSError:
+        with open(source, "rb") as src, open(destination, "xb") as dst:
+            shutil.copyfileobj(src, dst)
 
 
 class Task:
@@ -14,11 +42,18 @@ class Task:
     Class representing a single task
     """
 
-    __threads = 1
+    # tasks mostly wait for downloads and separation workers,
+    # real limit of parallel separations is size of separator pool
+    __threads = cpu_count()
     __executor = futures.ThreadPoolExecutor(__threads)
-    EXPIRATION_TIME = 600
+    # songs at least this long (in seconds) are separated in bounded
+    # memory segments instead of being decoded whole, segments are
+    # also what lets clients play stems before separation ends
+    STREAMING_MIN_DURATION = 0
 
-    def __init__(self, item):
+    def __init__(self, item, separator: SeparatorPool, store: Store):
+        self.__separator = separator
+        self.__store = store
         if type(item) is str:
             self.__item = None
             self.__path = item
@@ -26,38 +61,135 @@ class Task:
             self.__item = item
             self.__path = Task.get_path(item)
         self.__worker = Task.__executor.submit(self.__process_wrapper)
-        # for this to not be undefined
-        # proper expiration time will be counted since end of processing
-        self.__expiration_time = -Task.EXPIRATION_TIME
 
     def __process_wrapper(self):
         """
         Processes a single song inside queue
         """
-        if os.path.exists(
-            os.path.join(self.__path, "htdemucs/audio/vocals.mp3")
-        ):
+        try:
+            self.__process()
+        finally:
+            # cancel that came after separation is over
+            if Separator.is_cancelled(self.__path):
+                os.remove(os.path.join(self.__path, CANCEL_FILE))
+
+    def __process(self):
+        song_id = os.path.basename(self.__path)
+        self.__store.add(song_id)
+        if os.path.exists(Separator.get_stem_path(self.__path, STEM)):
+            self.__store.set_done(song_id)
             return
         if self.__item is not None:
             self.__item.wait_for()
 
-        demucs.separate.main(
-            [
-                "--mp3",
-                "--two-stems",
-                "vocals",
-                "-o",
-                self.__path,
-                os.path.join(self.__path, "audio.mp3"),
-            ]
-        )
-        self.__expiration_time = time.time()
+        audio = Download.get_audio_path(self.__path)
+        duration = Task.get_duration(self.__path)
+        # song fingerprinted after its download found no match then
+        tried = self.__store.has_fingerprint(song_id)
+        if not tried and Task.reuse_stems(self.__path, self.__store):
+            self.__store.set_done(song_id)
+            return
+
+        if Separator.is_cancelled(self.__path):
+            raise Cancelled(f"Separation of {self.__path} cancelled")
+        if duration is None or duration >= Task.STREAMING_MIN_DURATION:
+            self.__separator.separate_stream(
+                audio, self.__path, duration
+            )
+        else:
+            self.__separator.separate(audio, self.__path)
+        self.__store.set_done(song_id)
+
+    @staticmethod
+    def reuse_stems(path: str, store: Store) -> bool:
+        """
+        Fingerprints downloaded audio and links stems and lyrics of
+        already separated song that sounds the same (other upload of
+        the same track), so separation can be skipped
+
+        Returns:
+            bool: Were stems of another song reused
+        """
+        song_id = os.path.basename(path)
+        duration = Task.get_duration(path)
+        if duration is None:
+            return False
+        try:
+            fp = fingerprint.compute_file(Download.get_audio_path(path))
+            store.add_fingerprint(song_id, duration, fp.tobytes())
+            match = fingerprint.find_match(
+                fp,
+                store.find_fingerprints(
+                    song_id, duration, fingerprint.DURATION_TOLERANCE
+                ),
+            )
+        except Exception as e:
+            print(f"fingerprint: {e!s}")
+            return False
+        if match is None:
+            return False
+
+        source = Download.get_download_dir(match)
+        linked = []
+        try:
+            for stem in (STEM, f"no_{STEM}"):
+                destination = Separator.get_stem_path(path, stem)
+                link_file(
+                    Separator.get_stem_path(source, stem), destination
+                )
+                # only files made here are removed when reuse fails
+                linked.append(destination)
+            lyrics = os.path.join(path, "lyrics.srt")
+            # lyrics song already has are kept
+            if os.path.exists(
+                os.path.join(source, "lyrics.srt")
+            ) and not os.path.exists(lyrics):
+                link_file(os.path.join(source, "lyrics.srt"), lyrics)
+                linked.append(lyrics)
+        except Exception as e:
+            # other song got evicted in the meantime, or song got
+            # its own stems
+            print(f"unable to reuse stems of {match}: {e!s}")
+            for destination in linked:
+                with contextlib.suppress(FileNotFoundError):
+                    os.remove(destination)
+            return False
+
+        print(f"reusing stems of {match} for {song_id}")
+        return True
+
+    @staticmethod
+    def get_duration(path: str) -> Optional[float]:
+        """
+        Reads song duration saved by download, None if unknown
+        """
+        try:
+            with open(os.path.join(path, "metadata.json")) as file:
+                return json.load(file).get("duration")
+        except Exception:
+            return None
 
     def is_done(self) -> bool:
         """
-        Tells if processing is done
+        Tells if processing is done, not failed or cancelled
+        """
+        return (
+            self.__worker.done() and self.__worker.exception() is None
+        )
+
+    def is_running(self) -> bool:
+        """
+        Tells if processing is not over yet
         """
-        return self.__worker.done()
+        return not self.__worker.done()
+
+    def is_cancelled(self) -> bool:
+        """
+        Tells if separation was stopped by Engine.cancel
+        """
+        return self.__worker.done() and isinstance(
+            self.__worker.exception(), Cancelled
+        )
 
     def wait_for(self):
         """
@@ -65,20 +197,11 @@ class Task:
         """
         self.__worker.result()
 
-    def cleanup(self) -> bool:
+    def add_done_callback(self, callback: Callable[[], None]):
         """
-        Deletes directories and songs when they expire
+        Calls callback once task is over
         """
-        if not self.is_done():
-            return False
-        if self.__expiration_time <= time.time():
-            print(self.__path)
-            try:
-                shutil.rmtree(self.__path)
-                return True
-            except:
-                return False
-        return False
+        self.__worker.add_done_callback(lambda _: callback())
 
     @staticmethod
     def get_path(item: Union[str, Download]) -> str:
@@ -105,15 +228,62 @@ class Engine:
         - Enqueue songs on demand via e.enqueue()
     """
 
-    def __init__(self, clean_on_startup: bool = True):
+    def __init__(
+        self,
+        clean_on_startup: bool = False,
+        warmup: bool = False,
+        workers: Union[int, str] = 1,
+        threads: Optional[int] = None,
+        streaming_min_duration: Optional[float] = None,
+        disk_budget: int = 10 * 1024**3,
+        max_idle: Optional[float] = None,
+        is_active: Optional[Callable[[str], bool]] = None,
+        device: Optional[str] = None,
+    ):
         """
         Holds a collection of tasks left to complete, completed ones,
         and processes them whenever possible.
+        Separation models are loaded once per worker process and reused
+        by every task, warmup runs them once before first song comes in.
+
+        Args:
+            workers (int|str): number of separation processes or "auto"
+            to pick workers x threads split that separates fastest
+            threads (int): torch threads per separation process
+            streaming_min_duration (float): seconds from which songs
+            are separated in bounded memory segments
+            disk_budget (int): bytes songs can take before least
+            recently used ones are evicted
+            max_idle (float): seconds after which not accessed song
+            is evicted even when within budget
+            is_active (callable): tells if song is being processed by
+            any worker, so its download is not removed on startup
+            device (str): cpu, cuda or cuda:N separation runs on,
+            every GPU when available by default
         """
+        # tasks are added from request handlers and pipeline threads
+        # and dropped by reaper, lock makes every song single-flight
+        self.__lock = Lock()
         self.__tasks: dict[str, Task] = {}
+        if streaming_min_duration is not None:
+            Task.STREAMING_MIN_DURATION = streaming_min_duration
+
+        if workers == "auto":
+            devices = get_devices(device)
+            if devices[0].startswith("cuda"):
+                # GPU separates one song at a time the fastest
+                workers = len(devices)
+            else:
+                workers, threads = SeparatorPool.autotune()
+        self.__separator = SeparatorPool(
+            int(workers), threads, warmup, device
+        )
 
         if clean_on_startup:
             shutil.rmtree(DOWNLOADS_PATH, True)
+        # songs processed before restart are kept and validated
+        self.__store = Store(disk_budget, is_active=is_active)
+        self.__reaper = Reaper(self.__store, self.__forget, max_idle)
 
     def enqueue(self, item: Union[str, Download]):
         """
@@ -127,37 +297,91 @@ class Engine:
             bool: Was enqueueing successfull
         """
         path = Task.get_path(item)
-        if path in self.__tasks:
-            return
+        self.touch(path)
+        with self.__lock:
+            task = self.__tasks.get(path)
+            if task is not None and not task.is_cancelled():
+                return
+            task = Task(item, self.__separator, self.__store)
+            self.__tasks[path] = task
+        # idle time is counted since the end of processing
+        task.add_done_callback(lambda: self.touch(path))
 
-        self.__tasks[path] = Task(item)
-        self.__cleanup_expired()
+    def reuse_stems(self, path: str) -> bool:
+        """
+        Looks for already separated song that sounds the same as
+        downloaded one and links its stems, so song is done without
+        waiting for a separation worker. Does blocking disk reads
+
+        Returns:
+            bool: Were stems of another song linked, False also for
+            songs separated or fingerprinted before
+        """
+        song_id = os.path.basename(path)
+        # never link over stems the song has, or other songs link to
+        if os.path.exists(Separator.get_stem_path(path, STEM)):
+            return False
+        if self.__store.has_fingerprint(song_id):
+            return False
+        self.__store.add(song_id)
+        if not Task.reuse_stems(path, self.__store):
+            return False
+        self.__store.set_done(song_id)
+        return True
+
+    def get_workers(self) -> int:
+        """
+        Returns number of songs that can be separated at once
+        """
+        return self.__separator.workers
 
     def is_done(self, path: str) -> bool:
         """
-        Tells if song is ready to be downloaded
+        Tells if song is ready to be downloaded, which it is not
+        when its processing failed or got cancelled
         """
-        return path in self.__tasks and self.__tasks[path].is_done()
+        with self.__lock:
+            task = self.__tasks.get(path)
+        if task is not None:
+            return task.is_done()
+        return self.__store.is_done(os.path.basename(path))
 
-    def wait_for(self, path: str):
+    def is_running(self, path: str) -> bool:
         """
-        Awaits for end of processing
+        Tells if song is still being processed
         """
-        self.__tasks[path].wait_for()
+        with self.__lock:
+            task = self.__tasks.get(path)
+        return task is not None and task.is_running()
 
-    def __cleanup_expired(self) -> int:
+    def touch(self, path: str):
         """
-        Deletes songs that have expired to save space
+        Marks song as recently used, so it stays on disk longer
+        """
+        self.__reaper.touch(os.path.basename(path))
 
-        Returns:
-            int: Number of deleted songs
+    def wait_for(self, path: str):
+        """
+        Awaits for end of processing
         """
-        to_delete = []
-        for path, task in self.__tasks.items():
-            if task.cleanup():
-                to_delete.append(path)
+        with self.__lock:
+            task = self.__tasks[path]
+        task.wait_for()
 
-        for path in to_delete:
-            self.__tasks.pop(path)
+    def cancel(self, path: str):
+        """
+        Stops separation of a song after segment being separated,
+        song is processed again when enqueued after that
+        """
+        with self.__lock:
+            task = self.__tasks.get(path)
+        if task is not None and task.is_running():
+            Separator.cancel(path)
 
-        return len(to_delete)
+    def __forget(self, song_id: str):
+        """
+        Drops task of a song evicted by reaper,
+        so it gets processed again when requested
+        """
+        with self.__lock:
+            self.__tasks.pop(Download.get_download_dir(song_id), None)
@@ -0,0 +1,135 @@
+import subprocess
+from typing import Iterable, Optional, Tuple
+
+import numpy as np
+
+# audio is reduced to what is needed to tell songs apart
+SAMPLERATE = 5512
+FRAME = 4096
+HOP = 256
+# only beginning of the song is fingerprinted, which is enough to
+# tell apart different songs and keeps fingerprints small
+MAX_SECONDS = 120
+# 33 bands give 32 differences, one bit each
+BANDS = np.geomspace(300, 2000, 33)
+# uploads may have different intros, so fingerprints are compared
+# shifted by up to this many frames (~10s)
+MAX_OFFSET = 220
+# uploads of the same song differing in length more than this
+# (in seconds) are not compared at all
+DURATION_TOLERANCE = 10.0
+# fraction of differing bits below which songs are the same
+MATCH_THRESHOLD = 0.35
+# frames that need to overlap for comparison to be meaningful
+MIN_OVERLAP = 200
+BATCH = 256
+
+
+def decode(path: str, seconds: float = MAX_SECONDS) -> np.ndarray:
+    """
+    Decodes beginning of audio file to mono float samples
+    """
+    output = subprocess.run(
+        [
+            "ffmpeg",
+            "-v",
+            "error",
+            "-i",
+            path,
+            "-t",
+            str(seconds),
+            "-ac",
+            "1",
+            "-ar",
+            str(SAMPLERATE),
+            "-f",
+            "s16le",
+            "-",
+        ],
+        check=True,
+        capture_output=True,
+    ).stdout
+    return np.frombuffer(output, dtype=np.int16) / 2**15
+
+
+def compute(samples: np.ndarray) -> np.ndarray:
+    """
+    Computes fingerprint of mono audio sampled at SAMPLERATE.
+    Every frame gets 32 bits telling whether energy difference of
+    neighbouring bands grew or dropped since previous frame, which
+    survives re-encoding, volume changes and small eq differences
+
+    Returns:
+        np.ndarray: one uint32 per frame
+    """
+    if len(samples) < FRAME + HOP:
+        return np.zeros(0, dtype=np.uint32)
+
+    count = 1 + (len(samples) - FRAME) // HOP
+    window = np.hanning(FRAME)
+    freqs = np.fft.rfftfreq(FRAME, 1 / SAMPLERATE)
+    band = np.digitize(freqs, BANDS) - 1
+    valid = (band >= 0) & (band < len(BANDS) - 1)
+
+    energy = np.zeros((count, len(BANDS) - 1))
+    # frames are analysed in batches to keep memory use low
+    for start in range(0, count, BATCH):
+        frames = np.arange(start, min(count, start + BATCH))
+        index = np.arange(FRAME)[None, :] + HOP * frames[:, None]
+        spectrum = np.abs(np.fft.rfft(samples[index] * window)) ** 2
+        batch = np.zeros((len(frames), len(BANDS) - 1))
+        np.add.at(batch.T, band[valid], spectrum[:, valid].T)
+        energy[frames] = batch
+
+    diff = energy[:, :-1] - energy[:, 1:]
+    bits = (diff[1:] - diff[:-1]) > 0
+    weights = 1 << np.arange(bits.shape[1], dtype=np.uint64)
+    return (bits * weights).sum(axis=1).astype(np.uint32)
+
+
+def compute_file(path: str) -> np.ndarray:
+    """
+    Computes fingerprint of beginning of audio file
+    """
+    return compute(decode(path))
+
+
+def distance(a: np.ndarray, b: np.ndarray) -> float:
+    """
+    Returns lowest fraction of differing bits between fingerprints
+    over all allowed shifts of one against the other, 1 if they do
+    not overlap enough to be compared
+    """
+    best = 1.0
+    for offset in range(-MAX_OFFSET, MAX_OFFSET + 1):
+        x = a[max(0, offset) :]
+        y = b[max(0, -offset) :]
+        size = min(len(x), len(y))
+        if size < MIN_OVERLAP:
+            continue
+        xor = np.bitwise_xor(x[:size], y[:size])
+        bits = np.unpackbits(xor.view(np.uint8)).sum()
+        best = min(best, bits / (size * 32))
+    return best
+
+
+def find_match(
+    fingerprint: np.ndarray, candidates: Iterable[Tuple[str, bytes]]
+) -> Optional[str]:
+    """
+    Finds song that sounds the same as fingerprinted one
+
+    Args:
+        fingerprint (np.ndarray): fingerprint of new song
+        candidates (iterable): (song id, fingerprint bytes) pairs
+
+    Returns:
+        str: id of the closest matching song, None if no song matches
+    """
+    best, best_distance = None, MATCH_THRESHOLD
+    for song_id, data in candidates:
+        other = np.frombuffer(data, dtype=np.uint32)
+        current = distance(fingerprint, other)
+        if current < best_distance:
+            best, best_distance = song_id, current
+    return best
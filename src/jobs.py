@@ -0,0 +1,441 @@
+import contextlib
+import os
+import socket
+import sqlite3
+import time
+import uuid
+from abc import ABC, abstractmethod
+from threading import Lock
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from download import DOWNLOADS_PATH
+
+JOBS_FILE = "jobs.db"
+# seconds a worker owns a job without renewing its lease, a job of
+# a worker that died is picked up by another one after that
+LEASE_SECONDS = 60.0
+# states of songs no worker has to do anything about
+FINISHED = ("done", "failed", "cancelled")
+
+
+def get_owner() -> str:
+    """
+    Returns id of this worker process, unique across machines
+    """
+    return (
+        f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+    )
+
+
+class JobStore(ABC):
+    """
+    State and queue of songs being processed, shared by all API and
+    compute workers, so each song is processed by exactly one of them.
+    Workers own jobs under leases they have to keep renewing <br>
+    Usage: <br>
+        - Open store: s = open_job_store() <br>
+        - Queue songs via s.enqueue(), take them via s.claim() <br>
+        - Report progress via s.renew() and s.finish()
+    """
+
+    @abstractmethod
+    def enqueue(
+        self,
+        song_id: str,
+        link: str,
+        client: str = "",
+        priority: int = 0,
+    ) -> bool:
+        """
+        Queues song unless it is already queued or being processed,
+        either way client is recorded as waiting for it
+
+        Args:
+            song_id (str): song id
+            link (str): link song is downloaded from
+            client (str): id of client asking for the song
+            priority (int): songs with higher priority are taken
+            first, song queued again gets the highest one asked for
+
+        Returns:
+            bool: Was song queued
+        """
+
+    def enqueue_many(
+        self,
+        songs: List[Tuple[str, str]],
+        client: str = "",
+        priority: int = 0,
+    ) -> List[bool]:
+        """
+        Same as enqueue for list of (song id, link), songs are taken
+        in the order they are given
+
+        Returns:
+            list: Was song queued, for every song
+        """
+        return [
+            self.enqueue(song_id, link, client, priority)
+            for song_id, link in songs
+        ]
+
+    @abstractmethod
+    def claim(
+        self, owner: str, lease: float = LEASE_SECONDS
+    ) -> Optional[Tuple[str, str, str, int]]:
+        """
+        Takes queued song, or song of a worker whose lease expired,
+        with the highest priority, then of the client with the fewest
+        songs being processed, then the oldest one
+
+        Returns:
+            tuple: (song id, link, client, priority), None if there
+            is nothing to do
+        """
+
+    @abstractmethod
+    def renew(
+        self,
+        owner: str,
+        stages: Dict[str, str],
+        lease: float = LEASE_SECONDS,
+    ):
+        """
+        Extends leases of songs owned by worker and saves their stages
+
+        Args:
+            owner (str): id of the worker
+            stages (dict): song id -> stage
+            lease (float): seconds leases are extended by
+
+        Returns:
+            list: ids of songs worker no longer owns, because they
+            were cancelled or taken over by another worker
+        """
+
+    @abstractmethod
+    def finish(self, song_id: str, owner: str, failed: bool = False):
+        """
+        Marks song owned by worker as processed
+        """
+
+    @abstractmethod
+    def cancel(self, song_id: str, client: str = "") -> bool:
+        """
+        Stops client waiting for a song, song is cancelled when no
+        other client waits for it
+
+        Returns:
+            bool: Was song cancelled
+        """
+
+    @abstractmethod
+    def get_stage(self, song_id: str) -> Optional[str]:
+        """
+        Returns stage of song queued or being processed by any worker,
+        None if it is neither
+        """
+
+    @abstractmethod
+    def get_waiters(self, song_id: str) -> List[str]:
+        """
+        Returns clients waiting for a song queued or being processed
+        """
+
+    @abstractmethod
+    def is_leased(self, song_id: str) -> bool:
+        """
+        Tells if song is being processed by a worker that is alive,
+        so files it is writing must be left alone
+        """
+
+    @abstractmethod
+    def count_queued(
+        self, client: Optional[str] = None, running: bool = False
+    ) -> int:
+        """
+        Returns number of songs no worker took yet, only of given
+        client if there is one
+
+        Args:
+            client (str): client songs were queued by
+            running (bool): count songs being processed too
+        """
+
+
+class SqliteJobStore(JobStore):
+    """
+    Job store in an SQLite database in WAL mode, shared by workers
+    on one machine, or on machines sharing downloads directory
+    """
+
+    def __init__(
+        self, path: str = os.path.join(DOWNLOADS_PATH, JOBS_FILE)
+    ):
+        """
+        Args:
+            path (str): database file
+        """
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.__lock = Lock()
+        # transactions are opened explicitly, see __transaction
+        self.__db = sqlite3.connect(
+            path,
+            timeout=30,
+            isolation_level=None,
+            check_same_thread=False,
+        )
+        self.__db.execute("PRAGMA journal_mode=WAL")
+        self.__db.execute(
+            """
+            CREATE TABLE IF NOT EXISTS jobs (
+                song_id TEXT PRIMARY KEY,
+                link TEXT NOT NULL,
+                state TEXT NOT NULL,
+                stage TEXT NOT NULL,
+                client TEXT NOT NULL DEFAULT '',
+                priority INTEGER NOT NULL DEFAULT 0,
+                owner TEXT,
+                lease_until REAL NOT NULL DEFAULT 0,
+                created REAL NOT NULL
+            )
+            """
+        )
+        self.__db.execute(
+            "CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state, created)"
+        )
+        self.__db.execute(
+            """
+            CREATE TABLE IF NOT EXISTS waiters (
+                song_id TEXT NOT NULL,
+                client TEXT NOT NULL,
+                PRIMARY KEY (song_id, client)
+            )
+            """
+        )
+
+    def enqueue(
+        self,
+        song_id: str,
+        link: str,
+        client: str = "",
+        priority: int = 0,
+    ) -> bool:
+        return self.enqueue_many([(song_id, link)], client, priority)[0]
+
+    def enqueue_many(
+        self,
+        songs: List[Tuple[str, str]],
+        client: str = "",
+        priority: int = 0,
+    ) -> List[bool]:
+        now = time.time()
+        queued = []
+        with self.__transaction():
+            for index, (song_id, link) in enumerate(songs):
+                self.__db.execute(
+                    "INSERT OR IGNORE INTO waiters VALUES (?, ?)",
+                    (song_id, client),
+                )
+                row = self.__db.execute(
+                    "SELECT state FROM jobs WHERE song_id = ?",
+                    (song_id,),
+                ).fetchone()
+                if row is not None and row[0] not in FINISHED:
+                    self.__db.execute(
+                        """
+                        UPDATE jobs SET priority = MAX(priority, ?)
+                        WHERE song_id = ?
+                        """,
+                        (priority, song_id),
+                    )
+                    queued.append(False)
+                    continue
+                # songs of a batch are taken in order they were given
+                self.__db.execute(
+                    """
+                    INSERT OR REPLACE INTO jobs
+                    (song_id, link, state, stage, client, priority, created)
+                    VALUES (?, ?, 'queued', 'queued', ?, ?, ?)
+                    """,
+                    (
+                        song_id,
+                        link,
+                        client,
+                        priority,
+                        now + index * 1e-6,
+                    ),
+                )
+                queued.append(True)
+        return queued
+
+    def claim(
+        self, owner: str, lease: float = LEASE_SECONDS
+    ) -> Optional[Tuple[str, str, str, int]]:
+        now = time.time()
+        with self.__transaction():
+            row = self.__db.execute(
+                """
+                SELECT song_id, link, client, priority FROM jobs AS j
+                WHERE state = 'queued'
+                OR (state = 'running' AND lease_until < :now)
+                ORDER BY priority DESC, (
+                    SELECT COUNT(*) FROM jobs
+                    WHERE client = j.client AND state = 'running'
+                    AND lease_until >= :now
+                ), created
+                LIMIT 1
+                """,
+                {"now": now},
+            ).fetchone()
+            if row is not None:
+                self.__db.execute(
+                    """
+                    UPDATE jobs SET state = 'running', stage = 'queued',
+                        owner = ?, lease_until = ?
+                    WHERE song_id = ?
+                    """,
+                    (owner, now + lease, row[0]),
+                )
+        return None if row is None else tuple(row)
+
+    def renew(
+        self,
+        owner: str,
+        stages: Dict[str, str],
+        lease: float = LEASE_SECONDS,
+    ) -> List[str]:
+        until = time.time() + lease
+        lost = []
+        with self.__transaction():
+            for song_id, stage in stages.items():
+                cursor = self.__db.execute(
+                    """
+                    UPDATE jobs SET stage = ?, lease_until = ?
+                    WHERE song_id = ? AND owner = ? AND state = 'running'
+                    """,
+                    (stage, until, song_id, owner),
+                )
+                if cursor.rowcount == 0:
+                    lost.append(song_id)
+        return lost
+
+    def finish(self, song_id: str, owner: str, failed: bool = False):
+        state = "failed" if failed else "done"
+        with self.__transaction():
+            cursor = self.__db.execute(
+                """
+                UPDATE jobs SET state = ?, stage = ?, lease_until = 0
+                WHERE song_id = ? AND owner = ? AND state = 'running'
+                """,
+                (state, state, song_id, owner),
+            )
+            if cursor.rowcount:
+                self.__db.execute(
+                    "DELETE FROM waiters WHERE song_id = ?", (song_id,)
+                )
+
+    def cancel(self, song_id: str, client: str = "") -> bool:
+        with self.__transaction():
+            self.__db.execute(
+                "DELETE FROM waiters WHERE song_id = ? AND client = ?",
+                (song_id, client),
+            )
+            waiting = self.__db.execute(
+                "SELECT COUNT(*) FROM waiters WHERE song_id = ?",
+                (song_id,),
+            ).fetchone()[0]
+            if waiting:
+                return False
+            cursor = self.__db.execute(
+                """
+                UPDATE jobs SET state = 'cancelled', stage = 'cancelled',
+                    lease_until = 0
+                WHERE song_id = ? AND state IN ('queued', 'running')
+                """,
+                (song_id,),
+            )
+        return cursor.rowcount > 0
+
+    def get_stage(self, song_id: str) -> Optional[str]:
+        with self.__lock:
+            row = self.__db.execute(
+                """
+                SELECT state, stage, lease_until FROM jobs
+                WHERE song_id = ?
+                """,
+                (song_id,),
+            ).fetchone()
+        if row is None or row[0] in FINISHED:
+            return None
+        state, stage, lease_until = row
+        # worker died, song waits for another one
+        if state == "running" and lease_until < time.time():
+            return "queued"
+        return stage
+
+    def get_waiters(self, song_id: str) -> List[str]:
+        with self.__lock:
+            return [
+                row[0]
+                for row in self.__db.execute(
+                    "SELECT client FROM waiters WHERE song_id = ?",
+                    (song_id,),
+                )
+            ]
+
+    def is_leased(self, song_id: str) -> bool:
+        with self.__lock:
+            row = self.__db.execute(
+                """
+                SELECT 1 FROM jobs WHERE song_id = ?
+                AND state = 'running' AND lease_until >= ?
+                """,
+                (song_id, time.time()),
+            ).fetchone()
+        return row is not None
+
+    def count_queued(
+        self, client: Optional[str] = None, running: bool = False
+    ) -> int:
+        query = "SELECT COUNT(*) FROM jobs WHERE (state = 'queued'"
+        args: list = []
+        if running:
+            query += " OR (state = 'running' AND lease_until >= ?)"
+            args.append(time.time())
+        query += ")"
+        if client is not None:
+            query += " AND client = ?"
+            args.append(client)
+        with self.__lock:
+            return self.__db.execute(query, args).fetchone()[0]
+
+    @contextlib.contextmanager
+    def __transaction(self) -> Iterator[None]:
+        """
+        Runs statements atomically, holding database write lock from
+        the start, so two workers never claim the same song
+        """
+        with self.__lock:
+            self.__db.execute("BEGIN IMMEDIATE")
+            try:
+                yield
+            except BaseException:
+                self.__db.execute("ROLLBACK")
+                raise
+            self.__db.execute("COMMIT")
+
+
+def open_job_store(url: str = "") -> JobStore:
+    """
+    Opens job store given by url, e.g. sqlite:///shared/jobs.db,
+    default one in downloads directory if url is empty
+
+    Raises:
+        ValueError: store type is not supported
+    """
+    if not url:
+        return SqliteJobStore()
+    if url.startswith("sqlite://"):
+        return SqliteJobStore(url[len("sqlite://") :])
+    raise ValueError(f"Unsupported job store: {url}")
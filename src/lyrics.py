@@ -1,18 +1,27 @@
 import os
 import re
-import time
 from concurrent import futures
+from threading import Event
+from typing import Optional
 
 import lyricsgenius  # type: ignore
 import requests  # type: ignore
-import undetected_chromedriver as uc  # type: ignore
-from aeneas.executetask import ExecuteTask  # type: ignore
-from aeneas.task import Task  # type: ignore
 from bs4 import BeautifulSoup
 from dotenv import load_dotenv
 from langdetect import detect  # type: ignore
+from selenium.common.exceptions import TimeoutException
 from selenium.webdriver.common.by import By
 from selenium.webdriver.common.keys import Keys
+from selenium.webdriver.support import expected_conditions
+from selenium.webdriver.support.ui import WebDriverWait
+
+from aligner import AlignerPool, Fragments
+from browser import BrowserPool
+from lyrics_cache import LyricsCache
+from separator import Separator
+
+# seconds browser waits for page elements to show up
+PAGE_TIMEOUT = 10
 
 
 class Lyrics:
@@ -22,33 +31,76 @@ class Lyrics:
     """
 
     load_dotenv()
-    __threads = 1
-    __executor = futures.ThreadPoolExecutor(__threads)
     __GENIUS_API_TOKEN = os.getenv("GENIUS_API_TOKEN")
     __genius = lyricsgenius.Genius(
         __GENIUS_API_TOKEN,
         skip_non_songs=True,
         excluded_terms=["(Remix)", "(Live)"],
     )
+    # lookups running at once, each needs its own browser
+    BROWSERS = int(os.getenv("LYRICS_BROWSERS", "2"))
+    __browsers = BrowserPool(
+        BROWSERS, int(os.getenv("LYRICS_BROWSER_MAX_USES", "50"))
+    )
+    # lyrics found before are not searched for again, even when
+    # their song was evicted
+    __cache = LyricsCache(
+        float(os.getenv("LYRICS_MISS_TTL", str(24 * 3600)))
+    )
+    # alignments running at once, each in its own process
+    ALIGNERS = int(os.getenv("ALIGNMENT_WORKERS", "2"))
+    __aligner = AlignerPool(
+        ALIGNERS,
+        float(os.getenv("ALIGNMENT_TIMEOUT", "300")),
+        os.getenv("LYRICS_ALIGNER", "aeneas"),
+    )
+    # every lookup queries all sources at once
+    __sources = futures.ThreadPoolExecutor(2 * BROWSERS)
 
     def __init__(self, artist: str, song_name: str, path: str):
+        """
+        Searching and aligning are separate steps, so they can be run
+        by separate pipeline stages, see Lyrics.search and Lyrics.align
+        """
         self.song_name = song_name
         self.artist = artist
         self.path = path
         self.success = True
-        self.__worker = self.__executor.submit(self.__lyrics_wrapper)
+        self.language: Optional[str] = None
 
     def is_done(self) -> bool:
         """
-        Awaits for end of creating lyrics map and returns when it's done and
-        if everything has gone right
+        Tells if lyrics map is already created
         """
-        self.__worker.result()
-        return self.success
+        return os.path.exists(os.path.join(self.path, "lyrics.srt"))
+
+    def search(self) -> bool:
+        """
+        Searches for lyrics in available sources and saves them
+        to lyrics.txt
 
-    def __lyrics_wrapper(self):
+        Returns:
+            bool: Were lyrics found
+        """
+        # lyrics may come with stems reused from the same song
+        if self.is_done():
+            return True
+
+        cached = Lyrics.__cache.get(self.artist, self.song_name)
         try:
-            lyrics = self.__get_song_lyrics()
+            if cached is not None:
+                lyrics, self.language = cached
+            else:
+                lyrics = self.__get_song_lyrics()
+                if lyrics is not None:
+                    self.language = detect(lyrics)
+                Lyrics.__cache.put(
+                    self.artist, self.song_name, lyrics, self.language
+                )
+            if lyrics is None:
+                self.success = False
+                return self.success
+
             with open(
                 os.path.join(self.path, "lyrics.txt"),
                 "w",
@@ -57,24 +109,37 @@ class Lyrics:
                 file.write(lyrics)
         except Exception as e:
             self.success = False
-            return print(f"wrapper: {e!s}")
+            print(f"wrapper: {e!s}")
+        return self.success
+
+    @staticmethod
+    def get_cache_stats() -> dict:
+        return Lyrics.__cache.get_stats()
+
+    def align(self, cancelled: Optional[Event] = None) -> bool:
+        """
+        Aligns lyrics found by search with vocals stem and saves
+        them to lyrics.srt
+
+        Args:
+            cancelled (Event): stops alignment once it is set
+
+        Returns:
+            bool: Was lyrics map created
+        """
+        if self.is_done():
+            return True
 
         try:
             print("Start processing using ananas...")
-            language = detect(lyrics)
-            config_string = f"task_language={language}|is_text_type=plain|os_task_file_format=srt"
-            t = Task(config_string=config_string)
-            t.audio_file_path_absolute = os.path.join(
-                self.path, "htdemucs", "audio", "vocals.mp3"
-            )
-            t.text_file_path_absolute = os.path.join(
-                self.path, "lyrics.txt"
+            self.language, fragments = Lyrics.__aligner.align(
+                os.path.join(self.path, "lyrics.txt"),
+                Separator.get_stem_path(self.path, "vocals"),
+                self.language,
+                cancelled,
             )
-
-            ExecuteTask(t).execute()
-
             self.__write_srt(
-                t.sync_map, os.path.join(self.path, "lyrics.srt")
+                fragments, os.path.join(self.path, "lyrics.srt")
             )
             try:
                 os.remove(os.path.join(self.path, "lyrics.txt"))
@@ -83,11 +148,12 @@ class Lyrics:
 
         except Exception as e:
             self.success = False
-            return print(f"ananas: {e!s}")
+            print(f"ananas: {e!s}")
+        return self.success
 
-    def __write_srt(self, sync_map, output_path):
+    def __write_srt(self, fragments: Fragments, output_path):
         """
-        Converts sync map to .srt
+        Converts aligned fragments to .srt
         """
 
         def format_time(seconds):
@@ -98,9 +164,9 @@ class Lyrics:
             return f"{h:02}:{m:02}:{s:02},{ms:03}"
 
         with open(output_path, "w", encoding="utf-8") as f:
-            for i, fragment in enumerate(sync_map.fragments):
-                adjusted_start = float(fragment.begin)
-                adjusted_end = float(fragment.end)
+            for i, (begin, end, text) in enumerate(fragments):
+                adjusted_start = begin
+                adjusted_end = end
                 if i > 0:
                     adjusted_start = max(0.0, adjusted_start - 0.5)
                     adjusted_end -= 0.5
@@ -108,7 +174,7 @@ class Lyrics:
                 start = format_time(adjusted_start)
                 end = format_time(adjusted_end)
                 f.write(
-                    f"{i + 1}\n{start} --> {end}\n{fragment.text.strip()}\n\n"
+                    f"{i + 1}\n{start} --> {end}\n{text.strip()}\n\n"
                 )
 
     def __bing_search_tekstowo(self):
@@ -118,52 +184,53 @@ class Lyrics:
         query = f"site:tekstowo.pl {self.artist} {self.song_name}"
         search_url = "https://www.bing.com"
 
-        options = uc.ChromeOptions()
-        options.add_argument("--headless=new")
-        options.add_argument(
-            "--disable-blink-features=AutomationControlled"
-        )
-        options.add_argument("--no-sandbox")
-        options.add_argument("--disable-gpu")
-        options.add_argument("--disable-dev-shm-usage")
-        options.add_argument(
-            "user-agent=Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/115 Safari/537.36"
-        )
-        options.add_argument("--no-sandbox")
-        options.add_argument("--disable-dev-shm-usage")
-
-        driver = uc.Chrome(options=options)
-
         try:
-            driver.get(search_url)
-            time.sleep(2)
-
-            search_box = driver.find_element(By.NAME, "q")
-            search_box.send_keys(query)
-            search_box.send_keys(Keys.RETURN)
-            time.sleep(4)
-
-            results = driver.find_elements(By.CSS_SELECTOR, "h2 > a")
-            for result in results:
-                href = result.get_attribute("href")
-                if href and "tekstowo.pl/piosenka," in href:
-                    return href
-
-            print("found no hrefs")
-            return None
+            with Lyrics.__browsers.acquire() as driver:
+                wait = WebDriverWait(driver, PAGE_TIMEOUT)
+                driver.get(search_url)
+                search_box = wait.until(
+                    expected_conditions.element_to_be_clickable(
+                        (By.NAME, "q")
+                    )
+                )
+                search_box.clear()
+                search_box.send_keys(query)
+                search_box.send_keys(Keys.RETURN)
+
+                # page with results has to replace the search one
+                wait.until(expected_conditions.staleness_of(search_box))
+                try:
+                    results = wait.until(
+                        expected_conditions.presence_of_all_elements_located(
+                            (By.CSS_SELECTOR, "h2 > a")
+                        )
+                    )
+                except TimeoutException:
+                    # no results, browser itself is fine
+                    results = []
+                hrefs = [
+                    result.get_attribute("href") for result in results
+                ]
 
         except Exception as e:
             print(f"Error during search: {e}")
             return None
 
-        finally:
-            driver.quit()
+        for href in hrefs:
+            if href and "tekstowo.pl/piosenka," in href:
+                return href
 
-    def __get_tekstowo_lyrics(self):
+        print("found no hrefs")
+        return None
+
+    def __get_tekstowo_lyrics(self, cancelled: Event):
+        # sources wait for the pool, other one could have won by now
+        if cancelled.is_set():
+            return None
         print("Searching tekstowo...")
         url = self.__bing_search_tekstowo()
-        if url is None:
-            return
+        if url is None or cancelled.is_set():
+            return None
         print("Got response from bing...")
         response = requests.get(url)
         if response.status_code != 200:
@@ -193,16 +260,17 @@ class Lyrics:
         lyrics = list(filter(self.__delete_useless_lines, lyrics))
         return "\n".join(lyrics[2:-2])
 
-    def __get_genius_lyrics(self):
+    def __get_genius_lyrics(self, cancelled: Event):
         """
-        Searches genius for lyrics as a backup
+        Searches genius for lyrics, unless other source found them
+        before search started, search itself can not be interrupted
         """
+        if cancelled.is_set():
+            return None
         try:
             print("Searching genius...")
-            self.song_name = self.song_name.split("(")[0]
-            song = self.__genius.search_song(
-                self.song_name, self.artist
-            )
+            song_name = self.song_name.split("(")[0]
+            song = self.__genius.search_song(song_name, self.artist)
             if song and song.lyrics:
                 return self.__clean_genius_lyrics(song.lyrics)
         except Exception as e:
@@ -221,23 +289,40 @@ class Lyrics:
         return cleaned
 
     def __get_song_lyrics(self):
+        """
+        Queries all sources at once, first one to find lyrics wins,
+        sources not started yet are skipped and tekstowo still
+        searching Bing does not fetch lyrics page
+
+        Returns:
+            str: lyrics, None if no source has them
+        """
         print("Searching for lyrics...")
-        if os.path.exists(f"{self.path}/lyrics.srt"):
-            return
-        lyrics = self.__get_tekstowo_lyrics()
-        if lyrics:
-            print("Found lyrics on tekstowo")
-            return lyrics
-
-        lyrics = self.__get_genius_lyrics()
-        if lyrics:
-            print("Found lyrics on genius")
-            return lyrics
-
-        self.success = False
+        cancelled = Event()
+        sources = {
+            Lyrics.__sources.submit(search, cancelled): name
+            for name, search in (
+                ("tekstowo", self.__get_tekstowo_lyrics),
+                ("genius", self.__get_genius_lyrics),
+            )
+        }
+        try:
+            for source in futures.as_completed(sources):
+                try:
+                    lyrics = source.result()
+                except Exception as e:
+                    print(f"{sources[source]}: {e!s}")
+                    continue
+                if lyrics:
+                    print(f"Found lyrics on {sources[source]}")
+                    return lyrics
+        finally:
+            # sources already running stop at their next check
+            cancelled.set()
+            for source in sources:
+                source.cancel()
+
         print(
             f"Unable to find lyrics for: {self.artist} - {self.song_name}"
         )
-        raise Exception(
-            f"Unable to find lyrics for: {self.artist} - {self.song_name}"
-        )
+        return None
@@ -0,0 +1,144 @@
+import os
+import re
+import sqlite3
+import time
+import unicodedata
+from threading import Lock
+from typing import Dict, Optional, Tuple
+
+from download import DOWNLOADS_PATH
+
+CACHE_FILE = "lyrics.db"
+# parts of titles that differ between uploads of the same song
+TITLE_NOISE = re.compile(
+    r"[(\[].*?[)\]]|\b(?:feat|ft)\b[^()\[\]-]*"
+    r"|\b(?:official|video|audio|lyrics?)\b",
+    re.IGNORECASE,
+)
+
+
+def normalize(text: str) -> str:
+    """
+    Reduces artist or title to a form shared by different spellings,
+    e.g. "Beyoncé - Halo (Official Video)" -> "beyonce halo"
+    """
+    text = unicodedata.normalize("NFKD", text)
+    text = "".join(c for c in text if not unicodedata.combining(c))
+    text = TITLE_NOISE.sub(" ", text.lower())
+    return " ".join(re.findall(r"\w+", text))
+
+
+class LyricsCache:
+    """
+    Persistent cache of found lyrics, kept outside of song
+    directories, so it survives their eviction. Songs without lyrics
+    are remembered too, for a limited time <br>
+    Usage: <br>
+        - Create cache: c = LyricsCache() <br>
+        - Look lyrics up via c.get(), save them via c.put()
+    """
+
+    def __init__(
+        self,
+        miss_ttl: float = 24 * 3600,
+        path: str = DOWNLOADS_PATH,
+    ):
+        """
+        Args:
+            miss_ttl (float): seconds after which songs without lyrics
+            are searched for again
+            path (str): directory of the cache file
+        """
+        self.miss_ttl = miss_ttl
+        os.makedirs(path, exist_ok=True)
+        self.__lock = Lock()
+        self.__stats = {"hits": 0, "misses": 0, "negative_hits": 0}
+        self.__db = sqlite3.connect(
+            os.path.join(path, CACHE_FILE), check_same_thread=False
+        )
+        self.__db.execute("PRAGMA journal_mode=WAL")
+        self.__db.execute(
+            """
+            CREATE TABLE IF NOT EXISTS lyrics (
+                artist TEXT NOT NULL,
+                title TEXT NOT NULL,
+                language TEXT,
+                lyrics TEXT,
+                created REAL NOT NULL,
+                PRIMARY KEY (artist, title)
+            )
+            """
+        )
+        self.__db.commit()
+
+    def get(
+        self, artist: str, title: str
+    ) -> Optional[Tuple[Optional[str], Optional[str]]]:
+        """
+        Looks song up in cache
+
+        Returns:
+            tuple: (lyrics, language), lyrics are None for songs known
+            to have none, None when song has to be searched for
+        """
+        key = (normalize(artist), normalize(title))
+        with self.__lock:
+            row = self.__db.execute(
+                """
+                SELECT lyrics, language, created FROM lyrics
+                WHERE artist = ? AND title = ?
+                """,
+                key,
+            ).fetchone()
+            if row is None or (
+                row[0] is None and row[2] + self.miss_ttl < time.time()
+            ):
+                self.__stats["misses"] += 1
+                return None
+            if row[0] is None:
+                self.__stats["negative_hits"] += 1
+            else:
+                self.__stats["hits"] += 1
+        return row[0], row[1]
+
+    def put(
+        self,
+        artist: str,
+        title: str,
+        lyrics: Optional[str],
+        language: Optional[str] = None,
+    ):
+        """
+        Saves lyrics of a song, None if it has none
+        """
+        key = (normalize(artist), normalize(title))
+        with self.__lock:
+            self.__db.execute(
+                """
+                INSERT OR REPLACE INTO lyrics
+                (artist, title, language, lyrics, created)
+                VALUES (?, ?, ?, ?, ?)
+                """,
+                (*key, language, lyrics, time.time()),
+            )
+            self.__db.commit()
+
+    def get_stats(self) -> Dict[str, float]:
+        """
+        Returns lookups served since start and share of them
+        answered from cache
+        """
+        with self.__lock:
+            stats: Dict[str, float] = dict(self.__stats)
+            stats["size"] = self.__db.execute(
+                "SELECT COUNT(*) FROM lyrics WHERE lyrics IS NOT NULL"
+            ).fetchone()[0]
+        lookups = (
+            stats["hits"] + stats["negative_hits"] + stats["misses"]
+        )
+        stats["hit_rate"] = (
+            (stats["hits"] + stats["negative_hits"]) / lookups
+            if lookups
+            else 0.0
+        )
+        return stats
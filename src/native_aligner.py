@@ -0,0 +1,253 @@
+import re
+import wave
+from typing import List, Tuple
+
+import numpy as np
+
+# (begin, end, text) of every aligned line
+Fragments = List[Tuple[float, float, str]]
+
+# seconds per analysed frame
+HOP = 0.04
+# frames of smoothing applied to loudness
+SMOOTH = 3
+# loudness (dB) range over which frame goes from silent to voiced
+VOICING_SOFTNESS = 6.0
+# short pause expected between sung lines, in seconds
+LINE_GAP = 0.3
+# how far (in seconds, at least) alignment may drift from singing
+# at constant rate, which bounds the part of DTW matrix computed
+BAND_SECONDS = 20.0
+BAND_FRACTION = 0.1
+# how much line and word starts are drawn to onsets of singing
+LINE_ONSET_WEIGHT = 2.0
+WORD_ONSET_WEIGHT = 0.5
+# cost of singing faster or slower than template for one frame,
+# without it warping is free within sung parts and lines drift
+STEP_PENALTY = 0.1
+VOWELS = re.compile(
+    r"[aeiouyàáâãäåæèéêëìíîïòóôõöøùúûüýÿąęıœ"  # noqa: RUF001
+    r"аеёиоуыэюяіїє]+",
+    re.IGNORECASE,
+)
+
+
+def read_wav(path: str) -> Tuple[np.ndarray, int]:
+    """
+    Reads 16 bit wav, like stems written by separation, as mono
+
+    Returns:
+        tuple: (samples, samplerate)
+    """
+    with wave.open(path, "rb") as file:
+        channels = file.getnchannels()
+        samplerate = file.getframerate()
+        data = file.readframes(file.getnframes())
+    samples = np.frombuffer(data, dtype=np.int16).reshape(-1, channels)
+    return samples.mean(axis=1) / 2**15, samplerate
+
+
+def get_features(
+    samples: np.ndarray, samplerate: int
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Computes how likely every frame is sung in and how strongly
+    singing starts in it
+
+    Returns:
+        tuple: (voicing, onset), both in [0, 1] per frame
+    """
+    hop = int(HOP * samplerate)
+    count = len(samples) // hop
+    frames = samples[: count * hop].reshape(count, hop)
+    loudness = 10 * np.log10(np.mean(frames**2, axis=1) + 1e-10)
+    kernel = np.ones(SMOOTH) / SMOOTH
+    padded = np.pad(loudness, SMOOTH // 2, mode="edge")
+    loudness = np.convolve(padded, kernel, mode="valid")
+
+    # separated vocals are close to silent between phrases, so
+    # threshold sits between noise floor and typical singing level
+    floor, peak = np.percentile(loudness, [10, 95])
+    threshold = floor + 0.35 * (peak - floor)
+    voicing = np.clip(
+        (loudness - threshold) / VOICING_SOFTNESS + 0.5, 0, 1
+    )
+
+    rise = np.diff(loudness, prepend=loudness[0]).clip(min=0)
+    scale = np.percentile(rise, 99) or 1.0
+    onset = np.clip(rise / scale, 0, 1) * voicing
+    return voicing, onset
+
+
+def count_syllables(word: str) -> int:
+    """
+    Estimates syllables of a word by its vowel groups, scripts
+    without vowels (like CJK) count one syllable per character
+    """
+    groups = len(VOWELS.findall(word))
+    if groups:
+        return groups
+    return max(1, sum(c.isalpha() for c in word))
+
+
+def build_template(
+    lines: List[str], frames_per_syllable: float, gap: int
+) -> Tuple[np.ndarray, np.ndarray, List[Tuple[int, int]]]:
+    """
+    Lays lyrics out on a frame grid as if they were sung at constant
+    rate, which plays the role text to speech plays in aeneas
+
+    Returns:
+        tuple: (voicing, onset weights, (first, last) frame of
+        every line)
+    """
+    voicing: List[float] = []
+    onset: List[float] = []
+    spans: List[Tuple[int, int]] = []
+    position = 0.0
+    for line in lines:
+        voicing.extend([0.0] * gap)
+        onset.extend([0.0] * gap)
+        position += gap
+        line_start = len(voicing)
+        for index, word in enumerate(line.split()):
+            position += count_syllables(word) * frames_per_syllable
+            size = max(1, round(position) - len(voicing))
+            first = len(voicing)
+            voicing.extend([1.0] * size)
+            onset.extend([0.0] * size)
+            if index == 0:
+                onset[first] = LINE_ONSET_WEIGHT
+            else:
+                onset[first] = WORD_ONSET_WEIGHT
+        spans.append((line_start, len(voicing) - 1))
+    return np.array(voicing), np.array(onset), spans
+
+
+def banded_dtw(
+    template: Tuple[np.ndarray, np.ndarray],
+    audio: Tuple[np.ndarray, np.ndarray],
+    radius: int,
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Aligns template frames with audio frames, only within radius of
+    the path that matches equal shares of sung frames, so long
+    instrumental parts do not push alignment out of the band.
+    Every row is computed at once, horizontal steps included, as
+    D[j] = C[j] + min(A[k] - C[k] for k <= j), where C is cumulative
+    cost of the row and A cost of entering it
+
+    Returns:
+        tuple: (first, last) audio frame matched with every
+        template frame
+    """
+    t_voicing, t_onset = template
+    a_voicing, a_onset = audio
+    rows, columns = len(t_voicing), len(a_voicing)
+    width = 2 * radius + 1
+    sung = np.cumsum(a_voicing) / max(a_voicing.sum(), 1e-9)
+    laid_out = np.cumsum(t_voicing) / max(t_voicing.sum(), 1e-9)
+    centers = np.searchsorted(sung, laid_out).clip(max=columns - 1)
+    starts = np.clip(centers - radius, 0, max(0, columns - width))
+    width = min(width, columns)
+    # 0 - diagonal, 1 - vertical, 2 - horizontal step
+    steps = np.zeros((rows, width), dtype=np.int8)
+
+    previous = np.full(width, np.inf)
+    previous_start = starts[0]
+    for i in range(rows):
+        start = starts[i]
+        band = slice(start, start + width)
+        cost = np.abs(t_voicing[i] - a_voicing[band]) + t_onset[i] * (
+            1 - a_onset[band]
+        )
+        if i == 0:
+            entry = np.full(width, np.inf)
+            entry[0] = 0.0
+        else:
+            shift = start - previous_start
+            # previous row, aligned to columns of this one
+            up = np.full(width + 1, np.inf)
+            lo, hi = max(0, shift - 1), min(width, shift + width)
+            up[lo - (shift - 1) : hi - (shift - 1)] = previous[lo:hi]
+            diagonal, vertical = up[:-1], up[1:]
+            vertical = vertical + STEP_PENALTY
+            entry = np.minimum(diagonal, vertical)
+            steps[i] = np.where(diagonal <= vertical, 0, 1)
+
+        entered = entry + cost
+        total = np.cumsum(cost + STEP_PENALTY)
+        best = np.minimum.accumulate(entered - total)
+        current = total + best
+        steps[i][current < entered] = 2
+        previous, previous_start = current, start
+
+    first = np.zeros(rows, dtype=int)
+    last = np.full(rows, -1)
+    i, j = rows - 1, width - 1
+    while i >= 0:
+        # path is walked backwards, so row is entered at its end
+        first[i] = starts[i] + j
+        if last[i] < 0:
+            last[i] = first[i]
+        step = steps[i, j]
+        if step == 2:
+            j -= 1
+            continue
+        if step == 0:
+            j -= 1
+        j += starts[i] - starts[i - 1] if i > 0 else 0
+        i -= 1
+    return first, last
+
+
+def align(text_path: str, audio_path: str) -> Fragments:
+    """
+    Aligns lyrics with vocals stem without speech synthesis:
+    lyrics are laid out at constant singing rate and warped onto
+    sung parts of the stem with banded DTW
+
+    Args:
+        text_path (str): plain text, one line per fragment
+        audio_path (str): vocals stem (16 bit wav)
+
+    Returns:
+        list: fragment of every line
+    """
+    with open(text_path, encoding="utf-8") as file:
+        lines = [line.strip() for line in file if line.strip()]
+    if not lines:
+        return []
+
+    samples, samplerate = read_wav(audio_path)
+    voicing, onset = get_features(samples, samplerate)
+    # search only between first and last sung frame
+    sung = np.flatnonzero(voicing > 0.5)
+    if len(sung) == 0:
+        raise Exception("No singing found in vocals")
+    first, last = sung[0], sung[-1] + 1
+    voicing, onset = voicing[first:last], onset[first:last]
+
+    syllables = sum(count_syllables(w) for w in " ".join(lines).split())
+    gap = round(LINE_GAP / HOP)
+    frames_per_syllable = max(
+        1.0, (voicing.sum() - gap * len(lines)) / syllables
+    )
+    t_voicing, t_onset, spans = build_template(
+        lines, frames_per_syllable, gap
+    )
+    radius = int(max(BAND_SECONDS / HOP, BAND_FRACTION * len(voicing)))
+    starts, ends = banded_dtw(
+        (t_voicing, t_onset), (voicing, onset), radius
+    )
+
+    fragments = []
+    for line, (begin, end) in zip(lines, spans):
+        fragments.append(
+            (
+                float(round((first + starts[begin]) * HOP, 3)),
+                float(round((first + ends[end] + 1) * HOP, 3)),
+                line,
+            )
+        )
+    return fragments
@@ -0,0 +1,739 @@
+import asyncio
+import contextlib
+import json
+import math
+import os
+import time
+from collections import Counter, OrderedDict, deque
+from concurrent import futures
+from threading import Event, Lock
+from typing import Awaitable, Callable, Dict, List, Optional
+
+from download import Download
+from engine import Engine
+from jobs import JobStore, get_owner, open_job_store
+from lyrics import Lyrics
+from progress import Progress
+from scheduler import FairQueue
+from separator import (
+    STEM,
+    WAV_HEADER_SIZE,
+    Separator,
+    read_wav_header,
+)
+
+STAGES = ["download", "separate", "lyrics", "align"]
+# stages songs branch off to, running alongside the main ones
+BRANCHES = {"lyrics"}
+# how often separation progress is checked
+PROGRESS_INTERVAL = 1.0
+# how often download is checked for metadata lyrics search needs
+METADATA_INTERVAL = 0.2
+# how often job store is checked for songs queued by other workers
+FEED_INTERVAL = 1.0
+# how often leases of songs being processed are renewed, which is
+# also how late other workers learn about stage changes
+RENEW_INTERVAL = 2.0
+# seconds a stage is assumed to take before it handled any song
+DEFAULT_DURATION = 30.0
+# client songs prefetched from search results are queued for, they
+# wait behind every requested song and give way to it
+SPECULATIVE_CLIENT = "speculative"
+SPECULATIVE_PRIORITY = -1
+# prefetched songs remembered for hit rate
+SPECULATED_SIZE = 1024
+
+
+class Saturated(Exception):
+    """
+    Raised when pipeline can not take more songs right now
+    """
+
+    def __init__(
+        self,
+        position: int,
+        retry_after: int,
+        song_ids: Optional[List[Optional[str]]] = None,
+    ):
+        """
+        Args:
+            position (int): songs waiting ahead
+            retry_after (int): seconds until there is likely room
+            song_ids (list): for batches, id of every song that was
+            queued anyway and None for every one that was not
+        """
+        super().__init__("Too many songs are being processed")
+        self.position = position
+        self.retry_after = retry_after
+        self.song_ids = song_ids or []
+
+
+class Job:
+    """
+    Song travelling through pipeline stages
+    """
+
+    def __init__(
+        self,
+        song_id: str,
+        link: str,
+        progress: Progress,
+        client: str = "",
+        priority: int = 0,
+    ):
+        self.song_id = song_id
+        self.link = link
+        self.client = client
+        self.priority = priority
+        self.path = Download.get_download_dir(song_id)
+        self.stage = "queued"
+        self.failed = False
+        # song length, known once it is downloaded
+        self.duration: Optional[float] = None
+        # set from other threads, checked between and within stages
+        self.cancelled = Event()
+        # stage after which song is finished early
+        self.last_stage: Optional[str] = None
+        self.lyrics: Optional[Lyrics] = None
+        # whether lyrics were found, set by lyrics stage
+        self.searched: futures.Future = futures.Future()
+        self.__progress = progress
+        self.__progress.publish(song_id, self.stage)
+
+    def set_stage(self, stage: str):
+        self.stage = stage
+        percent = 100 if stage == "done" else 0
+        self.__progress.publish(self.song_id, stage, percent)
+
+    def report(self, percent: float):
+        """
+        Publishes how much of current stage is done
+        """
+        self.__progress.publish(self.song_id, self.stage, percent)
+
+
+class Stage:
+    """
+    Single pipeline step with bounded queue in front of it and
+    fixed number of workers running its blocking handler in threads.
+    Queue hands out jobs by priority and fair share of clients, see
+    FairQueue. Branch stage runs alongside the main ones, so it
+    neither changes stage of the song nor fails it
+    """
+
+    def __init__(
+        self,
+        name: str,
+        handler: Callable[[Job], None],
+        concurrency: int = 1,
+        queue_size: int = 16,
+        branch: bool = False,
+        shortest_first: bool = False,
+    ):
+        self.name = name
+        self.concurrency = concurrency
+        self.branch = branch
+        self.queue = FairQueue(queue_size, shortest_first)
+        self.next: Optional[Stage] = None
+        self.on_finish: Optional[Callable[[Job], Awaitable[None]]] = (
+            None
+        )
+        self.__handler = handler
+        self.__executor = futures.ThreadPoolExecutor(concurrency)
+        self.__busy = 0
+        # recent handler run times, for wait estimates
+        self.__durations: deque = deque([DEFAULT_DURATION], maxlen=32)
+        self.__workers: List[asyncio.Task] = []
+
+    def start(self):
+        self.__workers = [
+            asyncio.create_task(self.__work())
+            for _ in range(self.concurrency)
+        ]
+
+    def stop(self):
+        for worker in self.__workers:
+            worker.cancel()
+        self.__executor.shutdown(wait=False)
+
+    def get_load(self) -> int:
+        """
+        Returns number of jobs waiting for or handled by this stage
+        """
+        return self.queue.qsize() + self.__busy
+
+    def get_average(self) -> float:
+        """
+        Returns average seconds one job spends in this stage
+        """
+        return sum(self.__durations) / len(self.__durations)
+
+    async def __work(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            job = await self.queue.get()
+            # cancelled songs pass through remaining stages right away
+            skip = job.cancelled.is_set()
+            if not self.branch and not skip:
+                job.set_stage(self.name)
+            self.__busy += 1
+            start = time.time()
+            try:
+                if not skip:
+                    await loop.run_in_executor(
+                        self.__executor, self.__handler, job
+                    )
+            except Exception as e:
+                print(f"{self.name} failed for {job.song_id}: {e!s}")
+                job.failed = job.failed or not self.branch
+            finally:
+                self.__busy -= 1
+                if not skip:
+                    self.__durations.append(time.time() - start)
+                self.queue.task_done()
+
+            if self.branch:
+                continue
+            try:
+                if (
+                    job.failed
+                    or job.cancelled.is_set()
+                    or job.last_stage == self.name
+                    or self.next is None
+                ):
+                    if self.on_finish is not None:
+                        await self.on_finish(job)
+                else:
+                    # blocks when next stage is full, which in turn
+                    # fills this one and finally rejects new songs
+                    await self.next.queue.put(job)
+            except Exception as e:
+                # song whose lease is not renewed any more is
+                # taken over by another worker
+                print(
+                    f"{self.name} could not pass on {job.song_id}: {e!s}"
+                )
+
+
+class Pipeline:
+    """
+    Staged song processing: download -> separate -> align, with
+    lyrics searched alongside separation as soon as song title is
+    known, every stage with its own bounded queue and concurrency.
+    Songs are queued in job store shared by all workers, each one
+    takes songs its first stage has room for <br>
+    Usage: <br>
+        - Create pipeline: p = Pipeline(engine) <br>
+        - Start it inside event loop: p.start() <br>
+        - Submit songs via p.submit()
+    """
+
+    def __init__(
+        self,
+        engine: Engine,
+        concurrency: Optional[Dict[str, int]] = None,
+        queue_sizes: Optional[Dict[str, int]] = None,
+        jobs: Optional[JobStore] = None,
+        client_queue_size: Optional[int] = None,
+        shortest_first: bool = False,
+        speculative_separation: bool = False,
+    ):
+        """
+        Args:
+            engine (Engine): engine separating songs
+            concurrency (dict): stage name -> number of workers
+            queue_sizes (dict): stage name -> max waiting songs,
+            download one limits songs queued in job store
+            jobs (JobStore): store shared with other workers
+            client_queue_size (int): max songs queued by one client,
+            half of download queue by default
+            shortest_first (bool): separate shorter songs first
+            speculative_separation (bool): separate prefetched songs
+            too, not just download them
+        """
+        self.__engine = engine
+        self.__concurrency = {
+            "download": 4,
+            "separate": 1,
+            "lyrics": Lyrics.BROWSERS,
+            "align": Lyrics.ALIGNERS,
+            **(concurrency or {}),
+        }
+        self.__queue_sizes = {
+            "download": 32,
+            "separate": 16,
+            "lyrics": 16,
+            "align": 16,
+            **(queue_sizes or {}),
+        }
+        self.__client_queue_size = client_queue_size or max(
+            1, self.__queue_sizes["download"] // 2
+        )
+        self.__shortest_first = shortest_first
+        self.__speculative_separation = speculative_separation
+        # prefetch stats are shared by request and pipeline threads
+        self.__lock = Lock()
+        self.__speculated: OrderedDict[str, None] = OrderedDict()
+        self.__prefetch_stats: Counter = Counter()
+        self.__handlers = {
+            "download": self.__download,
+            "separate": self.__separate,
+            "lyrics": self.__search_lyrics,
+            "align": self.__align_lyrics,
+        }
+        self.__stages: List[Stage] = []
+        self.__jobs: Dict[str, Job] = {}
+        self.__store = jobs or open_job_store()
+        self.owner = get_owner()
+        self.__loop: Optional[asyncio.AbstractEventLoop] = None
+        self.__wakeup: Optional[asyncio.Event] = None
+        self.__tasks: List[asyncio.Task] = []
+        self.progress = Progress()
+
+    def start(self, process: bool = True):
+        """
+        Starts stage workers, has to be called inside event loop
+
+        Args:
+            process (bool): whether this worker processes songs,
+            otherwise it only queues them for other workers
+        """
+        self.__loop = asyncio.get_running_loop()
+        self.progress.bind(self.__loop)
+        if not process:
+            return
+        self.__stages = [
+            Stage(
+                name,
+                self.__handlers[name],
+                self.__concurrency[name],
+                self.__queue_sizes[name],
+                name in BRANCHES,
+                self.__shortest_first and name == "separate",
+            )
+            for name in STAGES
+        ]
+        main = [stage for stage in self.__stages if not stage.branch]
+        for stage, following in zip(main, main[1:]):
+            stage.next = following
+        for stage in main:
+            stage.on_finish = self.__finish
+        for stage in self.__stages:
+            stage.start()
+        self.__wakeup = asyncio.Event()
+        self.__tasks = [
+            asyncio.create_task(self.__feed()),
+            asyncio.create_task(self.__keep_leases()),
+        ]
+
+    def stop(self):
+        """
+        Stops taking songs, ones being processed are taken over by
+        other workers once their leases expire
+        """
+        for task in self.__tasks:
+            task.cancel()
+        for stage in self.__stages:
+            stage.stop()
+
+    def submit(
+        self, link: str, client: str = "", priority: int = 0
+    ) -> str:
+        """
+        Queues song for processing unless it is already queued or
+        being processed by any worker, does blocking database calls
+
+        Args:
+            link (str): link to the song
+            client (str): id of client asking for the song
+            priority (int): songs with higher priority go first
+
+        Returns:
+            str: song id
+
+        Raises:
+            Saturated: too many songs are queued, or queued by client
+        """
+        return self.submit_many([link], client, priority)[0]
+
+    def submit_many(
+        self, links: List[str], client: str = "", priority: int = 0
+    ) -> List[str]:
+        """
+        Queues songs like submit, in the given order, so first ones
+        are downloaded and separated while later ones still download.
+        Songs are admitted while there is room for them, songs
+        already queued or being processed always are, and songs
+        already separated are not queued at all
+
+        Returns:
+            list: song id of every link
+
+        Raises:
+            Saturated: some songs did not fit, its song_ids tell
+            which ones were queued
+        """
+        song_ids = [Download.get_song_id(link) for link in links]
+        # separated songs take no room and are not processed again
+        done = [
+            self.__engine.is_done(Download.get_download_dir(song_id))
+            for song_id in song_ids
+        ]
+        fresh = [
+            not is_done and self.get_stage(song_id) is None
+            for song_id, is_done in zip(song_ids, done)
+        ]
+        rejected = [False] * len(links)
+        # songs left out wait for whichever limit is hit first
+        queued = ahead = 0
+        if any(fresh):
+            queued = self.__store.count_queued()
+            own = self.__store.count_queued(client)
+            free = self.__queue_sizes["download"] - queued
+            quota = self.__client_queue_size - own
+            room = min(free, quota)
+            ahead = queued if free <= quota else own
+            for index, is_fresh in enumerate(fresh):
+                if is_fresh:
+                    rejected[index] = room <= 0
+                    room -= 1
+
+        admitted = [
+            (song_id, link)
+            for song_id, link, skip, is_done in zip(
+                song_ids, links, rejected, done
+            )
+            if not skip and not is_done
+        ]
+        added = self.__store.enqueue_many(admitted, client, priority)
+        if client != SPECULATIVE_CLIENT:
+            with self.__lock:
+                for song_id, _ in admitted:
+                    if song_id in self.__speculated:
+                        del self.__speculated[song_id]
+                        self.__prefetch_stats["hits"] += 1
+        if any(added) and self.__wakeup is not None:
+            assert self.__loop is not None
+            self.__loop.call_soon_threadsafe(self.__wakeup.set)
+
+        if any(rejected):
+            raise Saturated(
+                queued + sum(added),
+                self.__estimate_wait(ahead + sum(added)),
+                [
+                    None if skip else song_id
+                    for song_id, skip in zip(song_ids, rejected)
+                ]
+                if len(links) > 1
+                else None,
+            )
+        return song_ids
+
+    def prefetch(self, links: List[str], limit: int = 8) -> List[str]:
+        """
+        Queues songs likely to be asked for soon, like top search
+        results, behind every requested song and only while none
+        waits. Prefetched songs are just downloaded unless
+        speculative separation is on, and their separation gives way
+        to requested songs. Does blocking database calls
+
+        Args:
+            links (list): links to the songs, most likely first
+            limit (int): max prefetched songs queued or processed
+
+        Returns:
+            list: ids of songs queued
+        """
+        try:
+            store = self.__store
+            prefetching = store.count_queued(SPECULATIVE_CLIENT, True)
+            waiting = store.count_queued() - store.count_queued(
+                SPECULATIVE_CLIENT
+            )
+            if waiting or prefetching >= limit:
+                return []
+            wanted = []
+            for link in links[: limit - prefetching]:
+                song_id = Download.get_song_id(link)
+                path = Download.get_download_dir(song_id)
+                if self.__speculative_separation:
+                    ready = self.__engine.is_done(path)
+                else:
+                    ready = Download.has_audio(path)
+                if not ready and self.get_stage(song_id) is None:
+                    wanted.append(link)
+            if not wanted:
+                return []
+            try:
+                song_ids = self.submit_many(
+                    wanted, SPECULATIVE_CLIENT, SPECULATIVE_PRIORITY
+                )
+            except Saturated as e:
+                song_ids = [
+                    song_id for song_id in e.song_ids if song_id
+                ]
+        except Exception as e:
+            print(f"prefetch failed: {e!s}")
+            return []
+
+        with self.__lock:
+            for song_id in song_ids:
+                self.__speculated[song_id] = None
+                self.__speculated.move_to_end(song_id)
+            while len(self.__speculated) > SPECULATED_SIZE:
+                self.__speculated.popitem(last=False)
+            self.__prefetch_stats["prefetched"] += len(song_ids)
+        return song_ids
+
+    def get_prefetch_stats(self) -> dict:
+        """
+        Returns songs prefetched and later asked for by this worker,
+        and prefetched separations given way to requested songs
+        """
+        with self.__lock:
+            prefetched = self.__prefetch_stats["prefetched"]
+            hits = self.__prefetch_stats["hits"]
+            preempted = self.__prefetch_stats["preempted"]
+        return {
+            "prefetched": prefetched,
+            "hits": hits,
+            "preempted": preempted,
+            "hit_rate": hits / prefetched if prefetched else 0.0,
+        }
+
+    def cancel(self, song_id: str, client: str = "") -> bool:
+        """
+        Stops client waiting for a song, which drops the song if no
+        other client waits for it. Separation that is running stops
+        after segment being separated, does blocking database calls
+
+        Returns:
+            bool: Was song cancelled
+        """
+        if not self.__store.cancel(song_id, client):
+            return False
+        job = self.__jobs.get(song_id)
+        if job is not None:
+            job.cancelled.set()
+        return True
+
+    def get_stage(self, song_id: str) -> Optional[str]:
+        """
+        Returns stage song is in, None if it is not in pipeline
+        of any worker
+        """
+        job = self.__jobs.get(song_id)
+        if job is not None:
+            return job.stage
+        return self.__store.get_stage(song_id)
+
+    def is_processing(self, song_id: str) -> bool:
+        """
+        Tells if song is processed by this worker, so its progress
+        can be followed in detail
+        """
+        return song_id in self.__jobs
+
+    def get_position(self) -> int:
+        """
+        Returns number of songs a new song would wait behind
+        """
+        return self.__store.count_queued()
+
+    def __estimate_wait(self, queued: int) -> int:
+        """
+        Returns seconds until first stage is likely to take a song
+        """
+        average = DEFAULT_DURATION
+        if self.__stages:
+            average = self.__stages[0].get_average()
+        per_job = average / self.__concurrency["download"]
+        return max(1, math.ceil(queued * per_job))
+
+    async def __feed(self):
+        """
+        Takes queued songs from job store while first stage has room
+        """
+        assert self.__wakeup is not None
+        first = self.__stages[0]
+        while True:
+            self.__wakeup.clear()
+            while not first.queue.full():
+                claimed = await asyncio.to_thread(
+                    self.__store.claim, self.owner
+                )
+                if claimed is None:
+                    break
+                song_id, link, client, priority = claimed
+                # lease of own song expired, it is still processed
+                if song_id in self.__jobs:
+                    continue
+                job = Job(
+                    song_id, link, self.progress, client, priority
+                )
+                self.__jobs[song_id] = job
+                first.queue.put_nowait(job)
+                if client != SPECULATIVE_CLIENT:
+                    await asyncio.to_thread(self.__preempt)
+            with contextlib.suppress(asyncio.TimeoutError):
+                await asyncio.wait_for(
+                    self.__wakeup.wait(), FEED_INTERVAL
+                )
+
+    async def __keep_leases(self):
+        """
+        Renews leases of songs being processed, so no other worker
+        takes them over, and shares their stages. Songs cancelled
+        through other workers are stopped here
+        """
+        while True:
+            stages = {
+                song_id: job.stage
+                for song_id, job in self.__jobs.items()
+            }
+            try:
+                lost = await asyncio.to_thread(
+                    self.__store.renew, self.owner, stages
+                )
+            except Exception as e:
+                print(f"renewing leases failed: {e!s}")
+                lost = []
+            for song_id in lost:
+                job = self.__jobs.get(song_id)
+                if job is not None:
+                    job.cancelled.set()
+            await asyncio.sleep(RENEW_INTERVAL)
+
+    def __preempt(self):
+        """
+        Stops separating prefetched songs when separation is busy,
+        so requested song does not wait for them
+        """
+        separate = next(
+            s for s in self.__stages if s.name == "separate"
+        )
+        if separate.get_load() < separate.concurrency:
+            return
+        for job in list(self.__jobs.values()):
+            if (
+                job.client != SPECULATIVE_CLIENT
+                or job.stage != "separate"
+            ):
+                continue
+            # song someone asked for meanwhile is not cancelled
+            if self.cancel(job.song_id, SPECULATIVE_CLIENT):
+                with self.__lock:
+                    self.__prefetch_stats["preempted"] += 1
+
+    def __stops_early(self, job: Job) -> bool:
+        """
+        Tells if song was only prefetched, so it is just downloaded.
+        Prefetched song someone asked for meanwhile is processed like
+        any other one from now on
+        """
+        if job.client != SPECULATIVE_CLIENT:
+            return False
+        waiters = [
+            client
+            for client in self.__store.get_waiters(job.song_id)
+            if client != SPECULATIVE_CLIENT
+        ]
+        if waiters:
+            job.client, job.priority = waiters[0], max(job.priority, 0)
+            return False
+        return not self.__speculative_separation
+
+    async def __finish(self, job: Job):
+        self.__jobs.pop(job.song_id, None)
+        if job.cancelled.is_set():
+            job.set_stage("cancelled")
+            return
+        job.set_stage("failed" if job.failed else "done")
+        # store can wait for other workers' writes, not the loop
+        await asyncio.to_thread(
+            self.__store.finish, job.song_id, self.owner, job.failed
+        )
+
+    def __branch(self, job: Job, name: str):
+        """
+        Sends song to branch stage, waits while the stage is full
+        """
+        assert self.__loop is not None
+        stage = next(s for s in self.__stages if s.name == name)
+        asyncio.run_coroutine_threadsafe(
+            stage.queue.put(job), self.__loop
+        ).result()
+
+    def __download(self, job: Job):
+        download = Download(job.link, job.report)
+        # lyrics search needs just the title, which is known
+        # long before audio is downloaded
+        metadata = os.path.join(job.path, "metadata.json")
+        while not os.path.exists(metadata) and not download.is_ready():
+            time.sleep(METADATA_INTERVAL)
+        # prefetched song needs lyrics only once someone asks for it
+        searching = os.path.exists(metadata) and not self.__stops_early(
+            job
+        )
+        if searching:
+            self.__branch(job, "lyrics")
+        download.wait_for()
+        with open(metadata) as file:
+            job.duration = json.load(file).get("duration")
+        if self.__stops_early(job):
+            job.last_stage = "download"
+            return
+        # other upload of a song separated before needs no separation
+        # worker, its stems and lyrics are linked right away
+        if self.__engine.reuse_stems(job.path):
+            job.last_stage = "download"
+        elif not searching:
+            self.__branch(job, "lyrics")
+
+    def __separate(self, job: Job):
+        self.__engine.enqueue(job.path)
+        duration = job.duration
+        while self.__engine.is_running(job.path):
+            if job.cancelled.is_set():
+                # waits below until separation actually stops
+                self.__engine.cancel(job.path)
+                break
+            if duration:
+                job.report(Pipeline.get_separated(job.path, duration))
+            time.sleep(PROGRESS_INTERVAL)
+        self.__engine.wait_for(job.path)
+
+    @staticmethod
+    def get_separated(path: str, duration: float) -> float:
+        """
+        Returns percent of song already separated, judged by size of
+        stem being written, 0 when song is separated in one piece
+        """
+        part = f"{Separator.get_stem_path(path, STEM)}.part"
+        try:
+            with open(part, "rb") as file:
+                header = file.read(WAV_HEADER_SIZE)
+                size = os.fstat(file.fileno()).st_size
+            samplerate, channels = read_wav_header(header)
+        except Exception:
+            return 0
+        seconds = (size - WAV_HEADER_SIZE) / (samplerate * channels * 2)
+        return min(99, 100 * seconds / duration)
+
+    def __search_lyrics(self, job: Job):
+        found = False
+        try:
+            with open(os.path.join(job.path, "metadata.json")) as file:
+                title = json.load(file)["title"]
+            job.lyrics = Lyrics("", title, job.path)
+            found = job.lyrics.search()
+        finally:
+            job.searched.set_result(found)
+
+    def __align_lyrics(self, job: Job):
+        # only alignment needs vocals, search ran during separation
+        if not job.searched.result():
+            raise Exception("lyrics not found")
+        assert job.lyrics is not None
+        if not job.lyrics.align(job.cancelled):
+            raise Exception("lyrics not aligned")
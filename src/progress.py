@@ -0,0 +1,114 @@
+import asyncio
+from typing import AsyncIterator, Dict, Optional, Set
+
+# stages after which no more events of a song are published
+FINAL_STAGES = ("done", "failed", "cancelled")
+# events a slow subscriber can lag behind, older ones are dropped
+# as only the latest state matters
+SUBSCRIBER_BACKLOG = 16
+
+
+class Progress:
+    """
+    Fans progress events of songs out to all their subscribers,
+    so clients are pushed stage changes instead of polling <br>
+    Usage: <br>
+        - Create hub: p = Progress() <br>
+        - Bind it to event loop: p.bind(loop) <br>
+        - Publish from any thread via p.publish() <br>
+        - Subscribe inside event loop via p.open() and p.listen()
+    """
+
+    def __init__(self):
+        self.__loop: Optional[asyncio.AbstractEventLoop] = None
+        self.__subscribers: Dict[str, Set[asyncio.Queue]] = {}
+        self.__last: Dict[str, dict] = {}
+
+    def bind(self, loop: asyncio.AbstractEventLoop):
+        self.__loop = loop
+
+    def publish(self, song_id: str, stage: str, percent: float = 0):
+        """
+        Publishes progress of a song, safe to call from any thread
+
+        Args:
+            song_id (str): id of the song
+            stage (str): stage song is in
+            percent (float): how much of the stage is done
+        """
+        if self.__loop is None:
+            return
+        event = {
+            "song_id": song_id,
+            "stage": stage,
+            "percent": round(percent),
+        }
+        self.__loop.call_soon_threadsafe(self.__publish, event)
+
+    def __publish(self, event: dict):
+        song_id = event["song_id"]
+        last = self.__last.get(song_id)
+        if last == event:
+            return
+
+        if event["stage"] in FINAL_STAGES:
+            self.__last.pop(song_id, None)
+        else:
+            self.__last[song_id] = event
+        for queue in self.__subscribers.get(song_id, ()):
+            if queue.full():
+                queue.get_nowait()
+            queue.put_nowait(event)
+
+    def get_last(self, song_id: str) -> Optional[dict]:
+        """
+        Returns latest event of a song still being processed
+        """
+        return self.__last.get(song_id)
+
+    def open(self, song_id: str) -> asyncio.Queue:
+        """
+        Registers new subscriber of a song
+
+        Returns:
+            asyncio.Queue: queue events are put into, starting with
+            the latest one if there is any
+        """
+        queue: asyncio.Queue = asyncio.Queue(SUBSCRIBER_BACKLOG)
+        last = self.__last.get(song_id)
+        if last is not None:
+            queue.put_nowait(last)
+        self.__subscribers.setdefault(song_id, set()).add(queue)
+        return queue
+
+    def close(self, song_id: str, queue: asyncio.Queue):
+        subscribers = self.__subscribers.get(song_id)
+        if subscribers is None:
+            return
+        subscribers.discard(queue)
+        if not subscribers:
+            del self.__subscribers[song_id]
+
+    async def listen(
+        self,
+        song_id: str,
+        queue: asyncio.Queue,
+        timeout: Optional[float] = None,
+    ) -> AsyncIterator[Optional[dict]]:
+        """
+        Yields events of opened subscription until song is done or
+        failed, None when there was no event for timeout seconds.
+        Subscription is closed afterwards
+        """
+        try:
+            while True:
+                try:
+                    event = await asyncio.wait_for(queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    yield None
+                    continue
+                yield event
+                if event["stage"] in FINAL_STAGES:
+                    return
+        finally:
+            self.close(song_id, queue)
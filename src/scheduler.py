@@ -0,0 +1,70 @@
+import asyncio
+import itertools
+import math
+from collections import Counter
+from typing import List, Optional
+
+
+class FairQueue(asyncio.Queue):
+    """
+    Bounded queue of pipeline jobs handing out the most urgent job
+    first: highest priority, then job of the client served the least
+    since it started waiting, so one client submitting a whole
+    playlist takes turns with others instead of starving them, then
+    optionally the shortest song.
+    Jobs need client, priority and duration attributes <br>
+    Usage: <br>
+        - Create queue: q = FairQueue(maxsize, shortest_first) <br>
+        - Use it like asyncio.Queue
+    """
+
+    def __init__(self, maxsize: int = 0, shortest_first: bool = False):
+        """
+        Args:
+            maxsize (int): max waiting jobs, 0 for unbounded
+            shortest_first (bool): prefer songs with lower duration
+        """
+        self.shortest_first = shortest_first
+        super().__init__(maxsize)
+
+    # asyncio.Queue storage hooks, same ones PriorityQueue overrides
+    def _init(self, maxsize: int):
+        self._queue: List = []
+        self.__order = itertools.count()
+        # jobs of waiting clients taken so far
+        self.__served: Counter = Counter()
+        self.__waiting: Counter = Counter()
+
+    def _put(self, job):
+        if not self.__waiting[job.client]:
+            # client that was not waiting starts level with the
+            # least served one, so it gets no credit for idle time
+            self.__served[job.client] = min(
+                (self.__served[c] for c in self.__waiting), default=0
+            )
+        self.__waiting[job.client] += 1
+        self._queue.append((next(self.__order), job))
+
+    def _get(self):
+        index = min(
+            range(len(self._queue)),
+            key=lambda i: self.__rank(*self._queue[i]),
+        )
+        _, job = self._queue.pop(index)
+        self.__served[job.client] += 1
+        self.__waiting[job.client] -= 1
+        if not self.__waiting[job.client]:
+            del self.__waiting[job.client]
+            del self.__served[job.client]
+        return job
+
+    def __rank(self, order: int, job) -> tuple:
+        duration: Optional[float] = job.duration
+        if not self.shortest_first or duration is None:
+            duration = math.inf if self.shortest_first else 0
+        return (
+            -job.priority,
+            self.__served[job.client],
+            duration,
+            order,
+        )
@@ -1,10 +1,32 @@
 import json
-from typing import List
+import time
+from collections import OrderedDict
+from concurrent import futures
+from threading import Lock
+from typing import List, Optional, Tuple
 
-import yt_dlp
+from singleflight import SingleFlight
+from ytdl import YoutubeDLPool
+
+# songs read from one playlist at most
+PLAYLIST_LIMIT = 100
 
 
 class Search:
+    # pools of search, playlist and download are separate, see
+    # YoutubeDLPool, together they run 4 + 2 + download threads calls
+    __ytdl = YoutubeDLPool(
+        {
+            "quiet": True,
+            "extract_flat": "in_playlist",
+            "skip_download": True,
+            "format": "bestaudio/best",
+            "default_search": "ytsearch30",
+            "noplaylist": True,
+        },
+        4,
+    )
+
     def __init__(self, query: str):
         """
         Holds information about a search done on a given query
@@ -21,38 +43,29 @@ class Search:
             bool: Was query successfull
         """
         try:
-            ydl_opts = {
-                "quiet": True,
-                "extract_flat": "in_playlist",
-                "skip_download": True,
-                "format": "bestaudio/best",
-                "default_search": "ytsearch30",
-                "noplaylist": True,
-            }
-
-            with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-                info = ydl.extract_info(self.query, download=False)
-
-                if "entries" not in info:
-                    return False
-                self.results = []
-                for entry in info["entries"]:
-                    if not entry.get("id") or not entry.get("title"):
-                        continue
-
-                    self.results.append(
-                        {
-                            "url": f"https://www.youtube.com/watch?v={entry.get('id')}",
-                            "title": entry.get("track")
-                            or entry.get("title")
-                            or "Unknown",
-                        }
-                    )
-
-                    if len(self.results) >= 20:
-                        break
-
-                return bool(self.results)
+            info = Search.__ytdl.run(
+                lambda ydl: ydl.extract_info(self.query, download=False)
+            )
+            if "entries" not in info:
+                return False
+            self.results = []
+            for entry in info["entries"]:
+                if not entry.get("id") or not entry.get("title"):
+                    continue
+
+                self.results.append(
+                    {
+                        "url": f"https://www.youtube.com/watch?v={entry.get('id')}",
+                        "title": entry.get("track")
+                        or entry.get("title")
+                        or "Unknown",
+                    }
+                )
+
+                if len(self.results) >= 20:
+                    break
+
+            return bool(self.results)
 
         except Exception as e:
             print(f"Error during search: {e}")
@@ -66,3 +79,110 @@ class Search:
             str: JSON string of results
         """
         return json.dumps(self.results, indent=2)
+
+
+class Playlist:
+    __ytdl = YoutubeDLPool(
+        {
+            "quiet": True,
+            "extract_flat": "in_playlist",
+            "skip_download": True,
+            "playlistend": PLAYLIST_LIMIT,
+        },
+        2,
+    )
+
+    def __init__(self, url: str):
+        """
+        Holds links to songs of a playlist, read with one flat
+        extraction, without visiting every song
+
+        Raises:
+            Exception: link is not a playlist or can not be read
+        """
+        self.url = url
+        info = Playlist.__ytdl.run(
+            lambda ydl: ydl.extract_info(url, download=False)
+        )
+        if "entries" not in info:
+            raise Exception("Link is not a playlist")
+        self.title: str = info.get("title") or "Unknown"
+        self.links: List[str] = [
+            entry.get("url") or entry.get("webpage_url")
+            for entry in info["entries"]
+            if entry and (entry.get("url") or entry.get("webpage_url"))
+        ][:PLAYLIST_LIMIT]
+
+
+class SearchCache:
+    """
+    Searches in background threads and keeps results of recent
+    queries, so popular ones are answered right away. Identical
+    queries searched at the same time share one search <br>
+    Usage: <br>
+        - Create cache: c = SearchCache() <br>
+        - Get future of results via c.submit()
+    """
+
+    __executor = futures.ThreadPoolExecutor(4)
+
+    def __init__(self, size: int = 1024, ttl: float = 3600):
+        """
+        Args:
+            size (int): number of queries kept, least recently used
+            are dropped first
+            ttl (float): seconds results are kept for
+        """
+        self.size = size
+        self.ttl = ttl
+        self.__lock = Lock()
+        self.__results: OrderedDict[str, Tuple[float, List[dict]]] = (
+            OrderedDict()
+        )
+        self.__flights = SingleFlight(SearchCache.__executor)
+
+    @staticmethod
+    def normalize(query: str) -> str:
+        return " ".join(query.lower().split())
+
+    def get_cached(self, query: str) -> Optional[List[dict]]:
+        """
+        Returns results of query searched recently, None if there are
+        none or they expired
+        """
+        key = SearchCache.normalize(query)
+        with self.__lock:
+            entry = self.__results.get(key)
+            if entry is None:
+                return None
+            expires, results = entry
+            if expires < time.time():
+                del self.__results[key]
+                return None
+            self.__results.move_to_end(key)
+            return results
+
+    def submit(self, query: str) -> futures.Future:
+        """
+        Returns future of query results, already resolved for
+        cached queries
+        """
+        results = self.get_cached(query)
+        if results is not None:
+            future: futures.Future = futures.Future()
+            future.set_result(results)
+            return future
+        key = SearchCache.normalize(query)
+        return self.__flights.submit(key, self.__search, key)
+
+    def __search(self, key: str) -> List[dict]:
+        results = Search(key).results
+        # failed searches are retried on next request
+        if not results:
+            return results
+        with self.__lock:
+            self.__results[key] = (time.time() + self.ttl, results)
+            self.__results.move_to_end(key)
+            while len(self.__results) > self.size:
+                self.__results.popitem(last=False)
+        return results
@@ -0,0 +1,591 @@
+import multiprocessing
+import os
+import shutil
+import struct
+import tempfile
+import time
+from concurrent import futures
+from threading import Lock
+from typing import Dict, List, Optional, Tuple, Union
+
+import torch
+from demucs.apply import apply_model
+from demucs.audio import AudioFile, convert_audio
+from demucs.pretrained import get_model
+
+MODEL_NAME = "htdemucs"
+STEM = "vocals"
+# streaming mode works on segments of this length, which bounds
+# peak memory no matter how long the track is
+SEGMENT_SECONDS = 30.0
+# first segment is shorter, so beginning of the song can be
+# played back while the rest is still being separated
+FIRST_SEGMENT_SECONDS = 10.0
+# segments are separated with this much context on each side
+# and crossfaded over it when stitched back together
+OVERLAP_SECONDS = 2.0
+WAV_HEADER_SIZE = 44
+# file in song directory that stops its separation after the segment
+# being separated, so songs nobody waits for do not take a worker
+CANCEL_FILE = ".cancel"
+
+
+class Cancelled(Exception):
+    """
+    Raised when separation is stopped by cancel file
+    """
+
+
+class StemWriter:
+    """
+    Writes stem as 16 bit PCM wav incrementally, chunk by chunk.
+    Lossless stems are encoded to requested formats only on demand <br>
+    File is written under .part suffix and renamed when closed,
+    so only complete stems appear under their final names
+    """
+
+    def __init__(self, path: str, samplerate: int, channels: int):
+        self.path = path
+        self.__part = f"{path}.part"
+        self.__samplerate = samplerate
+        self.__channels = channels
+        self.__size = 0
+        with open(self.__part, "wb") as file:
+            file.write(self.__header())
+
+    def write(self, wav: torch.Tensor):
+        """
+        Appends waveform of shape (channels, samples) to the stem
+        """
+        pcm = (wav.clamp(-1, 1) * (2**15 - 1)).short()
+        data = pcm.t().contiguous().cpu().numpy().tobytes()
+        with open(self.__part, "ab") as file:
+            file.write(data)
+        self.__size += len(data)
+
+    def close(self):
+        # sizes in header are known only now
+        with open(self.__part, "r+b") as file:
+            file.write(self.__header())
+        os.replace(self.__part, self.path)
+
+    def discard(self):
+        """
+        Removes unfinished stem
+        """
+        if os.path.exists(self.__part):
+            os.remove(self.__part)
+
+    def __header(self) -> bytes:
+        block = self.__channels * 2
+        return struct.pack(
+            "<4sI4s4sIHHIIHH4sI",
+            b"RIFF",
+            WAV_HEADER_SIZE - 8 + self.__size,
+            b"WAVE",
+            b"fmt ",
+            16,
+            1,
+            self.__channels,
+            self.__samplerate,
+            self.__samplerate * block,
+            block,
+            16,
+            b"data",
+            self.__size,
+        )
+
+
+def read_wav_header(header: bytes) -> Tuple[int, int]:
+    """
+    Reads stem format from header written by StemWriter
+
+    Returns:
+        tuple: (samplerate, channels)
+    """
+    fields = struct.unpack("<4sI4s4sIHHIIHH4sI", header)
+    return fields[7], fields[6]
+
+
+class Separator:
+    """
+    Keeps a Demucs model resident in memory and splits songs into
+    vocals and accompaniment <br>
+    Usage: <br>
+        - Create separator once: s = Separator() <br>
+        - Separate songs on demand via s.separate()
+    """
+
+    def __init__(
+        self,
+        device: Optional[str] = None,
+        warmup: bool = False,
+    ):
+        """
+        Loads model weights, which is the expensive part of separation,
+        so it happens only once per separator
+        """
+        self.device = device or (
+            "cuda" if torch.cuda.is_available() else "cpu"
+        )
+        self.__model = get_model(MODEL_NAME)
+        self.__model.to(self.device)
+        self.__model.eval()
+        self.__lock = Lock()
+
+        if warmup:
+            self.warmup()
+
+    @property
+    def samplerate(self) -> int:
+        return self.__model.samplerate
+
+    @property
+    def channels(self) -> int:
+        return self.__model.audio_channels
+
+    def warmup(self, seconds: float = 1.0):
+        """
+        Runs model on a short noise clip, so lazy initialization
+        is not paid by the first real song
+        """
+        wav = torch.randn(self.channels, int(seconds * self.samplerate))
+        self.__separate(wav * 1e-3)
+
+    def load(self, path: str) -> torch.Tensor:
+        """
+        Decodes audio file into waveform expected by the model
+
+        Returns:
+            torch.Tensor: waveform of shape (channels, samples)
+        """
+        return AudioFile(path).read(
+            streams=0,
+            samplerate=self.samplerate,
+            channels=self.channels,
+        )
+
+    def separate(
+        self,
+        source: Union[str, torch.Tensor],
+        out_dir: str,
+        samplerate: Optional[int] = None,
+    ) -> Dict[str, str]:
+        """
+        Splits a song into stems and writes them to
+        out_dir/htdemucs/audio, same layout as demucs cli
+
+        Args:
+            source (str|torch.Tensor): path to audio file or waveform
+            of shape (channels, samples)
+            out_dir (str): song directory
+            samplerate (int): sample rate of waveform, model's one
+            is assumed if not given
+
+        Returns:
+            dict: stem name -> path of written file
+        """
+        if isinstance(source, str):
+            wav = self.load(source)
+        else:
+            wav = convert_audio(
+                source,
+                samplerate or self.samplerate,
+                self.samplerate,
+                self.channels,
+            )
+
+        stems = self.__separate(wav)
+        return self.__save(stems, Separator.get_stems_dir(out_dir))
+
+    def separate_stream(
+        self,
+        path: str,
+        out_dir: str,
+        duration: Optional[float] = None,
+        segment: float = SEGMENT_SECONDS,
+        overlap: float = OVERLAP_SECONDS,
+    ) -> Dict[str, str]:
+        """
+        Bounded memory version of separate for long tracks.
+        Decodes and separates input in overlapping segments, stitches
+        them with overlap-add and writes stems as it goes, so peak
+        memory depends only on segment length.
+        Stems are appended in time order, so their .part files can be
+        streamed to clients while separation is still running
+
+        Args:
+            path (str): path to audio file
+            out_dir (str): song directory
+            duration (float): track length in seconds, if known
+            segment (float): seconds separated at once
+            overlap (float): seconds of context on each segment side
+
+        Returns:
+            dict: stem name -> path of written file
+
+        Raises:
+            Cancelled: cancel file appeared in song directory
+        """
+        stems_dir = Separator.get_stems_dir(out_dir)
+        os.makedirs(stems_dir, exist_ok=True)
+        writers = {
+            name: StemWriter(
+                os.path.join(stems_dir, f"{name}.wav"),
+                self.samplerate,
+                self.channels,
+            )
+            for name in (STEM, f"no_{STEM}")
+        }
+
+        audio = AudioFile(path)
+        length = int(segment * self.samplerate)
+        first = int(
+            min(segment, FIRST_SEGMENT_SECONDS) * self.samplerate
+        )
+        context = int(overlap * self.samplerate)
+        # consecutive segments share 2 * context samples, which
+        # are crossfaded linearly when stitched together
+        fade_in = torch.linspace(0, 1, 2 * context)
+        fade_out = 1 - fade_in
+        tail: Dict[str, torch.Tensor] = {}
+
+        start = 0
+        while duration is None or start < duration * self.samplerate:
+            if Separator.is_cancelled(out_dir):
+                for writer in writers.values():
+                    writer.discard()
+                os.remove(os.path.join(out_dir, CANCEL_FILE))
+                raise Cancelled(f"Separation of {out_dir} cancelled")
+            size = first if start == 0 else length
+            begin = max(0, start - context)
+            wanted = start + size + context - begin
+            wav = audio.read(
+                seek_time=begin / self.samplerate,
+                duration=wanted / self.samplerate,
+                streams=0,
+                samplerate=self.samplerate,
+                channels=self.channels,
+            )[..., :wanted]
+            if wav.shape[-1] == 0:
+                break
+            last = wav.shape[-1] < wanted
+
+            stems = self.__separate(wav)
+            rest = {}
+            for name, stem in stems.items():
+                offset = 0
+                if tail:
+                    head = stem[..., : 2 * context]
+                    offset = head.shape[-1]
+                    writers[name].write(
+                        tail[name][..., :offset] * fade_out[:offset]
+                        + head * fade_in[:offset]
+                    )
+                end = stem.shape[-1] - (0 if last else 2 * context)
+                writers[name].write(stem[..., offset:end])
+                rest[name] = stem[..., end:]
+
+            tail = rest
+            if last:
+                break
+            start += size
+
+        # track ended exactly where last segment did
+        for name, rest in tail.items():
+            writers[name].write(rest)
+        for writer in writers.values():
+            writer.close()
+        return {name: writer.path for name, writer in writers.items()}
+
+    def __separate(self, wav: torch.Tensor) -> Dict[str, torch.Tensor]:
+        """
+        Runs inference on normalized waveform
+
+        Returns:
+            dict: two stems, vocals and everything else
+        """
+        ref = wav.mean(0)
+        mean = ref.mean()
+        std = ref.std()
+        if std == 0:
+            std = torch.tensor(1.0)
+        wav = (wav - mean) / std
+
+        with self.__lock, torch.no_grad():
+            sources = apply_model(
+                self.__model,
+                wav[None],
+                device=self.device,
+                shifts=1,
+                split=True,
+                overlap=0.25,
+                progress=False,
+            )[0]
+        sources = sources * std + mean
+
+        index = self.__model.sources.index(STEM)
+        vocals = sources[index]
+        no_vocals = sources.sum(0) - vocals
+        return {STEM: vocals, f"no_{STEM}": no_vocals}
+
+    def __save(
+        self, stems: Dict[str, torch.Tensor], stems_dir: str
+    ) -> Dict[str, str]:
+        os.makedirs(stems_dir, exist_ok=True)
+        paths = {}
+        for name, wav in stems.items():
+            # whole stem is known, so it can be rescaled to avoid
+            # clipping instead of being clamped like in stream mode
+            wav = wav / max(1.01 * wav.abs().max().item(), 1)
+            writer = StemWriter(
+                os.path.join(stems_dir, f"{name}.wav"),
+                self.samplerate,
+                self.channels,
+            )
+            writer.write(wav)
+            writer.close()
+            paths[name] = writer.path
+        return paths
+
+    @staticmethod
+    def cancel(path: str):
+        """
+        Asks separation of song stored in path to stop
+        """
+        open(os.path.join(path, CANCEL_FILE), "w").close()
+
+    @staticmethod
+    def is_cancelled(path: str) -> bool:
+        return os.path.exists(os.path.join(path, CANCEL_FILE))
+
+    @staticmethod
+    def get_stems_dir(path: str) -> str:
+        """
+        Returns directory with stems of song stored in path
+        """
+        return os.path.join(path, MODEL_NAME, "audio")
+
+    @staticmethod
+    def get_stem_path(path: str, stem: str) -> str:
+        """
+        Returns path of lossless stem of song stored in path
+        """
+        return os.path.join(
+            Separator.get_stems_dir(path), f"{stem}.wav"
+        )
+
+
+# separator living in a pool worker process, see SeparatorPool
+_worker_separator: Optional[Separator] = None
+
+
+def _init_worker(
+    cores: List[int], threads: int, warmup: bool, device: str
+):
+    """
+    Pins worker process to its slice of cores and loads the model
+    on its device
+    """
+    global _worker_separator
+    if cores and hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, cores)
+    torch.set_num_threads(threads)
+    torch.set_num_interop_threads(1)
+    _worker_separator = Separator(device=device, warmup=warmup)
+
+
+def _start_worker():
+    """
+    Does nothing, submitting it makes executor start its process
+    """
+
+
+def _run_in_worker(method: str, *args) -> Dict[str, str]:
+    assert _worker_separator is not None
+    return getattr(_worker_separator, method)(*args)
+
+
+def get_devices(device: Optional[str] = None) -> List[str]:
+    """
+    Returns devices separation workers take turns on: every GPU
+    for "cuda", the one given for e.g. "cuda:1" or "cpu", and every
+    GPU or cpu when nothing is given
+    """
+    if device is None:
+        device = "cuda" if torch.cuda.is_available() else "cpu"
+    gpus = torch.cuda.device_count() if device == "cuda" else 0
+    return [f"cuda:{i}" for i in range(gpus)] or [device]
+
+
+def get_cores() -> List[int]:
+    """
+    Returns cores this process is allowed to run on
+    """
+    if hasattr(os, "sched_getaffinity"):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(multiprocessing.cpu_count()))
+
+
+class SeparatorPool:
+    """
+    Pool of separation worker processes, each one with its own
+    resident model, slice of cores and torch thread count, so songs
+    are separated in parallel without torch threads fighting
+    each other and the api. With several GPUs workers are spread
+    over them, one worker per GPU is usually fastest <br>
+    Usage: <br>
+        - Create pool: p = SeparatorPool(workers=2, threads=4) <br>
+        - Separate songs via p.separate() or p.submit()
+    """
+
+    def __init__(
+        self,
+        workers: int = 1,
+        threads: Optional[int] = None,
+        warmup: bool = False,
+        device: Optional[str] = None,
+    ):
+        """
+        Args:
+            workers (int): number of separation processes
+            threads (int): torch threads per process, defaults to
+            even split of available cores
+            warmup (bool): run model once in every worker on startup
+            device (str): cpu, cuda (every GPU) or cuda:N, GPUs are
+            used when available by default
+        """
+        cores = get_cores()
+        devices = get_devices(device)
+        self.workers = max(1, workers)
+        self.threads = threads or max(1, len(cores) // self.workers)
+        self.devices = [
+            devices[i % len(devices)] for i in range(self.workers)
+        ]
+
+        context = multiprocessing.get_context("spawn")
+        self.__executors = []
+        for i in range(self.workers):
+            start = i * self.threads
+            slot = [
+                cores[(start + j) % len(cores)]
+                for j in range(self.threads)
+            ]
+            self.__executors.append(
+                futures.ProcessPoolExecutor(
+                    1,
+                    mp_context=context,
+                    initializer=_init_worker,
+                    initargs=(
+                        slot,
+                        self.threads,
+                        warmup,
+                        self.devices[i],
+                    ),
+                )
+            )
+        self.__load = [0] * self.workers
+        self.__lock = Lock()
+        # executors start processes on first submit, models are loaded
+        # and warmed up now instead of when first song comes in
+        for executor in self.__executors:
+            executor.submit(_start_worker)
+
+    def submit(self, method: str, *args) -> futures.Future:
+        """
+        Queues call of Separator method on the least busy worker
+
+        Returns:
+            Future: resolves to dict of stem name -> path
+        """
+        with self.__lock:
+            index = self.__load.index(min(self.__load))
+            self.__load[index] += 1
+
+        def release(_):
+            with self.__lock:
+                self.__load[index] -= 1
+
+        worker = self.__executors[index].submit(
+            _run_in_worker, method, *args
+        )
+        worker.add_done_callback(release)
+        return worker
+
+    def separate(
+        self,
+        source: Union[str, torch.Tensor],
+        out_dir: str,
+        samplerate: Optional[int] = None,
+    ) -> Dict[str, str]:
+        """
+        Same as Separator.separate, but runs in a worker process
+        """
+        return self.submit(
+            "separate", source, out_dir, samplerate
+        ).result()
+
+    def separate_stream(
+        self,
+        path: str,
+        out_dir: str,
+        duration: Optional[float] = None,
+    ) -> Dict[str, str]:
+        """
+        Same as Separator.separate_stream, but runs in a worker process
+        """
+        return self.submit(
+            "separate_stream", path, out_dir, duration
+        ).result()
+
+    def shutdown(self):
+        for executor in self.__executors:
+            executor.shutdown()
+
+    @staticmethod
+    def autotune(seconds: float = 10.0) -> Tuple[int, int]:
+        """
+        Tries a few workers x threads splits of available cores on
+        a synthetic clip on cpu and picks the one with most songs
+        per hour
+
+        Returns:
+            tuple: (workers, threads)
+        """
+        cores = len(get_cores())
+        splits = []
+        workers = 1
+        while workers <= cores:
+            splits.append((workers, cores // workers))
+            workers *= 2
+
+        best, best_rate = splits[0], 0.0
+        clip = torch.randn(2, int(seconds * 44100)) * 0.1
+        out_dir = tempfile.mkdtemp(prefix="autotune")
+        for workers, threads in splits:
+            pool = SeparatorPool(workers, threads, device="cpu")
+            try:
+                # first round only loads models in every worker
+                for runs in (1, 2):
+                    start = time.time()
+                    jobs = [
+                        pool.submit(
+                            "separate", clip, f"{out_dir}/{i}", 44100
+                        )
+                        for i in range(workers * runs)
+                    ]
+                    for job in jobs:
+                        job.result()
+                rate = len(jobs) * 3600 / (time.time() - start)
+            except Exception as e:
+                print(f"autotune {workers}x{threads}: {e!s}")
+                continue
+            finally:
+                pool.shutdown()
+
+            print(f"autotune {workers}x{threads}: {rate:.0f} clips/h")
+            if rate > best_rate:
+                best, best_rate = (workers, threads), rate
+
+        shutil.rmtree(out_dir, True)
+        return best
@@ -0,0 +1,54 @@
+from concurrent import futures
+from threading import Lock
+from typing import Callable, Dict, Optional
+
+
+class SingleFlight:
+    """
+    Runs at most one job per key at a time, callers asking for a key
+    that is already in flight get the future of the running job
+    instead of starting another one <br>
+    Usage: <br>
+        - Create registry: f = SingleFlight(executor) <br>
+        - Start or join jobs via f.submit()
+    """
+
+    def __init__(self, executor: futures.Executor):
+        """
+        Args:
+            executor (Executor): executor running the jobs
+        """
+        self.__executor = executor
+        self.__lock = Lock()
+        self.__flights: Dict[str, futures.Future] = {}
+
+    def submit(
+        self, key: str, function: Callable, *args
+    ) -> futures.Future:
+        """
+        Starts function unless a job for key is already running
+
+        Returns:
+            Future: future of the job running for key
+        """
+        with self.__lock:
+            future = self.__flights.get(key)
+            if future is not None:
+                return future
+            future = self.__executor.submit(function, *args)
+            self.__flights[key] = future
+        # outside of the lock, finished future calls back right away
+        future.add_done_callback(lambda _: self.__land(key, future))
+        return future
+
+    def get(self, key: str) -> Optional[futures.Future]:
+        """
+        Returns future of job running for key, None if there is none
+        """
+        with self.__lock:
+            return self.__flights.get(key)
+
+    def __land(self, key: str, future: futures.Future):
+        with self.__lock:
+            if self.__flights.get(key) is future:
+                del self.__flights[key]
@@ -0,0 +1,436 @@
+import heapq
+import os
+import shutil
+import sqlite3
+import time
+from threading import Event, Lock, Thread
+from typing import Callable, Dict, List, Optional, Tuple
+
+from download import DOWNLOADS_PATH, Download
+from separator import STEM, Separator
+
+CATALOG_FILE = "catalog.db"
+
+
+def get_dir_size(path: str) -> int:
+    """
+    Returns size of all files inside directory in bytes
+    """
+    size = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                size += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                continue
+    return size
+
+
+class Store:
+    """
+    Persistent catalog of songs kept in downloads directory, so they
+    survive restarts and are evicted only when disk budget runs out,
+    least recently used first <br>
+    Usage: <br>
+        - Create store: s = Store(budget) <br>
+        - Register songs via s.add(), s.touch() and s.set_done() <br>
+        - Free space via s.over_budget() and s.remove()
+    """
+
+    def __init__(
+        self,
+        budget: int = 10 * 1024**3,
+        path: str = DOWNLOADS_PATH,
+        is_active: Optional[Callable[[str], bool]] = None,
+    ):
+        """
+        Opens catalog and makes it match what actually is on disk
+
+        Args:
+            budget (int): bytes all songs can take together
+            path (str): downloads directory
+            is_active (callable): tells if song is being processed
+            by some worker, its files are never removed as incomplete
+        """
+        self.budget = budget
+        self.path = path
+        self.__is_active = is_active or (lambda song_id: False)
+        os.makedirs(path, exist_ok=True)
+
+        self.__lock = Lock()
+        self.__db = sqlite3.connect(
+            os.path.join(path, CATALOG_FILE), check_same_thread=False
+        )
+        self.__db.execute("PRAGMA journal_mode=WAL")
+        self.__db.execute(
+            """
+            CREATE TABLE IF NOT EXISTS songs (
+                song_id TEXT PRIMARY KEY,
+                size INTEGER NOT NULL DEFAULT 0,
+                created REAL NOT NULL,
+                last_access REAL NOT NULL,
+                done INTEGER NOT NULL DEFAULT 0
+            )
+            """
+        )
+        self.__db.execute(
+            """
+            CREATE TABLE IF NOT EXISTS fingerprints (
+                song_id TEXT PRIMARY KEY,
+                duration REAL NOT NULL,
+                fingerprint BLOB NOT NULL
+            )
+            """
+        )
+        self.__db.execute(
+            """
+            CREATE INDEX IF NOT EXISTS fingerprints_duration
+            ON fingerprints (duration)
+            """
+        )
+        self.__db.commit()
+        self.rebuild()
+
+    def rebuild(self) -> int:
+        """
+        Validates catalog against downloads directory. Drops entries
+        of deleted songs, deletes songs interrupted before their audio
+        got downloaded, unless some worker is still downloading them,
+        and adds songs missing from catalog.
+        Songs with unfinished separation are separated again on request
+
+        Returns:
+            int: Number of songs in catalog
+        """
+        on_disk = {}
+        for song_id in os.listdir(self.path):
+            song_dir = os.path.join(self.path, song_id)
+            if not os.path.isdir(song_dir):
+                continue
+            if not Download.has_audio(song_dir):
+                # downloads directory is shared by all workers
+                if not self.__is_active(song_id):
+                    print(f"removing incomplete song {song_id}")
+                    shutil.rmtree(song_dir, True)
+                continue
+            on_disk[song_id] = song_dir
+
+        with self.__lock:
+            known = {
+                row[0]
+                for row in self.__db.execute(
+                    "SELECT song_id FROM songs"
+                )
+            }
+            for table in ("songs", "fingerprints"):
+                self.__db.executemany(
+                    f"DELETE FROM {table} WHERE song_id = ?",
+                    [(song_id,) for song_id in known - on_disk.keys()],
+                )
+            # size and state are taken from disk, access times of songs
+            # already in catalog are kept
+            now = time.time()
+            self.__db.executemany(
+                """
+                INSERT INTO songs (song_id, size, created, last_access, done)
+                VALUES (?, ?, ?, ?, ?)
+                ON CONFLICT (song_id) DO UPDATE
+                SET size = excluded.size, done = excluded.done
+                """,
+                [
+                    (
+                        song_id,
+                        get_dir_size(song_dir),
+                        now,
+                        now,
+                        os.path.exists(
+                            Separator.get_stem_path(song_dir, STEM)
+                        ),
+                    )
+                    for song_id, song_dir in on_disk.items()
+                ],
+            )
+            self.__db.commit()
+        return len(on_disk)
+
+    def add(self, song_id: str):
+        """
+        Registers song that is about to be processed
+        """
+        now = time.time()
+        with self.__lock:
+            self.__db.execute(
+                """
+                INSERT INTO songs (song_id, created, last_access)
+                VALUES (?, ?, ?)
+                ON CONFLICT (song_id) DO UPDATE SET last_access = ?
+                """,
+                (song_id, now, now, now),
+            )
+            self.__db.commit()
+
+    def touch(self, song_id: str):
+        """
+        Marks song as recently used, so it is evicted last
+        """
+        with self.__lock:
+            self.__db.execute(
+                "UPDATE songs SET last_access = ? WHERE song_id = ?",
+                (time.time(), song_id),
+            )
+            self.__db.commit()
+
+    def set_done(self, song_id: str):
+        """
+        Marks song as processed and records its size on disk
+        """
+        size = get_dir_size(os.path.join(self.path, song_id))
+        with self.__lock:
+            self.__db.execute(
+                "UPDATE songs SET done = 1, size = ? WHERE song_id = ?",
+                (size, song_id),
+            )
+            self.__db.commit()
+
+    def is_done(self, song_id: str) -> bool:
+        """
+        Tells if song was processed, possibly before restart
+        """
+        with self.__lock:
+            row = self.__db.execute(
+                "SELECT done FROM songs WHERE song_id = ?", (song_id,)
+            ).fetchone()
+        return row is not None and bool(row[0])
+
+    def touch_many(self, accesses: Dict[str, float]):
+        """
+        Saves access times collected in memory in one transaction
+        """
+        with self.__lock:
+            self.__db.executemany(
+                "UPDATE songs SET last_access = ? WHERE song_id = ?",
+                [(at, song_id) for song_id, at in accesses.items()],
+            )
+            self.__db.commit()
+
+    def get_access_times(self) -> Dict[str, float]:
+        """
+        Returns last access time of every processed song
+        """
+        with self.__lock:
+            return dict(
+                self.__db.execute(
+                    "SELECT song_id, last_access FROM songs WHERE done = 1"
+                )
+            )
+
+    def over_budget(self) -> List[str]:
+        """
+        Returns least recently used processed songs that have to be
+        deleted for the rest to fit in disk budget
+        """
+        with self.__lock:
+            total = self.__db.execute(
+                "SELECT COALESCE(SUM(size), 0) FROM songs"
+            ).fetchone()[0]
+            if total <= self.budget:
+                return []
+            candidates = self.__db.execute(
+                """
+                SELECT song_id, size FROM songs
+                WHERE done = 1 ORDER BY last_access
+                """
+            ).fetchall()
+
+        songs = []
+        for song_id, size in candidates:
+            if total <= self.budget:
+                break
+            total -= size
+            songs.append(song_id)
+        return songs
+
+    def remove(self, song_id: str):
+        """
+        Deletes song from disk and catalog
+        """
+        shutil.rmtree(os.path.join(self.path, song_id), True)
+        with self.__lock:
+            for table in ("songs", "fingerprints"):
+                self.__db.execute(
+                    f"DELETE FROM {table} WHERE song_id = ?", (song_id,)
+                )
+            self.__db.commit()
+
+    def add_fingerprint(
+        self, song_id: str, duration: float, fingerprint: bytes
+    ):
+        """
+        Saves acoustic fingerprint of downloaded song
+        """
+        with self.__lock:
+            self.__db.execute(
+                """
+                INSERT OR REPLACE INTO fingerprints
+                (song_id, duration, fingerprint) VALUES (?, ?, ?)
+                """,
+                (song_id, duration, fingerprint),
+            )
+            self.__db.commit()
+
+    def has_fingerprint(self, song_id: str) -> bool:
+        """
+        Tells if song was fingerprinted already
+        """
+        with self.__lock:
+            row = self.__db.execute(
+                "SELECT 1 FROM fingerprints WHERE song_id = ?",
+                (song_id,),
+            ).fetchone()
+        return row is not None
+
+    def find_fingerprints(
+        self, song_id: str, duration: float, tolerance: float
+    ) -> List[Tuple[str, bytes]]:
+        """
+        Returns fingerprints of other processed songs of similar
+        duration, the only ones that can be the same song
+
+        Returns:
+            list: (song id, fingerprint) pairs
+        """
+        with self.__lock:
+            return self.__db.execute(
+                """
+                SELECT f.song_id, f.fingerprint FROM fingerprints f
+                JOIN songs s ON s.song_id = f.song_id
+                WHERE s.done = 1 AND f.song_id != ?
+                AND f.duration BETWEEN ? AND ?
+                """,
+                (song_id, duration - tolerance, duration + tolerance),
+            ).fetchall()
+
+
+class Reaper:
+    """
+    Evicts songs in background, so request handling never waits for
+    filesystem deletes. Accesses are recorded in memory and idle
+    expiry is tracked in a heap, so recording one is O(log n) <br>
+    Usage: <br>
+        - Create reaper: r = Reaper(store, on_evict) <br>
+        - Record accesses via r.touch()
+    """
+
+    def __init__(
+        self,
+        store: Store,
+        on_evict: Callable[[str], None],
+        max_idle: Optional[float] = None,
+        interval: float = 5.0,
+        deletes_per_second: float = 2.0,
+    ):
+        """
+        Args:
+            store (Store): catalog of songs to evict from
+            on_evict (callable): called with id of every deleted song
+            max_idle (float): seconds after which not accessed song
+            is evicted even when within budget, never if None
+            interval (float): seconds between eviction rounds
+            deletes_per_second (float): limit of deleted songs, so
+            deletes do not starve downloads and separation of disk
+        """
+        self.__store = store
+        self.__on_evict = on_evict
+        self.__max_idle = max_idle
+        self.__interval = interval
+        self.__delay = 1 / deletes_per_second
+
+        self.__lock = Lock()
+        self.__access = store.get_access_times()
+        self.__pending: Dict[str, float] = {}
+        # (expiration time, song id), entries made stale by later
+        # accesses are skipped when popped
+        self.__heap: List[Tuple[float, str]] = []
+        if max_idle:
+            self.__heap = [
+                (at + max_idle, song_id)
+                for song_id, at in self.__access.items()
+            ]
+            heapq.heapify(self.__heap)
+
+        self.__stopped = Event()
+        self.__thread = Thread(target=self.__run, daemon=True)
+        self.__thread.start()
+
+    def touch(self, song_id: str):
+        """
+        Records access of a song
+        """
+        now = time.time()
+        with self.__lock:
+            self.__access[song_id] = now
+            self.__pending[song_id] = now
+            if self.__max_idle:
+                heapq.heappush(
+                    self.__heap, (now + self.__max_idle, song_id)
+                )
+
+    def stop(self):
+        self.__stopped.set()
+        self.__thread.join()
+
+    def __run(self):
+        while not self.__stopped.wait(self.__interval):
+            try:
+                self.__reap()
+            except Exception as e:
+                print(f"reaper: {e!s}")
+
+    def __reap(self) -> int:
+        """
+        Saves recorded accesses, then deletes expired songs and
+        songs over budget
+
+        Returns:
+            int: Number of deleted songs
+        """
+        with self.__lock:
+            pending, self.__pending = self.__pending, {}
+        if pending:
+            self.__store.touch_many(pending)
+
+        deleted = 0
+        for song_id in self.__pop_expired():
+            deleted += self.__evict(song_id)
+        for song_id in self.__store.over_budget():
+            deleted += self.__evict(song_id)
+        return deleted
+
+    def __pop_expired(self) -> List[str]:
+        if not self.__max_idle:
+            return []
+        idle = self.__max_idle
+        now = time.time()
+        expired = []
+        with self.__lock:
+            while self.__heap and self.__heap[0][0] <= now:
+                _, song_id = heapq.heappop(self.__heap)
+                last_access = self.__access.get(song_id)
+                # song accessed since this entry was pushed
+                # has a later one in the heap
+                if last_access is None or last_access + idle > now:
+                    continue
+                expired.append(song_id)
+        return expired
+
+    def __evict(self, song_id: str) -> int:
+        if not self.__store.is_done(song_id):
+            return 0
+        with self.__lock:
+            self.__access.pop(song_id, None)
+            self.__pending.pop(song_id, None)
+        self.__store.remove(song_id)
+        self.__on_evict(song_id)
+        print(f"evicted {song_id}")
+        time.sleep(self.__delay)
+        return 1
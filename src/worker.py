@@ -0,0 +1,21 @@
+import asyncio
+
+# compute node: processes songs queued by API workers started with
+# PROCESS_SONGS=0, configured by the same environment variables
+
+
+async def main():
+    # separation and alignment workers are spawned, so they import
+    # this module again, pipeline must not be built when they do
+    from api_routes import pipeline
+
+    pipeline.start()
+    print(f"worker {pipeline.owner} is processing songs")
+    try:
+        await asyncio.Event().wait()
+    finally:
+        pipeline.stop()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
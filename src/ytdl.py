@@ -0,0 +1,156 @@
+import contextlib
+import queue
+import re
+import time
+from threading import Lock
+from typing import Callable, Dict, Iterator, Optional, TypeVar
+
+import yt_dlp  # type: ignore
+
+# field of info dict that tells downloads apart, shared instances can
+# not have per download options, so it is used in their templates
+KEY_FIELD = "karaioke_id"
+# errors YouTube answers with when asked too often
+THROTTLED = re.compile(
+    r"HTTP Error 429|Too Many Requests", re.IGNORECASE
+)
+
+T = TypeVar("T")
+
+
+class YoutubeDLPool:
+    """
+    Keeps configured YoutubeDL instances alive, so extractors, cookies
+    and HTTP connections are reused between searches and downloads.
+    Number of instances limits calls running at once, and throttling
+    by YouTube pauses every pool for a while, each further throttling
+    doubling the pause.
+    There is one pool per configuration (search, playlist, download):
+    YoutubeDL reads options like outtmpl, format and extract_flat
+    once, when it is created, so they can not be switched per call on
+    a shared instance. Separate pools also keep long downloads from
+    taking the instances searches need. yt-dlp calls running at once
+    in a process are bounded by the sum of pool sizes <br>
+    Usage: <br>
+        - Create pool: p = YoutubeDLPool(options, size) <br>
+        - Run yt-dlp via p.run(lambda ytdl: ytdl.extract_info(...))
+    """
+
+    # throttling applies to the whole process, not a single pool
+    __lock = Lock()
+    __paused_until = 0.0
+    __strikes = 0
+
+    def __init__(
+        self,
+        options: dict,
+        size: int = 4,
+        retries: int = 3,
+        backoff: float = 5.0,
+    ):
+        """
+        Args:
+            options (dict): YoutubeDL options of every instance
+            size (int): number of calls running at once
+            retries (int): times throttled call is repeated
+            backoff (float): seconds of the first pause
+        """
+        self.options = options
+        self.size = size
+        self.retries = retries
+        self.backoff = backoff
+        self.__hooks: Dict[str, Callable[[dict], None]] = {}
+        # idle instances and None for every slot without one,
+        # most recently used instances are lent first
+        self.__idle: queue.LifoQueue = queue.LifoQueue()
+        for _ in range(size):
+            self.__idle.put(None)
+
+    def run(self, call: Callable[[yt_dlp.YoutubeDL], T]) -> T:
+        """
+        Calls function with an idle instance, waits for one when all
+        of them are in use. Throttled calls are repeated after a pause
+        """
+        for attempt in range(self.retries + 1):
+            YoutubeDLPool.__wait()
+            try:
+                with self.__acquire() as ytdl:
+                    result = call(ytdl)
+            except yt_dlp.utils.DownloadError as e:
+                if attempt == self.retries or not THROTTLED.search(
+                    str(e)
+                ):
+                    raise
+                YoutubeDLPool.__pause(self.backoff)
+                continue
+            YoutubeDLPool.__recover()
+            return result
+        raise AssertionError("unreachable")
+
+    def watch(self, key: str, hook: Callable[[dict], None]):
+        """
+        Passes progress of download with given KEY_FIELD to hook
+        """
+        self.__hooks[key] = hook
+
+    def unwatch(self, key: str):
+        self.__hooks.pop(key, None)
+
+    def close(self):
+        """
+        Closes idle instances, saving their cookies
+        """
+        instances = []
+        while not self.__idle.empty():
+            instances.append(self.__idle.get_nowait())
+        for ytdl in instances:
+            if ytdl is not None:
+                ytdl.close()
+            self.__idle.put(None)
+
+    @contextlib.contextmanager
+    def __acquire(self) -> Iterator[yt_dlp.YoutubeDL]:
+        ytdl: Optional[yt_dlp.YoutubeDL] = self.__idle.get()
+        try:
+            if ytdl is None:
+                ytdl = yt_dlp.YoutubeDL(
+                    {
+                        **self.options,
+                        "progress_hooks": [self.__dispatch],
+                    }
+                )
+        except Exception:
+            self.__idle.put(None)
+            raise
+        try:
+            yield ytdl
+        finally:
+            self.__idle.put(ytdl)
+
+    def __dispatch(self, status: dict):
+        key = status.get("info_dict", {}).get(KEY_FIELD)
+        hook = self.__hooks.get(key)
+        if hook is not None:
+            hook(status)
+
+    @staticmethod
+    def __wait():
+        with YoutubeDLPool.__lock:
+            delay = YoutubeDLPool.__paused_until - time.time()
+        if delay > 0:
+            time.sleep(delay)
+
+    @staticmethod
+    def __pause(backoff: float):
+        with YoutubeDLPool.__lock:
+            delay = backoff * 2**YoutubeDLPool.__strikes
+            YoutubeDLPool.__strikes += 1
+            YoutubeDLPool.__paused_until = max(
+                YoutubeDLPool.__paused_until, time.time() + delay
+            )
+        print(f"throttled by YouTube, pausing for {delay:.1f}s")
+
+    @staticmethod
+    def __recover():
+        with YoutubeDLPool.__lock:
+            YoutubeDLPool.__strikes = 0
@@ -1,18 +1,40 @@
+import json
+import multiprocessing
 import os
 import re
 import shutil
 import time
 import unittest
+import wave
+from concurrent import futures
 from os.path import abspath
 from pathlib import Path
 from sys import argv, path
+from types import SimpleNamespace
+from unittest import mock
+
+import numpy as np
+import yt_dlp
 
 path.insert(0, abspath(Path(argv[0]) / "../.."))
 path.insert(0, abspath(Path(argv[0]) / "../../src"))
 
 from src.download import Download
-from src.engine import Engine
-from src.search import Search
+from src.engine import Engine, SeparatorPool
+from src.fingerprint import (
+    MATCH_THRESHOLD,
+    SAMPLERATE,
+    compute,
+    distance,
+    find_match,
+)
+from src.jobs import SqliteJobStore, get_owner
+from src.lyrics_cache import LyricsCache
+from src.native_aligner import align, banded_dtw, count_syllables
+from src.scheduler import FairQueue
+from src.search import Playlist, Search, SearchCache
+from src.separator import STEM, Separator
+from src.store import Reaper, Store
 
 
 class TestSearch(unittest.TestCase):
@@ -42,6 +64,48 @@ class TestSearch(unittest.TestCase):
                 )
             )
 
+    def test_search_cache(self):
+        """
+        Tests if identical concurrent queries share one search
+        and repeated ones are answered from cache
+        """
+        query = "Reverse Sound Effect - Copyright free sound effects"
+        cache = SearchCache()
+        with mock.patch.object(
+            Search,
+            "search_query",
+            autospec=True,
+            side_effect=Search.search_query,
+        ) as searches:
+            jobs = [cache.submit(query) for _ in range(8)]
+            results = [job.result() for job in jobs]
+            start = time.time()
+            cached = cache.submit(query.upper()).result()
+
+        self.assertLess(time.time() - start, 0.1)
+        self.assertEqual(searches.call_count, 1)
+        self.assertEqual(len(results[0]), 20)
+        for result in [*results, cached]:
+            self.assertEqual(result, results[0])
+
+    def test_playlist(self):
+        """
+        Tests if playlist is expanded into links of its songs and
+        link to a single song is rejected
+        """
+        query = "Reverse Sound Effect - Copyright free sound effects"
+        link = Search(query).results[0]["url"]
+        video_id = link.split("=")[-1]
+        playlist = Playlist(f"{link}&list=RD{video_id}")
+
+        self.assertGreater(len(playlist.links), 1)
+        self.assertEqual(
+            Download.get_song_id(playlist.links[0]),
+            Download.get_song_id(link),
+        )
+        with self.assertRaisesRegex(Exception, "not a playlist"):
+            Playlist(link)
+
 
 class TestDownload(unittest.TestCase):
     def test_song_download(self):
@@ -57,7 +121,7 @@ class TestDownload(unittest.TestCase):
         path = os.path.join("downloads", dir)
         self.assertTrue(os.path.isdir(path))
 
-        audio_path = os.path.join(path, "audio.mp3")
+        audio_path = Download.get_audio_path(path)
         self.assertTrue(os.path.isfile(audio_path))
 
         meta_path = os.path.join(path, "metadata.json")
@@ -66,6 +130,328 @@ class TestDownload(unittest.TestCase):
         self.assertGreaterEqual(os.path.getsize(audio_path), 128)
         self.assertGreaterEqual(os.path.getsize(meta_path), 32)
 
+    def test_playlist_link_download(self):
+        """
+        Tests if link to a video inside a playlist downloads just
+        the video, under the same song id as the video alone
+        """
+        query = "Reverse Sound Effect - Copyright free sound effects"
+        link = Search(query).results[0]["url"]
+        video_id = link.split("=")[-1]
+        dl = Download(f"{link}&list=RD{video_id}")
+        dl.wait_for()
+
+        self.assertEqual(dl.get_name(), Download.get_song_id(link))
+        path = os.path.join("downloads", dl.get_name())
+        self.assertTrue(os.path.isfile(Download.get_audio_path(path)))
+        with open(os.path.join(path, "metadata.json")) as file:
+            metadata = json.load(file)
+        # playlist info has no duration, video info does
+        self.assertIsNotNone(metadata["duration"])
+
+    def test_link_normalization(self):
+        """
+        Tests if different links to the same video share song id
+        """
+        song_id = Download.get_song_id(
+            "https://www.youtube.com/watch?v=dQw4w9WgXcQ"
+        )
+        for link in [
+            "https://youtu.be/dQw4w9WgXcQ",
+            "https://youtu.be/dQw4w9WgXcQ?t=30",
+            "https://www.youtube.com/watch?v=dQw4w9WgXcQ&t=30s",
+            "https://www.youtube.com/watch?list=PL0&v=dQw4w9WgXcQ",
+            "https://m.youtube.com/watch?v=dQw4w9WgXcQ",
+            "https://music.youtube.com/watch?v=dQw4w9WgXcQ",
+            "youtube.com/shorts/dQw4w9WgXcQ",
+        ]:
+            self.assertEqual(Download.get_song_id(link), song_id)
+
+        self.assertNotEqual(
+            Download.get_song_id("https://youtu.be/9bZkp7q19f0"),
+            song_id,
+        )
+
+
+class TestLyricsCache(unittest.TestCase):
+    def test_lyrics_caching(self):
+        """
+        Tests if lyrics are found under different spellings of a song
+        and misses expire
+        """
+        path = os.path.join("downloads", "test_lyrics_cache")
+        cache = LyricsCache(miss_ttl=0.5, path=path)
+        cache.put(
+            "Beyoncé", "Halo", "Remember those walls I built", "en"
+        )
+        self.assertEqual(
+            cache.get("beyonce", "Halo (Official Video)"),
+            ("Remember those walls I built", "en"),
+        )
+
+        cache.put("", "Unknown song", None)
+        self.assertEqual(cache.get("", "unknown song"), (None, None))
+        time.sleep(1)
+        self.assertIsNone(cache.get("", "unknown song"))
+
+        stats = cache.get_stats()
+        self.assertEqual(stats["hits"], 1)
+        self.assertEqual(stats["negative_hits"], 1)
+        self.assertEqual(stats["misses"], 1)
+
+        shutil.rmtree(path)
+
+
+def melody(seed: int, seconds: float = 30) -> np.ndarray:
+    """
+    Returns synthetic song of random quarter second notes
+    """
+    rng = np.random.default_rng(seed)
+    t = np.arange(int(0.25 * SAMPLERATE)) / SAMPLERATE
+    notes = [
+        sum(np.sin(2 * np.pi * f * k * t) / k for k in (1, 2, 3))
+        for f in rng.uniform(200, 1000, int(seconds * 4))
+    ]
+    return np.concatenate(notes) * 0.3
+
+
+class TestFingerprint(unittest.TestCase):
+    def test_match(self):
+        """
+        Tests if quieter copy of a song with longer intro and some
+        noise matches it and a different song does not
+        """
+        song = melody(1)
+        noise = np.random.default_rng(3).standard_normal(len(song))
+        copy = np.concatenate(
+            [np.zeros(int(1.7 * SAMPLERATE)), 0.5 * song + 0.01 * noise]
+        )
+        fingerprint = compute(song)
+        same = compute(copy)
+        other = compute(melody(2))
+
+        self.assertLess(distance(fingerprint, same), MATCH_THRESHOLD)
+        self.assertGreater(
+            distance(fingerprint, other), MATCH_THRESHOLD
+        )
+        self.assertEqual(
+            find_match(
+                fingerprint,
+                [("other", other.tobytes()), ("copy", same.tobytes())],
+            ),
+            "copy",
+        )
+        self.assertIsNone(
+            find_match(fingerprint, [("other", other.tobytes())])
+        )
+        # too short to be compared
+        self.assertEqual(distance(fingerprint, compute(song[:4096])), 1)
+
+
+def sing(path: str, lines: int, seed: int) -> list:
+    """
+    Writes synthetic vocals stem, a tone per syllable with pauses
+    between lines and an instrumental break, and returns
+    (start, text) of every line
+    """
+    rng = np.random.default_rng(seed)
+    samplerate = 16000
+    words = ["la", "lala", "banana", "do", "sing", "hey"]
+    audio = [np.zeros(2 * samplerate)]
+    position, reference = 2.0, []
+    for k in range(lines):
+        text = " ".join(rng.choice(words, rng.integers(3, 7)))
+        reference.append((position, text))
+        rate = rng.uniform(0.18, 0.3)
+        for _ in range(sum(count_syllables(w) for w in text.split())):
+            t = np.arange(int(rate * samplerate)) / samplerate
+            pitch = rng.uniform(200, 500)
+            audio.append(0.3 * np.sin(2 * np.pi * pitch * t))
+            audio.append(np.zeros(int(0.03 * samplerate)))
+            position += rate + 0.03
+        pause = 8.0 if k == lines // 2 else rng.uniform(0.4, 2.0)
+        audio.append(np.zeros(int(pause * samplerate)))
+        position += pause
+
+    samples = np.concatenate(audio)
+    samples += rng.normal(0, 0.003, len(samples))
+    with wave.open(path, "wb") as file:
+        file.setnchannels(1)
+        file.setsampwidth(2)
+        file.setframerate(samplerate)
+        file.writeframes((samples * 32767).astype(np.int16).tobytes())
+    return reference
+
+
+class TestNativeAligner(unittest.TestCase):
+    def test_banded_dtw(self):
+        """
+        Tests if template is matched with audio sung slower and
+        after a pause, within a band narrower than the song
+        """
+        template = np.array([0.0, 1, 1, 1, 0, 1, 1, 0])
+        audio = np.array(
+            [0.0, 0, 0, 1, 1, 1, 1, 1, 1, 0, 0, 1, 1, 1, 1, 0]
+        )
+        onset = np.zeros(len(template))
+        onset[[1, 5]] = 1
+        first, last = banded_dtw(
+            (template, onset), (audio, np.diff(audio, prepend=0)), 4
+        )
+        self.assertEqual(first[[1, 5]].tolist(), [3, 11])
+        self.assertTrue(np.all(np.diff(first) >= 0))
+        self.assertTrue(np.all(last >= first))
+        self.assertEqual(last[-1], len(audio) - 1)
+
+    def test_line_starts(self):
+        """
+        Tests if synthetic song's lines are found close to where
+        they start
+        """
+        path = os.path.join("downloads", "test_native_aligner")
+        os.makedirs(path, exist_ok=True)
+        vocals = os.path.join(path, "vocals.wav")
+        reference = sing(vocals, 12, 0)
+        text = os.path.join(path, "lyrics.txt")
+        with open(text, "w", encoding="utf-8") as file:
+            file.write("\n".join(line for _, line in reference))
+
+        fragments = align(text, vocals)
+        self.assertEqual(
+            [line for _, _, line in fragments],
+            [line for _, line in reference],
+        )
+        errors = [
+            abs(begin - start)
+            for (begin, _, _), (start, _) in zip(fragments, reference)
+        ]
+        # few lines start a syllable or two off
+        self.assertLess(np.mean(errors), 0.2)
+        self.assertLess(max(errors), 1.0)
+
+        shutil.rmtree(path)
+
+
+def process_jobs(path: str, processed: multiprocessing.Queue):
+    """
+    Worker process taking songs from job store until none are left
+    """
+    store = SqliteJobStore(path)
+    owner = get_owner()
+    while True:
+        job = store.claim(owner)
+        if job is None:
+            return
+        processed.put(job[0])
+        store.finish(job[0], owner)
+
+
+class TestJobStore(unittest.TestCase):
+    def test_workers_share_store(self):
+        """
+        Tests if songs queued in one store are processed exactly once
+        by several worker processes
+        """
+        path = os.path.join("downloads", "test_jobs", "jobs.db")
+        store = SqliteJobStore(path)
+        songs = [f"song{i}" for i in range(200)]
+        for song_id in songs:
+            self.assertTrue(store.enqueue(song_id, song_id))
+        self.assertFalse(store.enqueue("song0", "song0"))
+
+        processed: multiprocessing.Queue = multiprocessing.Queue()
+        workers = [
+            multiprocessing.Process(
+                target=process_jobs, args=(path, processed)
+            )
+            for _ in range(4)
+        ]
+        for worker in workers:
+            worker.start()
+        done = [processed.get(timeout=30) for _ in songs]
+        for worker in workers:
+            worker.join()
+
+        self.assertCountEqual(done, songs)
+        self.assertTrue(processed.empty())
+        self.assertEqual(store.count_queued(), 0)
+        self.assertIsNone(store.get_stage("song0"))
+
+        shutil.rmtree(os.path.dirname(path))
+
+    def test_lease_expiry(self):
+        """
+        Tests if song of a worker that stopped renewing its lease is
+        taken over by another worker
+        """
+        path = os.path.join("downloads", "test_lease", "jobs.db")
+        store = SqliteJobStore(path)
+        store.enqueue("song", "song")
+        self.assertEqual(store.claim("dead", lease=0.5)[0], "song")
+        store.renew("dead", {"song": "separate"}, lease=0.5)
+        self.assertIsNone(store.claim("alive"))
+        self.assertEqual(store.get_stage("song"), "separate")
+
+        time.sleep(1)
+        self.assertEqual(store.get_stage("song"), "queued")
+        self.assertEqual(store.claim("alive")[0], "song")
+        # former owner can no longer finish the song
+        store.finish("song", "dead", failed=True)
+        self.assertIsNotNone(store.get_stage("song"))
+        store.finish("song", "alive")
+        self.assertIsNone(store.get_stage("song"))
+
+        shutil.rmtree(os.path.dirname(path))
+
+    def test_batch_order(self):
+        """
+        Tests if songs submitted at once are taken in given order
+        """
+        path = os.path.join("downloads", "test_batch", "jobs.db")
+        store = SqliteJobStore(path)
+        songs = [(f"song{i}", f"link{i}") for i in range(50)]
+        self.assertEqual(store.enqueue_many(songs), [True] * 50)
+        self.assertEqual(store.enqueue_many(songs[:2]), [False] * 2)
+
+        taken = [store.claim("worker")[:2] for _ in songs]
+        self.assertEqual(taken, songs)
+
+        shutil.rmtree(os.path.dirname(path))
+
+    def test_fair_share(self):
+        """
+        Tests if songs are taken by priority, then from clients with
+        fewer songs being processed, and cancelled only when nobody
+        waits for them
+        """
+        path = os.path.join("downloads", "test_fair_share", "jobs.db")
+        store = SqliteJobStore(path)
+        for i in range(3):
+            store.enqueue(f"playlist{i}", "", "greedy")
+        store.enqueue("single", "", "modest")
+        store.enqueue("urgent", "", "vip", priority=1)
+        self.assertEqual(store.count_queued("greedy"), 3)
+
+        order = [store.claim("worker")[0] for _ in range(4)]
+        self.assertEqual(
+            order, ["urgent", "playlist0", "single", "playlist1"]
+        )
+
+        store.enqueue("playlist2", "", "modest")
+        self.assertFalse(store.cancel("playlist2", "greedy"))
+        self.assertTrue(store.cancel("playlist2", "modest"))
+        self.assertIsNone(store.get_stage("playlist2"))
+        self.assertIsNone(store.claim("worker"))
+        self.assertEqual(
+            store.renew(
+                "worker",
+                {"urgent": "download", "playlist2": "download"},
+            ),
+            ["playlist2"],
+        )
+
+        shutil.rmtree(os.path.dirname(path))
+
 
 class TestEngine(unittest.TestCase):
     def test_song_processing(self):
@@ -73,7 +459,8 @@ class TestEngine(unittest.TestCase):
         Tests if engine integration works correctly
         """
         e = Engine(False)
-        dir = "b34263ce6e427d2f161f5bd52035682ae5a79bc1eeaa3616edcd7577d0870d5c"
+        query = "Reverse Sound Effect - Copyright free sound effects"
+        dir = Download.get_song_id(Search(query).results[0]["url"])
         path = os.path.join("downloads", dir)
         e.enqueue(path)
         for _ in range(60):
@@ -84,10 +471,10 @@ class TestEngine(unittest.TestCase):
         path = os.path.join(path, "htdemucs", "audio")
         self.assertTrue(os.path.isdir(path))
 
-        vocals_path = os.path.join(path, "vocals.mp3")
+        vocals_path = os.path.join(path, "vocals.wav")
         self.assertTrue(os.path.isfile(vocals_path))
 
-        no_vocals_path = os.path.join(path, "no_vocals.mp3")
+        no_vocals_path = os.path.join(path, "no_vocals.wav")
         self.assertTrue(os.path.isfile(no_vocals_path))
 
         self.assertGreaterEqual(os.path.getsize(vocals_path), 128)
@@ -96,5 +483,342 @@ class TestEngine(unittest.TestCase):
         shutil.rmtree(os.path.abspath("downloads"))
 
 
+def add_song(store: Store, song_id: str, size: int, done: bool = True):
+    """
+    Writes downloaded audio of given size and registers song,
+    separated one with empty stem unless done is False
+    """
+    song_dir = os.path.join(store.path, song_id)
+    os.makedirs(song_dir, exist_ok=True)
+    with open(os.path.join(song_dir, "audio.webm"), "wb") as file:
+        file.write(os.urandom(size))
+    store.add(song_id)
+    if done:
+        stem = Separator.get_stem_path(song_dir, STEM)
+        os.makedirs(os.path.dirname(stem))
+        open(stem, "wb").close()
+        store.set_done(song_id)
+
+
+class TestStore(unittest.TestCase):
+    def test_lru_eviction(self):
+        """
+        Tests if least recently used songs are evicted first and
+        songs being processed never are
+        """
+        path = os.path.join("downloads", "test_store")
+        store = Store(2500, path)
+        for song_id in ("a", "b", "c"):
+            add_song(store, song_id, 1000)
+        add_song(store, "active", 1000, done=False)
+        store.touch_many({"active": 0.0, "a": 1.0, "b": 3.0, "c": 2.0})
+
+        self.assertEqual(store.over_budget(), ["a"])
+        store.budget = 0
+        self.assertEqual(store.over_budget(), ["a", "c", "b"])
+        store.remove("a")
+        self.assertFalse(os.path.exists(os.path.join(path, "a")))
+        self.assertEqual(store.over_budget(), ["c", "b"])
+
+        # downloads interrupted by restart are removed, unless other
+        # worker is still downloading them
+        for song_id in ("abandoned", "downloading"):
+            os.makedirs(os.path.join(path, song_id))
+        store = Store(
+            1000,
+            path,
+            is_active=lambda song_id: song_id == "downloading",
+        )
+        self.assertFalse(
+            os.path.exists(os.path.join(path, "abandoned"))
+        )
+        self.assertTrue(
+            os.path.exists(os.path.join(path, "downloading"))
+        )
+        self.assertEqual(store.over_budget(), ["c", "b"])
+        self.assertFalse(store.is_done("active"))
+
+        shutil.rmtree(path)
+
+    def test_idle_eviction(self):
+        """
+        Tests if songs not accessed for max idle time are evicted in
+        background, while accessed and unfinished ones are kept
+        """
+        path = os.path.join("downloads", "test_reaper")
+        store = Store(10**9, path)
+        for song_id in ("idle", "used"):
+            add_song(store, song_id, 1000)
+        add_song(store, "active", 1000, done=False)
+
+        evicted = []
+        reaper = Reaper(store, evicted.append, 0.5, 0.1, 100)
+        reaper.touch("active")
+        for _ in range(15):
+            reaper.touch("used")
+            time.sleep(0.1)
+        reaper.stop()
+
+        self.assertEqual(evicted, ["idle"])
+        self.assertFalse(os.path.exists(os.path.join(path, "idle")))
+        self.assertTrue(store.is_done("used"))
+        self.assertTrue(os.path.exists(os.path.join(path, "active")))
+
+        shutil.rmtree(path)
+
+
+def take_all(queue: FairQueue) -> list:
+    """
+    Returns names of all jobs in order queue hands them out
+    """
+    return [queue.get_nowait().name for _ in range(queue.qsize())]
+
+
+def job(name: str, client: str = "", priority: int = 0, duration=None):
+    """
+    Returns stand-in for pipeline job with what FairQueue ranks by
+    """
+    return SimpleNamespace(
+        name=name, client=client, priority=priority, duration=duration
+    )
+
+
+class TestFairQueue(unittest.TestCase):
+    def test_priority(self):
+        """
+        Tests if jobs with higher priority go first, whoever
+        submitted them
+        """
+        queue = FairQueue(3)
+        queue.put_nowait(job("low", "a", -1))
+        queue.put_nowait(job("normal", "a"))
+        queue.put_nowait(job("high", "b", 1))
+        self.assertTrue(queue.full())
+        self.assertEqual(take_all(queue), ["high", "normal", "low"])
+
+    def test_fair_share(self):
+        """
+        Tests if clients take turns, and client that starts waiting
+        later gets no credit for the time it was not waiting
+        """
+        queue = FairQueue()
+        for i in range(4):
+            queue.put_nowait(job(f"a{i}", "a"))
+        queue.put_nowait(job("b0", "b"))
+        queue.put_nowait(job("b1", "b"))
+        self.assertEqual(
+            take_all(queue), ["a0", "b0", "a1", "b1", "a2", "a3"]
+        )
+
+        for i in range(4):
+            queue.put_nowait(job(f"a{i}", "a"))
+        self.assertEqual(queue.get_nowait().name, "a0")
+        self.assertEqual(queue.get_nowait().name, "a1")
+        queue.put_nowait(job("c0", "c"))
+        queue.put_nowait(job("c1", "c"))
+        self.assertEqual(take_all(queue), ["a2", "c0", "a3", "c1"])
+
+    def test_shortest_first(self):
+        """
+        Tests if shorter songs go first only when asked to, songs of
+        unknown duration last
+        """
+        durations = {"long": 300, "unknown": None, "short": 100}
+        for shortest_first, order in (
+            (False, ["long", "unknown", "short"]),
+            (True, ["short", "long", "unknown"]),
+        ):
+            queue = FairQueue(shortest_first=shortest_first)
+            for name, duration in durations.items():
+                queue.put_nowait(job(name, duration=duration))
+            self.assertEqual(take_all(queue), order)
+
+
+class TestSingleFlight(unittest.TestCase):
+    def test_concurrent_requests(self):
+        """
+        Tests if many concurrent requests for the same song download
+        and separate it only once
+        """
+        e = Engine(False)
+        query = "Reverse Sound Effect - Copyright free sound effects"
+        link = Search(query).results[0]["url"]
+        path = os.path.join("downloads", Download.get_song_id(link))
+        shutil.rmtree(path, True)
+
+        def request():
+            Download(link).wait_for()
+            e.enqueue(path)
+            e.wait_for(path)
+
+        dl = mock.patch.object(
+            yt_dlp.YoutubeDL,
+            "dl",
+            autospec=True,
+            side_effect=yt_dlp.YoutubeDL.dl,
+        )
+        sep = mock.patch.object(
+            SeparatorPool,
+            "submit",
+            autospec=True,
+            side_effect=SeparatorPool.submit,
+        )
+        pool = futures.ThreadPoolExecutor(16)
+        with dl as downloads, sep as separations, pool as executor:
+            jobs = [executor.submit(request) for _ in range(64)]
+            for job in jobs:
+                job.result()
+
+        self.assertEqual(downloads.call_count, 1)
+        self.assertEqual(separations.call_count, 1)
+        self.assertTrue(e.is_done(path))
+
+        shutil.rmtree(os.path.abspath("downloads"))
+
+
+class TestSongFiles(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        # api builds its engine on import, so it is imported here
+        from fastapi.testclient import TestClient
+        from src import api_routes
+
+        cls.api = api_routes
+        cls.client = TestClient(api_routes.app)
+        cls.song_id = "test_song_files"
+        cls.path = Download.get_download_dir(cls.song_id)
+        stem = api_routes.get_stem_path(cls.song_id, "vocals")
+        os.makedirs(os.path.dirname(stem), exist_ok=True)
+        with wave.open(stem, "wb") as file:
+            file.setnchannels(2)
+            file.setsampwidth(2)
+            file.setframerate(44100)
+            file.writeframes(os.urandom(44100 * 4))
+        with open(os.path.join(cls.path, "metadata.json"), "w") as file:
+            json.dump({"title": "Test song"}, file)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.path, True)
+
+    def test_not_modified(self):
+        """
+        Tests if client with current copy of a file gets 304
+        """
+        url = f"/v1/metadata/{self.song_id}"
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        etag = response.headers["etag"]
+        modified = response.headers["last-modified"]
+
+        for headers in (
+            {"If-None-Match": etag},
+            {"If-None-Match": f'W/{etag}, "other"'},
+            {"If-Modified-Since": modified},
+        ):
+            response = self.client.get(url, headers=headers)
+            self.assertEqual(response.status_code, 304)
+            self.assertEqual(response.content, b"")
+            self.assertEqual(response.headers["etag"], etag)
+
+        response = self.client.get(
+            url, headers={"If-None-Match": '"x"'}
+        )
+        self.assertEqual(response.status_code, 200)
+
+    def test_range(self):
+        """
+        Tests if encoded stem is served in ranges, and only when
+        If-Range matches, and re-encoded variant keeps its bytes
+        """
+        url = f"/v1/song_vocals/{self.song_id}?format=opus&bitrate=96"
+        whole = self.client.get(url)
+        self.assertEqual(whole.status_code, 200)
+        self.assertIn("immutable", whole.headers["cache-control"])
+        etag = whole.headers["etag"]
+
+        part = self.client.get(
+            url, headers={"Range": "bytes=10-19", "If-Range": etag}
+        )
+        self.assertEqual(part.status_code, 206)
+        self.assertEqual(part.content, whole.content[10:20])
+        self.assertEqual(
+            part.headers["content-range"],
+            f"bytes 10-19/{len(whole.content)}",
+        )
+        stale = self.client.get(
+            url, headers={"Range": "bytes=10-19", "If-Range": '"x"'}
+        )
+        self.assertEqual(stale.status_code, 200)
+
+        # variant evicted from cache is encoded again
+        os.remove(
+            self.api.StemEncoder.get_variant_path(
+                self.api.get_stem_path(self.song_id, "vocals"),
+                "opus",
+                96,
+            )
+        )
+        again = self.client.get(url)
+        self.assertEqual(again.headers["etag"], etag)
+        self.assertEqual(again.content, whole.content)
+
+    def test_saturated(self):
+        """
+        Tests if songs that do not fit in client's quota get 429 with
+        ids of those queued, and separated songs take no room
+        """
+        path = os.path.join("downloads", "test_saturated", "jobs.db")
+        engine = mock.Mock()
+        done = Download.get_download_dir(Download.get_song_id("done"))
+        engine.is_done.side_effect = lambda song_dir: song_dir == done
+        pipeline = self.api.Pipeline(
+            engine,
+            queue_sizes={"download": 4},
+            jobs=SqliteJobStore(path),
+            client_queue_size=2,
+        )
+        links = ["done", "first", "second", "third"]
+        headers = {"X-Client-Id": "greedy"}
+
+        with mock.patch.object(self.api, "pipeline", pipeline):
+            response = self.client.post(
+                "/v1/process_songs",
+                json={"links": links},
+                headers=headers,
+            )
+            self.assertEqual(response.status_code, 429)
+            self.assertGreater(int(response.headers["retry-after"]), 0)
+            song_ids = [Download.get_song_id(link) for link in links]
+            self.assertEqual(
+                response.json()["song_ids"], [*song_ids[:3], None]
+            )
+            # done song is not queued, so its processing is not rerun
+            self.assertIsNone(pipeline.get_stage(song_ids[0]))
+
+            response = self.client.post(
+                "/v1/process_song",
+                params={"link": "third"},
+                headers=headers,
+            )
+            self.assertEqual(response.status_code, 429)
+            self.assertIsNone(response.json().get("song_ids"))
+            response = self.client.post(
+                "/v1/process_song",
+                params={"link": "done"},
+                headers=headers,
+            )
+            self.assertEqual(response.json(), {"song_id": song_ids[0]})
+            # other client has its own quota
+            response = self.client.post(
+                "/v1/process_song",
+                params={"link": "third"},
+                headers={"X-Client-Id": "modest"},
+            )
+            self.assertEqual(response.json(), {"song_id": song_ids[3]})
+
+        shutil.rmtree(os.path.dirname(path))
+
+
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,136 @@
+"""
+Compares speed and timing error of lyrics aligners.
+
+Songs are given as directories with vocals stem and lyrics.srt, whose
+timings are the reference (e.g. a hand corrected one). Without
+directories a synthetic song with known line timings is used.
+
+    python tools/align_benchmark.py [engine ...] [-- song_dir ...]
+"""
+
+import os
+import re
+import shutil
+import sys
+import tempfile
+import time
+import wave
+from os.path import abspath
+from pathlib import Path
+
+import numpy as np
+
+sys.path.insert(0, abspath(Path(sys.argv[0]) / "../../src"))
+
+from aligner import ENGINES, AlignerPool
+from native_aligner import count_syllables
+from separator import Separator
+
+SRT_TIME = re.compile(r"(\d+):(\d+):(\d+),(\d+) -->")
+
+
+def read_srt(path: str):
+    """
+    Returns (start, text) of every line of srt written by Lyrics
+    """
+    with open(path, encoding="utf-8") as file:
+        blocks = file.read().strip().split("\n\n")
+    lines = []
+    for i, block in enumerate(blocks):
+        _, timing, *text = block.split("\n")
+        h, m, s, ms = map(int, SRT_TIME.match(timing).groups())
+        # Lyrics.__write_srt shows every line but the first earlier
+        start = h * 3600 + m * 60 + s + ms / 1000 + (0.5 if i else 0)
+        lines.append((start, " ".join(text)))
+    return lines
+
+
+def make_song(out_dir: str, lines: int = 40, seed: int = 0):
+    """
+    Writes synthetic vocals (a tone per syllable, pauses between
+    lines, instrumental breaks) and returns (start, text) of lines
+    """
+    rng = np.random.default_rng(seed)
+    samplerate = 44100
+    words = ["la", "lala", "banana", "do", "sing", "together", "hey"]
+    audio = [np.zeros(3 * samplerate)]
+    position, reference = 3.0, []
+    for k in range(lines):
+        count = rng.integers(3, 8)
+        text = " ".join(rng.choice(words, count))
+        reference.append((position, text))
+        rate = rng.uniform(0.18, 0.3)
+        for word in text.split():
+            for _ in range(count_syllables(word)):
+                t = np.arange(int(rate * samplerate)) / samplerate
+                fade = np.minimum(1, np.minimum(t, t[::-1]) / 0.02)
+                pitch = rng.uniform(200, 500)
+                audio.append(0.3 * np.sin(2 * np.pi * pitch * t) * fade)
+                audio.append(np.zeros(int(0.03 * samplerate)))
+                position += rate + 0.03
+        pause = 12.0 if k % 10 == 9 else rng.uniform(0.4, 2.5)
+        audio.append(np.zeros(int(pause * samplerate)))
+        position += pause
+
+    samples = np.concatenate(audio)
+    samples += rng.normal(0, 0.003, len(samples))
+    pcm = (np.stack([samples, samples], 1) * 32767).astype(np.int16)
+    path = Separator.get_stem_path(out_dir, "vocals")
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with wave.open(path, "wb") as file:
+        file.setnchannels(2)
+        file.setsampwidth(2)
+        file.setframerate(samplerate)
+        file.writeframes(pcm.tobytes())
+    return reference
+
+
+def main():
+    args = sys.argv[1:]
+    split = args.index("--") if "--" in args else len(args)
+    engines = args[:split] or ["native"]
+    songs = args[split + 1 :]
+
+    work_dir = tempfile.mkdtemp(prefix="align_benchmark")
+    cases = []
+    if not songs:
+        song_dir = os.path.join(work_dir, "synthetic")
+        cases.append((song_dir, make_song(song_dir)))
+    for song_dir in songs:
+        cases.append((song_dir, read_srt(f"{song_dir}/lyrics.srt")))
+
+    for engine in engines:
+        assert engine in ENGINES, f"unknown engine {engine}"
+        pool = AlignerPool(1, 3600, engine)
+        errors, elapsed, duration = [], 0.0, 0.0
+        for i, (song_dir, reference) in enumerate(cases):
+            text_path = os.path.join(work_dir, f"{i}.txt")
+            with open(text_path, "w", encoding="utf-8") as file:
+                file.write("\n".join(text for _, text in reference))
+            vocals = Separator.get_stem_path(song_dir, "vocals")
+            with wave.open(vocals) as file:
+                duration += file.getnframes() / file.getframerate()
+
+            start = time.time()
+            _, fragments = pool.align(text_path, vocals)
+            elapsed += time.time() - start
+            errors += [
+                abs(begin - expected)
+                for (begin, _, _), (expected, _) in zip(
+                    fragments, reference
+                )
+            ]
+        pool.shutdown()
+
+        errors = np.array(errors)
+        print(
+            f"{engine}: {duration / elapsed:.0f}x realtime, "
+            f"line start error mean {errors.mean():.2f}s, "
+            f"median {np.median(errors):.2f}s, "
+            f"within 0.5s {np.mean(errors < 0.5):.0%}"
+        )
+    shutil.rmtree(work_dir, True)
+
+
+if __name__ == "__main__":
+    main()